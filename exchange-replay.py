@@ -0,0 +1,44 @@
+#!/usr/bin/env python3.5
+#
+# Offline replay of recorded orders into the matching engine.
+
+import argparse
+
+from exchange.exchange import Exchange
+from exchange.book import Book
+from exchange.levelbook import LevelBook
+from exchange.instrument import Instrument
+from exchange import replay
+
+BOOKS = {"heap": Book, "levels": LevelBook}
+
+
+def main():
+    # Evaluate cmdline args
+    parser = argparse.ArgumentParser("Replay of recorded orders without networking")
+    parser.add_argument("file", help="Recorded orders, CSV if the name ends with .csv, binary otherwise "
+                                     "(see exchange/replay.py)")
+    parser.add_argument("--target", choices=["exchange", "book"], default="exchange",
+                        help="Replay into the whole exchange or into a single order book ignoring symbols")
+    parser.add_argument("--book", choices=sorted(BOOKS), default="heap", help="Order book implementation")
+    parser.add_argument("--tick-size", default="0.000001", help="Minimal price increment")
+    parser.add_argument("--symbol", action='append', metavar="SYMBOL[:TICK_SIZE]",
+                        help="Traded instrument, can be repeated. Orders without symbol are accepted if not given.")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Multiplier of the recorded pace, e.g. 10 replays ten times faster. As fast as possible "
+                             "if not given.")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="Number of records read at once")
+    args = parser.parse_args()
+
+    instruments = [Instrument(*s.split(":", 1)) if ":" in s else Instrument(s, args.tick_size)
+                   for s in (args.symbol or [""])]
+    if args.target == "exchange":
+        target = Exchange(BOOKS[args.book], instruments)
+    else:
+        target = BOOKS[args.book]()
+    chunks = replay.read_records(args.file, {i.symbol: i for i in instruments}, args.chunk_size)
+    print(replay.replay(chunks, target, args.speed).report())
+
+
+if __name__ == '__main__':
+    main()
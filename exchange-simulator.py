@@ -4,10 +4,21 @@
 
 import asyncio
 import signal
+import time
 import argparse
 
-from exchange.server import OrderServer, DatastreamServer
+from exchange.server import OrderServer, DatastreamServer, LOOPS, new_event_loop
 from exchange.exchange import Exchange
+from exchange.sharding import ShardedExchange
+from exchange.book import Book
+from exchange.levelbook import LevelBook
+from exchange.instrument import Instrument
+from exchange.journal import Journal
+from exchange.metrics import Metrics, MetricsServer, print_metrics
+from exchange.profiling import Profiler
+from exchange.sharedbook import SharedBookPublisher
+
+BOOKS = {"heap": Book, "levels": LevelBook}
 
 
 def _stop_server(signame: str, loop: asyncio.AbstractEventLoop) -> None:
@@ -16,32 +27,116 @@ def _stop_server(signame: str, loop: asyncio.AbstractEventLoop) -> None:
     loop.stop()
 
 
-def _stats_wakeup(loop, exchange):
-    """Prints stats every second"""
-    exchange.print_stats()
-    loop.call_later(1, _stats_wakeup, loop, exchange)
+def _stats_wakeup(loop, metrics):
+    """Prints metrics every second"""
+    print_metrics(metrics)
+    loop.call_later(1, _stats_wakeup, loop, metrics)
 
 
 def main():
-    loop = asyncio.get_event_loop()
-
     # Evaluate cmdline args
     parser = argparse.ArgumentParser("Stock exchange simulation server")
     parser.add_argument("--order-port", type=int, default=7001, help="Port of order/private channel")
     parser.add_argument("--datastream-port", type=int, default=7002, help="Port of datastream/public channel")
-    parser.add_argument("--print-stats", action='store_true', help="Print statistics of open orders")
+    parser.add_argument("--metrics-port", type=int, default=7003,
+                        help="Port of the HTTP endpoint with metrics in the Prometheus text format")
+    parser.add_argument("--no-metrics", action='store_true', help="Don't collect any metrics")
+    parser.add_argument("--print-stats", action='store_true', help="Print metrics every second")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="Enable profiling: SIGUSR1 starts or stops it, SIGUSR2 writes the flamegraph stacks to "
+                             "PREFIX.folded and stage timings of requests to PREFIX.stages.csv")
+    parser.add_argument("--profile-on-start", action='store_true', help="Start profiling right away")
+    parser.add_argument("--profile-interval", type=float, default=1.0,
+                        help="Milliseconds of CPU time between stack samples")
+    parser.add_argument("--slow-callback", type=float, default=10.0,
+                        help="Event loop callbacks running at least this many milliseconds are reported while "
+                             "profiling")
+    parser.add_argument("--loop", choices=LOOPS, default="auto",
+                        help="Event loop implementation, auto uses uvloop when it's installed")
+    parser.add_argument("--book", choices=sorted(BOOKS), default="heap", help="Order book implementation")
+    parser.add_argument("--tick-size", default="0.000001", help="Minimal price increment")
+    parser.add_argument("--symbol", action='append', metavar="SYMBOL[:TICK_SIZE]",
+                        help="Traded instrument, can be repeated. Orders without symbol are accepted if not given.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of matching worker processes, symbols are split among them. Matching runs in the "
+                             "server process if not given.")
+    parser.add_argument("--cancel-on-disconnect", action='store_true',
+                        help="Cancel orders of disconnected clients, unless their session turns it off")
+    parser.add_argument("--datastream-buffer-limit", type=int, default=1024 * 1024,
+                        help="Bytes buffered for a datastream client before it's considered slow")
+    parser.add_argument("--slow-consumer", choices=DatastreamServer.POLICIES, default="drop",
+                        help="What to do with slow datastream clients")
+    parser.add_argument("--journal", metavar="PATH",
+                        help="Journal of accepted orders, the exchange is recovered from it on start")
+    parser.add_argument("--journal-no-fsync", action='store_true',
+                        help="Don't wait for the journal to get to the disk")
+    parser.add_argument("--snapshot-interval", type=int, default=100000,
+                        help="Number of journaled orders between snapshots, 0 disables snapshots")
+    parser.add_argument("--shared-book", metavar="PATH",
+                        help="Publish the best levels of the books to a shared memory file, e.g. /dev/shm/exchange")
+    parser.add_argument("--shared-book-depth", type=int, default=10, help="Number of levels of each side published")
     args = parser.parse_args()
+    if args.journal and args.workers:
+        parser.error("--journal can't be used with --workers")
+    if args.print_stats and args.no_metrics:
+        parser.error("--print-stats can't be used with --no-metrics")
+    if args.profile_on_start and not args.profile:
+        parser.error("--profile-on-start needs --profile")
+    if args.shared_book_depth < 1:
+        parser.error("--shared-book-depth has to be positive")
+    try:
+        loop = new_event_loop(args.loop)
+    except ImportError as ex:
+        parser.error(str(ex))
+    asyncio.set_event_loop(loop)
+    print("Using %s event loop." % type(loop).__module__.split(".")[0])
+    if args.profile and not isinstance(loop, asyncio.BaseEventLoop):
+        print("Slow callbacks are not reported by the profiler with this event loop.")
 
     # create Exchange
-    exchange = Exchange()
+    instruments = [Instrument(*s.split(":", 1)) if ":" in s else Instrument(s, args.tick_size)
+                   for s in (args.symbol or [""])]
+    if args.workers:
+        exchange = ShardedExchange(args.workers, BOOKS[args.book], instruments)
+        exchange.start(loop)
+    else:
+        exchange = Exchange(BOOKS[args.book], instruments)
+    if args.journal:
+        journal = Journal(args.journal, not args.journal_no_fsync, args.snapshot_interval)
+        start = time.perf_counter()
+        replayed = journal.recover(exchange)
+        print("Recovered %d orders from journal in %.3f s." % (replayed, time.perf_counter() - start))
+        exchange.journal = journal
 
     # create TCP servers and start listening
     order_server = OrderServer("localhost", args.order_port, exchange)
-    datastream_server = DatastreamServer("localhost", args.datastream_port, exchange)
-    exchange.set_callbacks(order_server.fill_order_report, datastream_server.send_datastream_report)
+    order_server.cancel_on_disconnect = args.cancel_on_disconnect
+    datastream_server = DatastreamServer("localhost", args.datastream_port, exchange, args.datastream_buffer_limit,
+                                         args.slow_consumer)
+    exchange.add_event_handler(order_server.handle_events)
+    exchange.add_event_handler(datastream_server.handle_events)
+    shared_book = None
+    if args.shared_book:
+        shared_book = SharedBookPublisher(args.shared_book, exchange, args.shared_book_depth)
+        exchange.add_event_handler(shared_book.handle_events)
+    metrics = None
+    if not args.no_metrics:
+        metrics = Metrics()
+        exchange.register_metrics(metrics)
+        order_server.register_metrics(metrics)
+        datastream_server.register_metrics(metrics)
+        if shared_book is not None:
+            shared_book.register_metrics(metrics)
+    metrics_server = MetricsServer("localhost", args.metrics_port, metrics)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile_interval / 1000, args.slow_callback / 1000)
+        order_server.profiler = profiler
     try:
         order_server.start(loop)
         datastream_server.start(loop)
+        if metrics is not None:
+            metrics_server.start(loop)
     except OSError as ex:
         exit("Cannot bind address. Is another server already started?\nFull message: %s" % ex.strerror)
 
@@ -49,17 +144,34 @@ def main():
     for signame in ('SIGINT', 'SIGTERM'):
         loop.add_signal_handler(getattr(signal, signame), _stop_server, signame, loop)
 
-    # Print stats every second if requested
+    if profiler is not None:
+        loop.add_signal_handler(signal.SIGUSR1, profiler.toggle)
+        loop.add_signal_handler(signal.SIGUSR2, profiler.dump, args.profile)
+        if args.profile_on_start:
+            profiler.start()
+
+    # Print metrics every second if requested
     if args.print_stats:
-        loop.call_soon(_stats_wakeup, loop, exchange)
+        loop.call_soon(_stats_wakeup, loop, metrics)
 
     print("Stock exchange simulation server started.")
     try:
         loop.run_forever()
     finally:
         if args.print_stats:
-            exchange.print_stats()
+            print_metrics(metrics)
+        if profiler is not None:
+            profiler.stop()
+            profiler.dump(args.profile)
+        metrics_server.stop(loop)
         order_server.stop(loop)
+        if args.journal:
+            exchange.commit()
+            exchange.journal.close()
+        if args.workers:
+            exchange.stop(loop)
+        if shared_book is not None:
+            shared_book.close()
         loop.close()
 
 
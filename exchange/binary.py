@@ -0,0 +1,158 @@
+"""
+Binary protocol of the order channel.
+
+A client switches its connection to the binary protocol by sending MAGIC as the very first bytes. Each message is then
+sent as a frame consisting of a 2-byte little-endian payload length followed by the payload. The first byte of the
+payload is the message type, the rest has a fixed layout given by the struct formats below. Prices are integer numbers
+of ticks of the instrument, symbols are ASCII strings of at most 8 bytes padded by zeros.
+"""
+import struct
+from typing import Tuple
+
+MAGIC = b"\0EXB"
+
+CREATE_ORDER = 1
+CANCEL_ORDER = 2
+EXECUTION_REPORT = 3
+ERROR = 4
+CANCEL_ALL = 5
+SESSION = 6
+MODIFY_ORDER = 7
+
+SIDES = ["BUY", "SELL"]
+# CANCELLED_ALL finishes cancelAll with orderId 0, the number of cancelled orders as quantity and its symbol
+REPORTS = ["NEW", "FILL", "CANCELLED", "MODIFIED", "CANCELLED_ALL"]
+# cancelAll of both sides, at any price and of all symbols
+ANY_SIDE = 2
+MIN_PRICE = -2 ** 63
+MAX_PRICE = 2 ** 63 - 1
+ALL_SYMBOLS = "*"
+# session flags
+CANCEL_ON_DISCONNECT = 1
+# price of modifyOrder, which keeps the current price, quantity 0 keeps the current quantity
+UNCHANGED_PRICE = -2 ** 63
+
+HEADER = struct.Struct("<H")
+# type, orderId, side, price, quantity, symbol
+CREATE_ORDER_FORMAT = struct.Struct("<BQBqq8s")
+# type, orderId, symbol
+CANCEL_ORDER_FORMAT = struct.Struct("<BQ8s")
+# type, orderId, price or UNCHANGED_PRICE, quantity or 0, symbol
+MODIFY_ORDER_FORMAT = struct.Struct("<BQqq8s")
+# type, side or ANY_SIDE, minimal price, maximal price, symbol or ALL_SYMBOLS
+CANCEL_ALL_FORMAT = struct.Struct("<BBqq8s")
+# type, session flags
+SESSION_FORMAT = struct.Struct("<BB")
+# type, orderId, report, price, quantity, symbol
+EXECUTION_REPORT_FORMAT = struct.Struct("<BQBqq8s")
+# type, reason length, followed by the UTF-8 encoded reason
+ERROR_FORMAT = struct.Struct("<BH")
+
+_side_codes = {side: code for (code, side) in enumerate(SIDES)}
+_report_codes = {report: code for (code, report) in enumerate(REPORTS)}
+
+
+def _frame(payload: bytes) -> bytes:
+    return HEADER.pack(len(payload)) + payload
+
+
+def _symbol(symbol: bytes) -> str:
+    return symbol.rstrip(b"\0").decode("ascii")
+
+
+def unpack_request(payload: bytes) -> Tuple:
+    """
+    :param payload: payload of a frame sent by client
+    :return: ("createOrder", orderid, side, price, qty, symbol), ("cancelOrder", orderid, symbol),
+    ("modifyOrder", orderid, price, qty, symbol) with None meaning unchanged price or qty,
+    ("cancelAll", side, min_price, max_price, symbol) with None meaning any side, price or symbol, or
+    ("session", flags)
+    """
+    if payload[0] == CREATE_ORDER:
+        (_, orderid, side, price, qty, symbol) = CREATE_ORDER_FORMAT.unpack(payload)
+        return "createOrder", orderid, SIDES[side], price, qty, _symbol(symbol)
+    elif payload[0] == CANCEL_ORDER:
+        (_, orderid, symbol) = CANCEL_ORDER_FORMAT.unpack(payload)
+        return "cancelOrder", orderid, _symbol(symbol)
+    elif payload[0] == MODIFY_ORDER:
+        (_, orderid, price, qty, symbol) = MODIFY_ORDER_FORMAT.unpack(payload)
+        return ("modifyOrder", orderid, None if price == UNCHANGED_PRICE else price, qty or None,
+                _symbol(symbol))
+    elif payload[0] == CANCEL_ALL:
+        (_, side, min_price, max_price, symbol) = CANCEL_ALL_FORMAT.unpack(payload)
+        symbol = _symbol(symbol)
+        return ("cancelAll", None if side == ANY_SIDE else SIDES[side], None if min_price == MIN_PRICE else min_price,
+                None if max_price == MAX_PRICE else max_price, None if symbol == ALL_SYMBOLS else symbol)
+    elif payload[0] == SESSION:
+        (_, flags) = SESSION_FORMAT.unpack(payload)
+        return "session", flags
+    raise ValueError("Unknown message type %d" % payload[0])
+
+
+def unpack_response(payload: bytes) -> Tuple:
+    """
+    :param payload: payload of a frame sent by server
+    :return: ("executionReport", orderid, report, price, qty, symbol) or ("error", reason)
+    """
+    if payload[0] == EXECUTION_REPORT:
+        (_, orderid, report, price, qty, symbol) = EXECUTION_REPORT_FORMAT.unpack(payload)
+        return "executionReport", orderid, REPORTS[report], price, qty, _symbol(symbol)
+    elif payload[0] == ERROR:
+        (_, length) = ERROR_FORMAT.unpack_from(payload)
+        return "error", payload[ERROR_FORMAT.size:ERROR_FORMAT.size + length].decode("utf-8")
+    raise ValueError("Unknown message type %d" % payload[0])
+
+
+def pack_create_order(orderid: int, side: str, price: int, qty: int, symbol: str = "") -> bytes:
+    """
+    :return: frame with createOrder request
+    """
+    return _frame(CREATE_ORDER_FORMAT.pack(CREATE_ORDER, orderid, _side_codes[side], price, qty, symbol.encode()))
+
+
+def pack_cancel_order(orderid: int, symbol: str = "") -> bytes:
+    """
+    :return: frame with cancelOrder request
+    """
+    return _frame(CANCEL_ORDER_FORMAT.pack(CANCEL_ORDER, orderid, symbol.encode()))
+
+
+def pack_modify_order(orderid: int, price: int = None, qty: int = None, symbol: str = "") -> bytes:
+    """
+    :return: frame with modifyOrder request, None keeps the current price or qty
+    """
+    return _frame(MODIFY_ORDER_FORMAT.pack(MODIFY_ORDER, orderid, UNCHANGED_PRICE if price is None else price,
+                                           qty or 0, symbol.encode()))
+
+
+def pack_cancel_all(side: str = None, min_price: int = None, max_price: int = None, symbol: str = None) -> bytes:
+    """
+    :return: frame with cancelAll request, None stands for any side, price or symbol
+    """
+    return _frame(CANCEL_ALL_FORMAT.pack(CANCEL_ALL, ANY_SIDE if side is None else _side_codes[side],
+                                         MIN_PRICE if min_price is None else min_price,
+                                         MAX_PRICE if max_price is None else max_price,
+                                         (ALL_SYMBOLS if symbol is None else symbol).encode()))
+
+
+def pack_session(flags: int) -> bytes:
+    """
+    :return: frame with session request setting the session flags, e.g. CANCEL_ON_DISCONNECT
+    """
+    return _frame(SESSION_FORMAT.pack(SESSION, flags))
+
+
+def pack_execution_report(orderid: int, report: str, price: int = 0, qty: int = 0, symbol: str = "") -> bytes:
+    """
+    :return: frame with executionReport, price and qty are used only by FILL reports, qty also by CANCELLED_ALL
+    """
+    return _frame(EXECUTION_REPORT_FORMAT.pack(EXECUTION_REPORT, orderid, _report_codes[report], price, qty,
+                                               symbol.encode()))
+
+
+def pack_error(reason: str) -> bytes:
+    """
+    :return: frame with error report
+    """
+    reason = reason.encode("utf-8")[:0xffff - ERROR_FORMAT.size]
+    return _frame(ERROR_FORMAT.pack(ERROR, len(reason)) + reason)
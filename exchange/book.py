@@ -1,20 +1,29 @@
 import heapq
-from typing import Tuple, List
-from decimal import Decimal
-import copy
+from operator import attrgetter
+from typing import BinaryIO, Tuple, List
 
-from exchange.order import Order
+from exchange import snapshot
+from exchange.order import Order, Fill, ORDER_TYPES
 
 
 class Book:
     """
     Limit order book.
     Orders are managed through open_order and remove_order methods.
+
+    Every resting order is also kept in a per-client index, so cancellation does not have to scan the heaps. Removed
+    orders are only marked as cancelled (tombstones) and are dropped from the heap once they reach its top or when
+    the heap gets compacted.
+
+    An incoming order is matched against the opposite side first and only its remainder is pushed to the heap, so
+    a fully filled order never touches the heap of its own side.
     """
     def __init__(self):
         self._bid = []
         self._ask = []
         self._order_by_price_idx = {}
+        self._orders_by_client = {}  # clientid -> {orderid -> Order}
+        self._cancelled = {"BUY": 0, "SELL": 0}  # number of tombstones left in each heap
 
     def _opposite(self, side: str):
         if side == "BUY":
@@ -29,16 +38,25 @@ class Book:
         elif side == "SELL":
             return self._ask
 
-    def open_order(self, order: Order):
+    def open_order(self, order: Order, order_type: str = "LIMIT"):
         """
-        :param order: Order object
-        :return: filled orders as a list of Order objects.
+        :param order: Order object, its price is ignored for MARKET orders
+        :param order_type: one of order.ORDER_TYPES, only the remainder of a LIMIT order rests in the book
+        :return: the opened order and a list of Fill records of the matched resting orders. The qty of the order is
+        its unfilled remainder, which was cancelled unless the order is a LIMIT one.
+        Raises ValueError if the client has an open order with the same id.
         """
-        table = self._get_table(order.side)
-        assert len(self._ask) == 0 or len(self._bid) == 0 or self._ask[0].price >= self._bid[0].price
-        heapq.heappush(table, order)
-        self._update_price_qty(order.side, order.price, order.qty)
-        return self._try_match_order(order)
+        assert order_type in ORDER_TYPES, "Unknown order type"
+        if order.id in self._orders_by_client.get(order.clientid, ()):
+            raise ValueError("Order with specified id is already open")
+        if order_type == "FOK" and self._available_qty(order) < order.qty:
+            return order, []
+        filled = self._try_match_order(order, order_type == "MARKET")
+        if order.qty > 0 and order_type == "LIMIT":
+            heapq.heappush(self._get_table(order.side), order)
+            self._orders_by_client.setdefault(order.clientid, {})[order.id] = order
+            self._update_price_qty(order.side, order.price, order.qty)
+        return order, filled
 
     def remove_order(self, clientid: str, orderid: str) -> Order:
         """
@@ -46,56 +64,168 @@ class Book:
         :param orderid: Order_id assigned by client during opening.
         :return: The removed order.
         """
-        for side in ['BUY', 'SELL']:
-            orders = self._get_table(side)
-            for idx, order in enumerate(orders):
-                if order.clientid == clientid and order.id == orderid:
-                    if len(orders) > 1:
-                        orders[idx] = orders.pop()
-                        heapq.heapify(orders)
-                    else:
-                        del orders[idx]
-                    self._update_price_qty(side, order.price, -order.qty)
-                    return order
-        raise KeyError("Order with specified id does not exit")
-
-    def _try_match_order(self, opened_order: Order) -> Tuple[Order, List[Order]]:
-        filled = []
-        if len(self._bid) == 0 or len(self._ask) == 0:
-            return opened_order, filled
-        table = self._get_table(self._opposite(opened_order.side))
+        try:
+            orders = self._orders_by_client[clientid]
+            order = orders.pop(orderid)
+        except KeyError:
+            raise KeyError("Order with specified id does not exit")
+        if not orders:
+            del self._orders_by_client[clientid]
+        order.cancelled = True
+        self._cancelled[order.side] += 1
+        self._update_price_qty(order.side, order.price, -order.qty)
+        self._clean_table(order.side)
+        return order
+
+    def get_order(self, clientid: str, orderid: str) -> Order:
+        """
+        :param clientid Client id.
+        :param orderid: Order_id assigned by client during opening.
+        :return: The resting order, raises KeyError if there is none.
+        """
+        try:
+            return self._orders_by_client[clientid][orderid]
+        except KeyError:
+            raise KeyError("Order with specified id does not exit")
 
-        while len(table) > 0 and self._matches(opened_order, table[0]) and opened_order.qty > 0:
-            assert self._get_table(opened_order.side)[0].id == opened_order.id
+    def modify_order(self, clientid: str, orderid: str, price: int = None, qty: int = None):
+        """
+        Changes price and/or remaining qty of a resting order. Reducing the qty at the same price updates the order in
+        place, so it keeps its time priority. Any other change re-queues the order at once: it is removed and opened
+        again as a new order with the same id, which is matched first if its new price crosses the book.
+        :param price: new price, None keeps the current one
+        :param qty: new remaining qty, None keeps the current one
+        :return: the order in the book, a new Order object if it was re-queued, and a list of Fill records of the
+        matched resting orders, see open_order
+        """
+        order = self.get_order(clientid, orderid)
+        price = order.price if price is None else price
+        qty = order.qty if qty is None else qty
+        assert qty > 0, "Quantity has to be positive"
+        if price == order.price and qty <= order.qty:
+            self._update_price_qty(order.side, price, qty - order.qty)
+            order.qty = qty
+            return order, []
+        self.remove_order(clientid, orderid)
+        return self.open_order(Order(orderid, clientid, order.side, price, qty))
 
-            # It's a match
-            qty = min(opened_order.qty, table[0].qty)
-            assert qty != 0
-            price = opened_order.price if opened_order.side == "BUY" else table[0].price
+    def remove_client_orders(self, clientid: str, side: str = None, min_price: int = None,
+                             max_price: int = None) -> List[Order]:
+        """
+        Removes all resting orders of a client, optionally only those of one side or within a price range. It takes
+        time proportional to the number of orders of the client, not of the book.
+        :param clientid: Client id.
+        :param side: Order side, "BUY" or "SELL", None for both sides.
+        :param min_price: lowest price of removed orders, None for no limit.
+        :param max_price: highest price of removed orders, None for no limit.
+        :return: list of the removed orders in the order in which they were opened.
+        """
+        orders = self._orders_by_client.get(clientid)
+        if not orders:
+            return []
+        removed = [order for order in orders.values() if (side is None or order.side == side) and
+                   (min_price is None or order.price >= min_price) and (max_price is None or order.price <= max_price)]
+        for order in removed:
+            self.remove_order(clientid, order.id)
+        return removed
 
-            # Opened order
-            opened_order.qty -= qty
-            opened_order.price_traded = price
-            self._update_price_qty(opened_order.side, opened_order.price, -qty)
-            if opened_order.qty == 0:
-                assert heapq.heappop(self._get_table(opened_order.side)).id == opened_order.id
+    def dump(self, file: BinaryIO) -> None:
+        """
+        Writes live orders of both sides in priority order to a binary file, see the snapshot module.
+        """
+        sides = {}
+        for side in snapshot.SIDES:
+            # Two stable sorts by attributes are much faster than sorting by Order.__lt__.
+            orders = sorted((order for order in self._get_table(side) if not order.cancelled), key=attrgetter("seq"))
+            orders.sort(key=attrgetter("price"), reverse=side == "BUY")
+            sides[side] = orders
+        snapshot.write_book(file, sides)
+
+    @classmethod
+    def load(cls, file: BinaryIO) -> "Book":
+        """
+        Creates a book from a snapshot written by dump without matching the orders again.
+        """
+        book = cls()
+        for (side, (levels, orders)) in snapshot.read_book(file).items():
+            book._get_table(side)[:] = orders  # a sorted list is a valid heap
+            for (price, qty, count) in levels:
+                book._order_by_price_idx[(side, price)] = qty
+            for order in orders:
+                client_orders = book._orders_by_client.setdefault(order.clientid, {})
+                if order.id in client_orders:
+                    raise ValueError("Snapshot contains order %s of client %s twice" % (order.id, order.clientid))
+                client_orders[order.id] = order
+        return book
+
+    def get_order_count(self, side: str) -> int:
+        """
+        :param side: Order side, "BUY" or "SELL".
+        :return: number of orders resting on the specified side of order book.
+        """
+        return len(self._get_table(side)) - self._cancelled[side]
+
+    def _unindex_order(self, order: Order) -> None:
+        orders = self._orders_by_client.get(order.clientid)
+        if orders is not None and orders.get(order.id) is order:
+            del orders[order.id]
+            if not orders:
+                del self._orders_by_client[order.clientid]
+
+    def _clean_table(self, side: str) -> None:
+        """
+        Drops cancelled orders from the top of the heap, so table[0] is always a live order. The whole heap is
+        rebuilt when tombstones outnumber live orders, which keeps the memory overhead bounded.
+        """
+        table = self._get_table(side)
+        while table and table[0].cancelled:
+            heapq.heappop(table)
+            self._cancelled[side] -= 1
+        if self._cancelled[side] > 64 and 2 * self._cancelled[side] > len(table):
+            table[:] = [order for order in table if not order.cancelled]
+            heapq.heapify(table)
+            self._cancelled[side] = 0
 
-            # Matched orders
-            order_report = copy.copy(table[0])
-            order_report.qty = qty
-            order_report.price_traded = price
-            filled.append(order_report)
-            table[0].qty -= qty
-            self._update_price_qty(order_report.side, order_report.price, -qty)
+    def _pop_top(self, side: str) -> Order:
+        order = heapq.heappop(self._get_table(side))
+        self._unindex_order(order)
+        self._clean_table(side)
+        return order
 
-            if table[0].qty == 0:
-                assert table[0].id == heapq.heappop(table).id
-            assert len(table) == 0 or table[0].qty > 0
-            assert len(self._get_table(opened_order.side)) == 0 or self._get_table(opened_order.side)[0].qty > 0
+    def _try_match_order(self, opened_order: Order, market: bool = False) -> List[Fill]:
+        filled = []
+        side = self._opposite(opened_order.side)
+        table = self._get_table(side)
+        # table[0] is always a live order, see _clean_table
+        while opened_order.qty > 0 and table and (market or self._matches(opened_order, table[0])):
+            resting = table[0]
 
-        return opened_order, filled
+            # It's a match
+            qty = min(opened_order.qty, resting.qty)
+            price = opened_order.price if opened_order.side == "BUY" and not market else resting.price
+            opened_order.qty -= qty
+            filled.append(Fill(resting.id, resting.clientid, resting.side, resting.price, qty, price))
+            resting.qty -= qty
+            self._update_price_qty(side, resting.price, -qty)
+            if resting.qty == 0:
+                self._pop_top(side)
+        return filled
+
+    def _available_qty(self, order: Order) -> int:
+        """
+        :return: qty resting at prices matching the order, counted only until it reaches the qty of the order
+        """
+        side = self._opposite(order.side)
+        available = 0
+        for ((level_side, price), qty) in self._order_by_price_idx.items():
+            if level_side == side and (order.side == "BUY" and order.price > price or
+                                       order.side == "SELL" and order.price < price):
+                available += qty
+                if available >= order.qty:
+                    break
+        return available
 
-    def get_price_qty(self, side: str, price: Decimal) -> int:
+    def get_price_qty(self, side: str, price: int) -> int:
         """
         :param side: Order side, "BUY" or "SELL".
         :param price: Price too look-up.
@@ -106,7 +236,17 @@ class Book:
         except KeyError:
             return 0
 
-    def _update_price_qty(self, side: str, price: Decimal, qty: int) -> None:
+    def get_depth(self, side: str, depth: int) -> List[Tuple[int, int]]:
+        """
+        :param side: Order side, "BUY" or "SELL".
+        :param depth: Maximal number of price levels.
+        :return: list of (price, qty) of the best price levels of the specified side, best first.
+        """
+        prices = [price for (level_side, price) in self._order_by_price_idx if level_side == side]
+        best = heapq.nlargest(depth, prices) if side == "BUY" else heapq.nsmallest(depth, prices)
+        return [(price, self._order_by_price_idx[(side, price)]) for price in best]
+
+    def _update_price_qty(self, side: str, price: int, qty: int) -> None:
         try:
             self._order_by_price_idx[(side, price)] += qty
             if self._order_by_price_idx[(side, price)] == 0:
@@ -1,23 +1,40 @@
-from typing import Callable
-import datetime
-from decimal import Decimal, getcontext
+from typing import Callable, Iterable
+import asyncio
+import time
 
 from exchange import book
+from exchange.instrument import Instrument
+
+
+# Types of events, which are reported to the public/datastream channel
+DATASTREAM_EVENTS = ("trade", "orderbook", "cancel")
 
 
 class Exchange:
     """
-    Trading logic. This class provides opening and closing orders in asynchronous way provides callbacks on different
-    events.
+    Trading logic. Orders are matched synchronously by open_order_events and cancel_order_events, which return lists
+    of resulting events. Servers get these events in bulk through event handlers, see Exchange.publish.
+    The coroutines open_order and cancel_order additionally pass the events one by one to the callbacks.
     """
 
-    def __init__(self):
+    def __init__(self, book_class: type = book.Book, instruments: Iterable[Instrument] = None):
+        """
+        :param book_class: order book implementation, book.Book (heap of orders) or levelbook.LevelBook (ladder of
+        price levels)
+        :param instruments: traded instruments, which define symbols and tick sizes used to convert prices to integer
+        ticks. A single instrument with empty symbol is traded by default.
+        """
         self.next_clientid = 0
-        self.book = book.Book()
+        self.book_class = book_class
+        self.instruments = {i.symbol: i for i in (instruments or [Instrument()])}
+        self.books = {}  # symbol -> book, created on first order for the symbol
         self.fill_callback = None
         self.datastream_callback = None
+        self.event_handlers = []
+        self.journal = None  # journal.Journal of accepted commands, see Exchange.publish
         self.stats = {"opened": 0, "traded": 0}
-        getcontext().prec = 16
+        self._unpublished = []  # events waiting for the commit of the journal
+        self._commit_scheduled = False
 
     def get_clientid(self) -> int:
         """
@@ -27,72 +44,258 @@ class Exchange:
         self.next_clientid += 1
         return id
 
-    async def open_order(self, orderid: str, clientid: int, side: str, price: Decimal, qty: int) -> None:
+    def get_instrument(self, symbol: str = "") -> Instrument:
+        """
+        :param symbol: symbol of the instrument
+        :return: the instrument, raises KeyError for unknown symbols
+        """
+        try:
+            return self.instruments[symbol]
+        except KeyError:
+            raise KeyError("Unknown symbol %s" % symbol)
+
+    def get_book(self, symbol: str = ""):
+        """
+        :param symbol: symbol of the instrument
+        :return: order book of the instrument, which is created when needed for the first time
+        """
+        try:
+            return self.books[symbol]
+        except KeyError:
+            self.get_instrument(symbol)
+            book = self.books[symbol] = self.book_class()
+            return book
+
+    def open_order_events(self, orderid: str, clientid: int, side: str, price: int, qty: int,
+                          symbol: str = "", order_type: str = "LIMIT") -> list:
         """
-        Opens new trading order.
+        Opens new trading order without calling any callbacks.
         :param orderid: string id unique for a client
         :param clientid: number of client
         :param side: order side, "BUY" or "SELL"
-        :param price: desired price of order as str or decimal.Decimal
+        :param price: desired price of order as integer number of ticks (see Instrument.to_ticks), None for MARKET
+        orders
         :param qty: desired amount of equity
-        :return: None
+        :param symbol: symbol of the traded instrument
+        :param order_type: one of order.ORDER_TYPES, the unfilled remainder of other than LIMIT orders is cancelled
+        :return: list of events caused by the order, see Exchange.publish
         """
+        book_obj = self.get_book(symbol)
         order = book.Order(orderid, clientid, side, price, qty)
-        (order, filled) = self.book.open_order(order)
-        order_was_traded = len(filled) > 0
-        order_was_fully_traded = order.qty == 0
+        (order, filled) = book_obj.open_order(order, order_type)
+        if self.journal is not None:
+            if order_type == "LIMIT":
+                self.journal.append(("open", orderid, clientid, side, price, qty, symbol))
+            else:
+                self.journal.append(("open", orderid, clientid, side, price, qty, symbol, order_type))
         self.stats["opened"] += 1
-        if order_was_traded:
+        events = [("new", clientid, orderid, symbol)]
+        self._match_events(events, book_obj, order, qty - order.qty, filled, order_type, symbol, time.time())
+        return events
+
+    def _match_events(self, events: list, book_obj, order: book.Order, traded: int, filled: list, order_type: str,
+                      symbol: str, now: float) -> None:
+        # Appends events of an order, which traded qty against the filled resting orders and whose remainder is left
+        # in order.qty.
+        if filled:
             self.stats["traded"] += 2
-        if self.fill_callback and order_was_traded:
-            await self.fill_callback(order.clientid, order.id, order.price_traded, qty-order.qty)
+            price_traded = filled[-1].price_traded
+            events.append(("fill", order.clientid, order.id, price_traded, traded, symbol))
             for filled_order in filled:
-                await self.fill_callback(filled_order.clientid, filled_order.id, filled_order.price_traded,
-                                         filled_order.qty)
-        if self.datastream_callback:
-            if order_was_traded:
-                # Notify about the conducted trade.
-                await self.datastream_callback("trade", None, order.time, order.price_traded, qty - order.qty)
-
-                # Notify about the changed rows of the limit order book.
-                for changed_order in filled:  # We may have already notified about the first order.
-                    await self.datastream_callback("orderbook", changed_order.side, changed_order.time,
-                                                   changed_order.price, self.book.get_price_qty(changed_order.side,
-                                                                                                changed_order.price))
-            if not order_was_fully_traded:
-                # Notify about the opened order only if it has not been fully traded and therefore remains in the book.
-                # There are no more orders with the same price and side, as they would have get fulfilled already.
-                qty_left = self.book.get_price_qty(order.side, order.price)
-                await self.datastream_callback("orderbook", order.side, order.time, order.price, qty_left)
-
-    async def cancel_order(self, clientid: int, orderid: str) -> None:
-        """
-        Removes order
+                events.append(("fill", filled_order.clientid, filled_order.id, filled_order.price_traded,
+                               filled_order.qty, symbol))
+            # Notify about the conducted trade and the changed rows of the limit order book.
+            events.append(("trade", None, now, price_traded, traded, symbol))
+            for changed_order in filled:
+                events.append(("orderbook", changed_order.side, now, changed_order.price,
+                               book_obj.get_price_qty(changed_order.side, changed_order.price), symbol))
+        if order.qty and order_type != "LIMIT":
+            events.append(("cancelled", order.clientid, order.id, symbol))
+        elif order.qty:
+            # Notify about the opened order only if it has not been fully traded and therefore remains in the book.
+            # There are no more orders with the same price and side, as they would have get fulfilled already.
+            events.append(("orderbook", order.side, now, order.price,
+                           book_obj.get_price_qty(order.side, order.price), symbol))
+
+    def cancel_order_events(self, clientid: int, orderid: str, symbol: str = "") -> list:
+        """
+        Removes order without calling any callbacks.
+        :param clientid: int id of client
+        :param orderid: order id unique for the client
+        :param symbol: symbol of the traded instrument
+        :return: list of events caused by the cancel, see Exchange.publish
+        """
+        if symbol not in self.books:
+            raise KeyError("Order with specified id does not exit")
+        order = self.books[symbol].remove_order(clientid, orderid)
+        if self.journal is not None:
+            self.journal.append(("cancel", clientid, orderid, symbol))
+        return [("cancelled", clientid, orderid, symbol),
+                ("cancel", order.side, time.time(), order.price, order.qty, symbol)]
+
+    def modify_order_events(self, clientid: int, orderid: str, price: int = None, qty: int = None,
+                            symbol: str = "") -> list:
+        """
+        Changes price and/or remaining qty of a resting order without calling any callbacks. A reduced qty at the same
+        price keeps the time priority of the order, any other change re-queues it, see Book.modify_order.
         :param clientid: int id of client
         :param orderid: order id unique for the client
-        :return: None
+        :param price: new price as integer number of ticks, None keeps the current one
+        :param qty: new remaining qty, None keeps the current one
+        :param symbol: symbol of the traded instrument
+        :return: list of events caused by the change, see Exchange.publish. A re-queued order can trade at once.
+        """
+        if symbol not in self.books:
+            raise KeyError("Order with specified id does not exit")
+        book_obj = self.books[symbol]
+        original = book_obj.get_order(clientid, orderid)
+        (side, old_price) = (original.side, original.price)
+        (order, filled) = book_obj.modify_order(clientid, orderid, price, qty)
+        if self.journal is not None:
+            self.journal.append(("modify", clientid, orderid, price, qty, symbol))
+        now = time.time()
+        events = [("modified", clientid, orderid, symbol)]
+        if order is not original:
+            self._match_events(events, book_obj, order, sum(f.qty for f in filled), filled, "LIMIT", symbol, now)
+            if order.qty and order.price == old_price:
+                return events  # the row of the book was already reported
+        events.append(("orderbook", side, now, old_price, book_obj.get_price_qty(side, old_price), symbol))
+        return events
+
+    def cancel_all_events(self, clientid: int, symbol: str = None, side: str = None, min_price: int = None,
+                          max_price: int = None) -> list:
         """
-        order = self.book.remove_order(clientid, orderid)
-        if self.datastream_callback:
-            await self.datastream_callback("cancel", order.side, order.time, order.price, order.qty)
+        Removes all resting orders of a client, optionally filtered, without calling any callbacks.
+        :param clientid: int id of client
+        :param symbol: symbol of the traded instrument, None for all instruments
+        :param side: "BUY" or "SELL", None for both sides
+        :param min_price: lowest price in ticks of cancelled orders, None for no limit
+        :param max_price: highest price in ticks of cancelled orders, None for no limit
+        :return: list of events caused by the cancel, see Exchange.publish. Every cancelled order is acknowledged by
+        a "cancelled" event, but there is only one "cancel" event with the total cancelled qty per price level. The
+        list ends with a "cancelledAll" event with the number of cancelled orders, even if there were none.
+        """
+        assert side in [None, "BUY", "SELL"], "Side has to be BUY or SELL"
+        if symbol is None:
+            symbols = list(self.books)
+        else:
+            self.get_instrument(symbol)
+            symbols = [symbol] if symbol in self.books else []
+        now = time.time()
+        events = []
+        count = 0
+        for symbol_ in symbols:
+            removed = self.books[symbol_].remove_client_orders(clientid, side, min_price, max_price)
+            levels = {}  # (side, price) -> cancelled qty
+            for order in removed:
+                events.append(("cancelled", clientid, order.id, symbol_))
+                levels[(order.side, order.price)] = levels.get((order.side, order.price), 0) + order.qty
+            for ((side_, price), qty) in levels.items():
+                events.append(("cancel", side_, now, price, qty, symbol_))
+            count += len(removed)
+        if count and self.journal is not None:
+            self.journal.append(("cancelAll", clientid, symbol, side, min_price, max_price))
+        events.append(("cancelledAll", clientid, count, symbol))
+        return events
+
+    async def open_order(self, orderid: str, clientid: int, side: str, price: int, qty: int, symbol: str = "",
+                         order_type: str = "LIMIT") -> None:
+        """
+        Opens new trading order, publishes its events and passes them to the callbacks.
+        See Exchange.open_order_events for description of parameters.
+        """
+        events = self.open_order_events(orderid, clientid, side, price, qty, symbol, order_type)
+        self.publish(events)
+        await self._run_callbacks(events)
+
+    async def cancel_order(self, clientid: int, orderid: str, symbol: str = "") -> None:
+        """
+        Removes order, publishes its events and passes them to the callbacks.
+        See Exchange.cancel_order_events for description of parameters.
+        """
+        events = self.cancel_order_events(clientid, orderid, symbol)
+        self.publish(events)
+        await self._run_callbacks(events)
+
+    def add_event_handler(self, handler: Callable[[list], None]) -> None:
+        """
+        Adds a handler, i.e. a plain function, which is called with every list of events passed to Exchange.publish.
+        """
+        self.event_handlers.append(handler)
+
+    def publish(self, events: list) -> None:
+        """
+        Passes a list of events to all event handlers at once. Prices of events are integer numbers of ticks. Events
+        are tuples starting with their type:
+        - ("new", clientid, orderid, symbol) acknowledges an opened order,
+        - ("modified", clientid, orderid, symbol) acknowledges a changed order,
+        - ("cancelled", clientid, orderid, symbol) acknowledges a cancelled order or reports the cancelled remainder
+          of an IOC, FOK or MARKET order,
+        - ("cancelledAll", clientid, count, symbol) finishes a cancel of all orders of a client with the number of
+          cancelled orders, symbol is None for all instruments,
+        - ("fill", clientid, orderid, price, qty, symbol) reports a traded quantity of an order,
+        - ("error", clientid, reason) reports a failed request,
+        - (type, side, time, price, qty, symbol), where type is one of DATASTREAM_EVENTS, report a trade or a changed
+          row of the order book for the datastream. Side is None for "trade" events.
+
+        With a journal, the events are passed to the handlers only after the commands causing them were committed to
+        the journal. The commit is done once per event loop iteration for all events published meanwhile.
+        """
+        if self.journal is None:
+            for handler in self.event_handlers:
+                handler(events)
+            return
+        self._unpublished += events
+        if not self._commit_scheduled:
+            self._commit_scheduled = True
+            asyncio.get_event_loop().call_soon(self.commit)
+
+    def commit(self) -> None:
+        """
+        Commits the journal, writes a snapshot if it is due and passes the events deferred by Exchange.publish to the
+        event handlers.
+        """
+        self._commit_scheduled = False
+        self.journal.commit()
+        if self.journal.snapshot_due():
+            self.journal.snapshot(self)
+        events = self._unpublished
+        self._unpublished = []
+        for handler in self.event_handlers:
+            handler(events)
+
+    async def _run_callbacks(self, events: list) -> None:
+        for event in events:
+            if event[0] == "fill":
+                if self.fill_callback:
+                    await self.fill_callback(*event[1:])
+            elif event[0] in DATASTREAM_EVENTS:
+                if self.datastream_callback:
+                    await self.datastream_callback(*event)
 
-    def set_callbacks(self, fill: Callable[[str, int, Decimal, int], None], datastream: Callable[[str, str,
-                                                                            datetime.time, Decimal, int], None])-> None:
+    def set_callbacks(self, fill: Callable[[str, int, int, int, str], None],
+                      datastream: Callable[[str, str, float, int, int, str], None]) -> None:
         """
         Sets callbacks i.e. functions, which will be called when an order is opened, closed or traded.
+        Prices passed to the callbacks are integer numbers of ticks.
         :param fill: Method, that will be called when an order was filled. That function should accept clientid,
-        orderid, price and qty.
+        orderid, price, qty and symbol.
         :param datastream: Method, that will be called when there are data for the public/datastream channel. That
-        function should accept order_type, side ("BUY" or "SELL"), time as datetime.time, price and qty.
+        function should accept order_type, side ("BUY" or "SELL"), time of the event as UNIX timestamp, price, qty
+        and symbol.
         """
         self.fill_callback = fill
         self.datastream_callback = datastream
 
-    def print_stats(self):
+    def register_metrics(self, metrics) -> None:
         """
-        Prints statistics of server utilization e.g. number of opened or traded orders.
+        Registers counters of orders and gauges of the books and the journal in a metrics.Metrics object.
         """
-        print("Opened orders:", self.stats["opened"])
-        print("Traded orders:", self.stats["traded"])
-        print("Leftover SELL orders:", len(self.book._ask))
-        print("Leftover BUY orders:", len(self.book._bid))
+        metrics.counter("exchange_orders_opened", lambda: self.stats["opened"])
+        metrics.counter("exchange_orders_traded", lambda: self.stats["traded"])
+        metrics.gauge("exchange_books", lambda: len(self.books))
+        metrics.gauge("exchange_book_bid_orders", lambda: sum(b.get_order_count("BUY") for b in self.books.values()))
+        metrics.gauge("exchange_book_ask_orders", lambda: sum(b.get_order_count("SELL") for b in self.books.values()))
+        metrics.counter("journal_commits", lambda: self.journal.stats["commits"] if self.journal else 0)
+        metrics.counter("journal_commands", lambda: self.journal.stats["commands"] if self.journal else 0)
+        metrics.counter("journal_snapshots", lambda: self.journal.stats["snapshots"] if self.journal else 0)
@@ -0,0 +1,76 @@
+from typing import Iterator, Tuple
+
+
+class Histogram:
+    """
+    Histogram of non-negative integer values, e.g. latencies in nanoseconds, with logarithmic buckets in the manner of
+    HdrHistogram. Every power of two is split into SUB_BUCKETS linear buckets, so a value is known with relative error
+    below 1 / SUB_BUCKETS while recording stays a constant time operation.
+    """
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts = [0] * (64 * self.SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        """
+        :param value: non-negative integer, values from 32 up share buckets as wide as 1/16 of their power of two
+        """
+        value = int(value)
+        if value < 2 * self.SUB_BUCKETS:
+            self.counts[value] += 1
+        else:
+            shift = value.bit_length() - self.SUB_BITS - 1
+            self.counts[shift * self.SUB_BUCKETS + (value >> shift)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram") -> None:
+        """
+        Adds all values recorded by another histogram.
+        """
+        self.counts = [a + b for (a, b) in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def reset(self) -> None:
+        """
+        Forgets all recorded values.
+        """
+        self.__init__()
+
+    def mean(self) -> float:
+        """
+        :return: mean of recorded values, 0 if there are none
+        """
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, percentile: float) -> int:
+        """
+        :param percentile: number from 0 to 100
+        :return: upper bound of the bucket containing the value at the percentile, 0 if there are no values
+        """
+        limit = percentile / 100 * self.count
+        seen = 0
+        for (lower, upper, count) in self.buckets():
+            seen += count
+            if seen >= limit:
+                return min(upper, self.max)
+        return self.max
+
+    def buckets(self) -> Iterator[Tuple[int, int, int]]:
+        """
+        :return: generator of (lowest value, highest value, count) of non-empty buckets in ascending order
+        """
+        for (index, count) in enumerate(self.counts):
+            if count:
+                shift = max(index // self.SUB_BUCKETS - 1, 0)
+                lower = (index - shift * self.SUB_BUCKETS) << shift
+                yield lower, lower + (1 << shift) - 1, count
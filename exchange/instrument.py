@@ -0,0 +1,36 @@
+from decimal import Decimal
+
+
+class Instrument:
+    """
+    Traded instrument. Prices are represented as integer numbers of ticks inside the exchange, this class converts
+    them from and to the decimal strings used by clients.
+    """
+    def __init__(self, symbol: str = "", tick_size: str = "0.000001"):
+        """
+        :param symbol: name of the instrument
+        :param tick_size: minimal price increment as str or decimal.Decimal
+        """
+        self.symbol = symbol
+        self.tick_size = Decimal(tick_size)
+        assert self.tick_size > 0, "Tick size has to be positive"
+
+    def to_ticks(self, price: str) -> int:
+        """
+        :param price: price as str or decimal.Decimal
+        :return: price as integer number of ticks
+        """
+        (ticks, remainder) = divmod(Decimal(price), self.tick_size)
+        if remainder:
+            raise ValueError("Price %s is not a multiple of tick size %s" % (price, self.tick_size))
+        return int(ticks)
+
+    def to_price(self, ticks: int) -> str:
+        """
+        :param ticks: price as integer number of ticks
+        :return: price as decimal string without trailing zeros
+        """
+        return "{:f}".format((ticks * self.tick_size).normalize())
+
+    def __repr__(self) -> str:
+        return "%s(tick %s)" % (self.symbol, self.tick_size)
@@ -0,0 +1,168 @@
+"""
+Append-only journal of commands accepted by the exchange.
+
+Commands are collected in memory and written by commit as one block, so the costs of serialisation and fsync are shared
+by all commands accepted since the previous commit. Every block consists of a header with the payload length, CRC32 of
+the payload and the sequence number of its first command, followed by the pickled list of command tuples,
+("open", orderid, clientid, side, price, qty, symbol[, order_type]) with order_type given only for other than LIMIT
+orders, ("cancel", clientid, orderid, symbol), ("modify", clientid, orderid, price, qty, symbol) or
+("cancelAll", clientid, symbol, side, min_price, max_price) written only when it cancelled some orders. A block
+torn by a crash fails the CRC check and it and everything after it is discarded on recovery. Events of its commands
+were not published yet, see exchange.Exchange.publish.
+
+A snapshot of the exchange, consisting of its pickled state followed by snapshots of its books (see the snapshot
+module), is written next to the journal every snapshot_interval commands and the journal is truncated afterwards,
+which bounds the time of recovery.
+"""
+import os
+import pickle
+import struct
+import zlib
+
+# payload length, CRC32 of payload, sequence number of the first command
+HEADER = struct.Struct("<IIQ")
+PICKLE_PROTOCOL = 4
+
+
+def read_records(data: bytes):
+    """
+    Iterates over commands in complete and undamaged blocks of a journal.
+    :param data: content of the journal
+    :return: generator of (offset of the end of the block, sequence number, command)
+    """
+    position = 0
+    while len(data) - position >= HEADER.size:
+        (length, crc, seq) = HEADER.unpack_from(data, position)
+        end = position + HEADER.size + length
+        payload = data[position + HEADER.size:end]
+        if end > len(data) or zlib.crc32(payload) != crc:
+            return
+        for (n, command) in enumerate(pickle.loads(payload)):
+            yield end, seq + n, command
+        position = end
+
+
+class Journal:
+    """
+    Journal of one exchange.Exchange. Recover the exchange by Journal.recover before setting it as Exchange.journal.
+    """
+
+    def __init__(self, path: str, fsync: bool = True, snapshot_interval: int = 100000):
+        """
+        :param path: file of the journal, the snapshot is stored in path + ".snapshot"
+        :param fsync: whether commit waits for the data to get to the disk, not only to the operating system
+        :param snapshot_interval: number of commands between snapshots, 0 disables snapshots
+        """
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.fsync = fsync
+        self.snapshot_interval = snapshot_interval
+        self.seq = 0  # sequence number of the last committed command
+        self.stats = {"commits": 0, "commands": 0, "snapshots": 0}
+        self._snapshot_seq = 0  # sequence number of the last command included in the snapshot
+        self._commands = []  # commands waiting for commit
+        self._file = None
+
+    def recover(self, exchange_obj) -> int:
+        """
+        Loads the snapshot and replays the journal into an empty exchange. Opens the journal for appending.
+        :return: number of replayed commands
+        """
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                self._load_snapshot(exchange_obj, f)
+        replayed = 0
+        end = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            for (end, seq, command) in read_records(data):
+                if seq <= self.seq:  # already included in the snapshot
+                    continue
+                self.seq = seq
+                if command[0] == "open":
+                    exchange_obj.open_order_events(*command[1:])
+                    clientid = command[2]
+                elif command[0] == "cancelAll":
+                    exchange_obj.cancel_all_events(*command[1:])
+                    clientid = command[1]
+                elif command[0] == "modify":
+                    exchange_obj.modify_order_events(*command[1:])
+                    clientid = command[1]
+                else:
+                    exchange_obj.cancel_order_events(*command[1:])
+                    clientid = command[1]
+                exchange_obj.next_clientid = max(exchange_obj.next_clientid, clientid + 1)
+                replayed += 1
+        self._file = open(self.path, "ab")
+        self._file.truncate(end)  # drop a torn block
+        return replayed
+
+    def append(self, command: tuple) -> None:
+        """
+        Adds an accepted command to the journal. It is written to the file by the next commit.
+        """
+        self._commands.append(command)
+
+    def commit(self) -> None:
+        """
+        Writes all appended commands to the file at once.
+        """
+        if not self._commands:
+            return
+        payload = pickle.dumps(self._commands, PICKLE_PROTOCOL)
+        self._file.write(HEADER.pack(len(payload), zlib.crc32(payload), self.seq + 1) + payload)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.seq += len(self._commands)
+        self.stats["commands"] += len(self._commands)
+        self._commands = []
+        self.stats["commits"] += 1
+
+    def snapshot_due(self) -> bool:
+        """
+        :return: True if snapshot_interval commands were committed since the last snapshot
+        """
+        return self.snapshot_interval > 0 and self.seq - self._snapshot_seq >= self.snapshot_interval
+
+    def snapshot(self, exchange_obj) -> None:
+        """
+        Commits the journal, stores the state of the exchange and truncates the journal.
+        """
+        self.commit()
+        state = {
+            "seq": self.seq,
+            "next_clientid": exchange_obj.next_clientid,
+            "stats": exchange_obj.stats,
+            "symbols": list(exchange_obj.books),
+        }
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(state, f, PICKLE_PROTOCOL)
+            for book_obj in exchange_obj.books.values():
+                book_obj.dump(f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        # Commands up to self.seq are skipped by recover, so a crash before the truncation does no harm.
+        self._file.truncate(0)
+        self._snapshot_seq = self.seq
+        self.stats["snapshots"] += 1
+
+    def close(self) -> None:
+        """
+        Commits and closes the journal.
+        """
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
+
+    def _load_snapshot(self, exchange_obj, file) -> None:
+        state = pickle.load(file)
+        self.seq = self._snapshot_seq = state["seq"]
+        exchange_obj.next_clientid = state["next_clientid"]
+        exchange_obj.stats = state["stats"]
+        exchange_obj.books = {symbol: exchange_obj.book_class.load(file) for symbol in state["symbols"]}
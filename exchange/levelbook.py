@@ -0,0 +1,308 @@
+import bisect
+from collections import deque
+from typing import BinaryIO, List, Optional, Tuple
+
+from exchange import snapshot
+from exchange.order import Order, Fill, ORDER_TYPES
+
+
+class PriceLevel:
+    """
+    All orders resting on one side of the book at one price, in FIFO order, with their aggregated quantity.
+    """
+    __slots__ = ("price", "orders", "qty", "cancelled")
+
+    def __init__(self, price: int):
+        self.price = price
+        self.orders = deque()
+        self.qty = 0
+        self.cancelled = 0  # number of cancelled orders still queued in self.orders
+
+    def __repr__(self) -> str:
+        return "%d@%s" % (self.qty, self.price)
+
+
+class LevelBook:
+    """
+    Limit order book organised as a sorted ladder of price levels.
+    It has the same interface as book.Book, but orders are never compared with each other: price priority comes from
+    the ladder of levels and time priority from the FIFO queue of each level.
+    """
+    def __init__(self):
+        self._levels = {"BUY": {}, "SELL": {}}  # side -> {price -> PriceLevel}
+        # Sorted level keys of each side with the best level at the end. Keys are prices for bids and negated
+        # prices for asks, so both sides can be kept in ascending order.
+        self._keys = {"BUY": [], "SELL": []}
+        self._best = {"BUY": None, "SELL": None}  # cached best PriceLevel of each side
+        self._count = {"BUY": 0, "SELL": 0}
+        self._orders_by_client = {}  # clientid -> {orderid -> Order}
+
+    def _opposite(self, side: str):
+        if side == "BUY":
+            return "SELL"
+        if side == "SELL":
+            return "BUY"
+
+    def _key(self, side: str, price: int):
+        return price if side == "BUY" else -price
+
+    def _to_price(self, side: str, key):
+        return key if side == "BUY" else -key
+
+    def get_best(self, side: str) -> Optional[PriceLevel]:
+        """
+        :param side: Order side, "BUY" or "SELL".
+        :return: the best price level of the specified side or None if the side is empty.
+        """
+        return self._best[side]
+
+    def open_order(self, order: Order, order_type: str = "LIMIT"):
+        """
+        :param order: Order object, its price is ignored for MARKET orders
+        :param order_type: one of order.ORDER_TYPES, only the remainder of a LIMIT order rests in the book
+        :return: the opened order and a list of Fill records of the matched resting orders. The qty of the order is
+        its unfilled remainder, which was cancelled unless the order is a LIMIT one.
+        Raises ValueError if the client has an open order with the same id.
+        """
+        assert order.side in ["BUY", "SELL"], "Side has to be BUY or SELL"
+        assert order_type in ORDER_TYPES, "Unknown order type"
+        if order.id in self._orders_by_client.get(order.clientid, ()):
+            raise ValueError("Order with specified id is already open")
+        if order_type == "FOK" and self._available_qty(order) < order.qty:
+            return order, []
+        filled = self._try_match_order(order, order_type == "MARKET")
+        if order.qty > 0 and order_type == "LIMIT":
+            self._insert_order(order)
+        return order, filled
+
+    def remove_order(self, clientid: str, orderid: str) -> Order:
+        """
+        :param clientid Client id. (Has to be specified to resolve orderid conflicts between clients.)
+        :param orderid: Order_id assigned by client during opening.
+        :return: The removed order.
+        """
+        try:
+            orders = self._orders_by_client[clientid]
+            order = orders.pop(orderid)
+        except KeyError:
+            raise KeyError("Order with specified id does not exit")
+        if not orders:
+            del self._orders_by_client[clientid]
+        order.cancelled = True
+        self._count[order.side] -= 1
+        level = self._levels[order.side][order.price]
+        level.qty -= order.qty
+        level.cancelled += 1
+        if level.qty == 0:
+            self._remove_level(order.side, level)
+        else:
+            self._clean_level(level)
+        return order
+
+    def get_order(self, clientid: str, orderid: str) -> Order:
+        """
+        :param clientid Client id.
+        :param orderid: Order_id assigned by client during opening.
+        :return: The resting order, raises KeyError if there is none.
+        """
+        try:
+            return self._orders_by_client[clientid][orderid]
+        except KeyError:
+            raise KeyError("Order with specified id does not exit")
+
+    def modify_order(self, clientid: str, orderid: str, price: int = None, qty: int = None):
+        """
+        Changes price and/or remaining qty of a resting order. Reducing the qty at the same price updates the order in
+        place, so it keeps its time priority. Any other change re-queues the order at once: it is removed and opened
+        again as a new order with the same id, which is matched first if its new price crosses the book.
+        :param price: new price, None keeps the current one
+        :param qty: new remaining qty, None keeps the current one
+        :return: the order in the book, a new Order object if it was re-queued, and a list of Fill records of the
+        matched resting orders, see open_order
+        """
+        order = self.get_order(clientid, orderid)
+        price = order.price if price is None else price
+        qty = order.qty if qty is None else qty
+        assert qty > 0, "Quantity has to be positive"
+        if price == order.price and qty <= order.qty:
+            level = self._levels[order.side][price]
+            level.qty += qty - order.qty
+            order.qty = qty
+            return order, []
+        self.remove_order(clientid, orderid)
+        return self.open_order(Order(orderid, clientid, order.side, price, qty))
+
+    def remove_client_orders(self, clientid: str, side: str = None, min_price: int = None,
+                             max_price: int = None) -> List[Order]:
+        """
+        Removes all resting orders of a client, optionally only those of one side or within a price range. It takes
+        time proportional to the number of orders of the client, not of the book.
+        :param clientid: Client id.
+        :param side: Order side, "BUY" or "SELL", None for both sides.
+        :param min_price: lowest price of removed orders, None for no limit.
+        :param max_price: highest price of removed orders, None for no limit.
+        :return: list of the removed orders in the order in which they were opened.
+        """
+        orders = self._orders_by_client.get(clientid)
+        if not orders:
+            return []
+        removed = [order for order in orders.values() if (side is None or order.side == side) and
+                   (min_price is None or order.price >= min_price) and (max_price is None or order.price <= max_price)]
+        for order in removed:
+            self.remove_order(clientid, order.id)
+        return removed
+
+    def get_price_qty(self, side: str, price: int) -> int:
+        """
+        :param side: Order side, "BUY" or "SELL".
+        :param price: Price too look-up.
+        :return: qty left on the specified side of order book.
+        """
+        level = self._levels[side].get(price)
+        return level.qty if level is not None else 0
+
+    def get_depth(self, side: str, depth: int) -> List[Tuple[int, int]]:
+        """
+        :param side: Order side, "BUY" or "SELL".
+        :param depth: Maximal number of price levels.
+        :return: list of (price, qty) of the best price levels of the specified side, best first.
+        """
+        levels = self._levels[side]
+        keys = self._keys[side]
+        return [(level.price, level.qty) for level in
+                (levels[self._to_price(side, key)] for key in reversed(keys[-depth:] if depth else []))]
+
+    def dump(self, file: BinaryIO) -> None:
+        """
+        Writes live orders of both sides in priority order to a binary file, see the snapshot module.
+        """
+        sides = {}
+        for side in snapshot.SIDES:
+            levels = self._levels[side]
+            sides[side] = [order for key in reversed(self._keys[side])
+                           for order in levels[self._to_price(side, key)].orders if not order.cancelled]
+        snapshot.write_book(file, sides)
+
+    @classmethod
+    def load(cls, file: BinaryIO) -> "LevelBook":
+        """
+        Creates a book from a snapshot written by dump without matching the orders again.
+        """
+        book = cls()
+        for (side, (levels, orders)) in snapshot.read_book(file).items():
+            position = 0
+            for (price, qty, count) in levels:
+                level = book._levels[side][price] = PriceLevel(price)
+                level.orders.extend(orders[position:position + count])
+                level.qty = qty
+                position += count
+            book._keys[side] = [book._key(side, price) for (price, qty, count) in reversed(levels)]
+            book._best[side] = book._levels[side][levels[0][0]] if levels else None
+            book._count[side] = len(orders)
+            for order in orders:
+                client_orders = book._orders_by_client.setdefault(order.clientid, {})
+                if order.id in client_orders:
+                    raise ValueError("Snapshot contains order %s of client %s twice" % (order.id, order.clientid))
+                client_orders[order.id] = order
+        return book
+
+    def get_order_count(self, side: str) -> int:
+        """
+        :param side: Order side, "BUY" or "SELL".
+        :return: number of orders resting on the specified side of order book.
+        """
+        return self._count[side]
+
+    def _insert_order(self, order: Order) -> None:
+        side = order.side
+        level = self._levels[side].get(order.price)
+        if level is None:
+            level = PriceLevel(order.price)
+            self._levels[side][order.price] = level
+            keys = self._keys[side]
+            key = self._key(side, order.price)
+            if not keys or key > keys[-1]:
+                keys.append(key)
+                self._best[side] = level
+            else:
+                bisect.insort(keys, key)
+        level.orders.append(order)
+        level.qty += order.qty
+        self._count[side] += 1
+        self._orders_by_client.setdefault(order.clientid, {})[order.id] = order
+
+    def _remove_level(self, side: str, level: PriceLevel) -> None:
+        del self._levels[side][level.price]
+        keys = self._keys[side]
+        if level is self._best[side]:
+            keys.pop()
+            self._best[side] = self._levels[side][self._to_price(side, keys[-1])] if keys else None
+        else:
+            del keys[bisect.bisect_left(keys, self._key(side, level.price))]
+
+    def _clean_level(self, level: PriceLevel) -> None:
+        """
+        Drops cancelled orders from the head of the level queue. The queue is rebuilt when cancelled orders outnumber
+        live ones.
+        """
+        orders = level.orders
+        while orders and orders[0].cancelled:
+            orders.popleft()
+            level.cancelled -= 1
+        if level.cancelled > 16 and 2 * level.cancelled > len(orders):
+            level.orders = deque(order for order in orders if not order.cancelled)
+            level.cancelled = 0
+
+    def _unindex_order(self, order: Order) -> None:
+        orders = self._orders_by_client.get(order.clientid)
+        if orders is not None and orders.get(order.id) is order:
+            del orders[order.id]
+            if not orders:
+                del self._orders_by_client[order.clientid]
+
+    def _try_match_order(self, opened_order: Order, market: bool = False) -> List[Fill]:
+        filled = []
+        side = self._opposite(opened_order.side)
+        while opened_order.qty > 0:
+            level = self._best[side]
+            if level is None or not (market or self._matches(opened_order, level.price)):
+                break
+            resting = level.orders[0]
+
+            # It's a match
+            qty = min(opened_order.qty, resting.qty)
+            price = opened_order.price if opened_order.side == "BUY" and not market else level.price
+            opened_order.qty -= qty
+            filled.append(Fill(resting.id, resting.clientid, resting.side, resting.price, qty, price))
+            resting.qty -= qty
+            level.qty -= qty
+
+            if resting.qty == 0:
+                level.orders.popleft()
+                self._count[side] -= 1
+                self._unindex_order(resting)
+                if level.qty == 0:
+                    self._remove_level(side, level)
+                else:
+                    self._clean_level(level)
+        return filled
+
+    def _available_qty(self, order: Order) -> int:
+        """
+        :return: qty resting at prices matching the order, counted only until it reaches the qty of the order
+        """
+        side = self._opposite(order.side)
+        levels = self._levels[side]
+        available = 0
+        for key in reversed(self._keys[side]):
+            level = levels[self._to_price(side, key)]
+            if available >= order.qty or not self._matches(order, level.price):
+                break
+            available += level.qty
+        return available
+
+    def _matches(self, order: Order, price: int) -> bool:
+        if order.side == "BUY":
+            return order.price > price
+        else:
+            return order.price < price
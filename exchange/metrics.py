@@ -0,0 +1,143 @@
+"""
+Metrics of the running exchange: counters, gauges and latency histograms, exposed in the Prometheus text format.
+
+Components record into a shared Metrics object given to their register_metrics method. Counters and histograms are
+updated on the hot path, so they are plain integers and histogram.Histogram objects updated once per batch or request.
+Gauges, e.g. the depth of the books, are functions evaluated only when the metrics are rendered. Components keep
+their metrics attribute None when metrics are disabled and then skip all measurements.
+"""
+import asyncio
+import sys
+from typing import Callable, Dict
+
+from exchange.histogram import Histogram
+
+
+class Metrics:
+    """
+    Registry of named metrics. Names should follow Prometheus conventions, i.e. lower case words joined by "_".
+    """
+    QUANTILES = (50, 90, 99, 99.9)
+
+    def __init__(self):
+        self.counters = {}  # name -> int
+        self.histograms = {}  # name -> Histogram of values in nanoseconds
+        self._functions = {}  # name -> (type, function returning the current value)
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Increments a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def histogram(self, name: str) -> Histogram:
+        """
+        :return: histogram of the given name, created when needed. Keep it and record into it directly.
+        """
+        try:
+            return self.histograms[name]
+        except KeyError:
+            histogram = self.histograms[name] = Histogram()
+            return histogram
+
+    def gauge(self, name: str, function: Callable[[], float]) -> None:
+        """
+        Registers a function returning the current value of a gauge.
+        """
+        self._functions[name] = ("gauge", function)
+
+    def counter(self, name: str, function: Callable[[], int]) -> None:
+        """
+        Registers a function returning a counter maintained elsewhere, e.g. in stats of a component.
+        """
+        self._functions[name] = ("counter", function)
+
+    def values(self) -> Dict[str, float]:
+        """
+        :return: dict mapping names of counters and gauges to their current values
+        """
+        values = dict(self.counters)
+        for (name, (type_, function)) in self._functions.items():
+            values[name] = function()
+        return values
+
+    def render(self) -> str:
+        """
+        :return: all metrics in the Prometheus text exposition format, histograms are rendered as summaries
+        """
+        lines = []
+        types = {name: "counter" for name in self.counters}
+        types.update({name: type_ for (name, (type_, function)) in self._functions.items()})
+        for (name, value) in sorted(self.values().items()):
+            lines.append("# TYPE %s %s" % (name, types[name]))
+            lines.append("%s %s" % (name, value))
+        for (name, histogram) in sorted(self.histograms.items()):
+            lines.append("# TYPE %s summary" % name)
+            for quantile in self.QUANTILES:
+                lines.append('%s{quantile="%s"} %d' % (name, quantile / 100, histogram.percentile(quantile)))
+            lines.append("%s_sum %d" % (name, histogram.total))
+            lines.append("%s_count %d" % (name, histogram.count))
+            lines.append("%s_max %d" % (name, histogram.max))
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsConnection(asyncio.Protocol):
+    """
+    HTTP connection, which answers a single GET request with the rendered metrics.
+    """
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.transport = None
+        self._data = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self._data += data
+        if b"\r\n\r\n" not in self._data and b"\n\n" not in self._data:
+            return
+        request = self._data.split(b"\n", 1)[0].split()
+        if len(request) >= 2 and request[0] == b"GET" and request[1] in (b"/", b"/metrics"):
+            (status, body) = ("200 OK", self.metrics.render().encode())
+        else:
+            (status, body) = ("404 Not Found", b"Not found\n")
+        self.transport.write(("HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n"
+                              "Connection: close\r\n\r\n" % (status, len(body))).encode() + body)
+        self.transport.close()
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint serving the metrics on GET / and GET /metrics.
+    """
+    def __init__(self, host: str, port: int, metrics: Metrics):
+        self.server = None
+        self.host = host
+        self.port = port
+        self.metrics = metrics
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Start listening on specified address and port. Port 0 picks a free port, which is then stored in port."""
+        self.server = loop.run_until_complete(
+            loop.create_server(lambda: _MetricsConnection(self.metrics), self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def stop(self, loop: asyncio.AbstractEventLoop):
+        """Stop listening."""
+        if self.server is not None:
+            self.server.close()
+            loop.run_until_complete(self.server.wait_closed())
+            self.server = None
+
+
+def print_metrics(metrics: Metrics, file=sys.stdout) -> None:
+    """
+    Prints counters, gauges and latency percentiles in a human readable form.
+    """
+    for (name, value) in sorted(metrics.values().items()):
+        print("%s: %s" % (name, value), file=file)
+    for (name, histogram) in sorted(metrics.histograms.items()):
+        print("%s: count %d, mean %.0f, %s, max %d" % (
+            name, histogram.count, histogram.mean(),
+            ", ".join("p%s %d" % (q, histogram.percentile(q)) for q in Metrics.QUANTILES), histogram.max), file=file)
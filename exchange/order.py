@@ -1,25 +1,49 @@
-from datetime import datetime
-from decimal import Decimal
+from collections import namedtuple
+import itertools
+
+
+_sequence = itertools.count()
+
+
+def reserve_sequence(seq: int) -> None:
+    """
+    Makes orders created from now on get higher sequence numbers, i.e. lower priority, than seq.
+    """
+    global _sequence
+    _sequence = itertools.count(max(seq + 1, next(_sequence)))
+
+# Types of orders. A LIMIT order rests in the book until it is filled or cancelled. The others never rest in the book,
+# their unfilled remainder is cancelled: IOC (immediate or cancel) is matched up to its limit price, FOK (fill or kill)
+# only if it can be filled completely and MARKET at any price.
+ORDER_TYPES = ("LIMIT", "IOC", "FOK", "MARKET")
+
+# Report about a filled (part of) resting order. Price is the limit price of the order, price_traded the price of the
+# trade and qty the traded quantity.
+Fill = namedtuple("Fill", ["id", "clientid", "side", "price", "qty", "price_traded"])
 
 
 class Order:
     """
-    Buy/sell order with defined "<" operator.
+    Buy/sell order with defined "<" operator. Price is an integer number of ticks.
+    Orders arriving earlier get lower sequence numbers, which gives them time priority. The sequence number is given
+    only to orders restored from a snapshot.
     """
-    def __init__(self, id: str, clientid: int, side: str, price: Decimal, qty: int):
+    __slots__ = ("id", "clientid", "side", "price", "qty", "seq", "cancelled")
+
+    def __init__(self, id: str, clientid: int, side: str, price: int, qty: int, seq: int = None):
         assert side in ["BUY", "SELL"], "Side has to be BUY or SELL"
         assert qty > 0, "Quantity has to be positive"
         self.id = id
         self.clientid = clientid
         self.side = side
         self.price = price
-        self.price_traded = None
         self.qty = qty
-        self.time = datetime.now()
+        self.seq = next(_sequence) if seq is None else seq
+        self.cancelled = False
 
     def __lt__(self, other) -> bool:
         if self.price == other.price:
-            return self.time < other.time
+            return self.seq < other.seq
         if self.side == "BUY":
             return self.price > other.price
         else:
@@ -27,4 +51,3 @@ class Order:
 
     def __repr__(self) -> str:
         return "%s: %d@%f" % (self.side, self.qty, self.price)
-    
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""
+Opt-in profiling of the running server, which can be started and stopped at runtime.
+
+While running, the profiler
+- samples the Python stack every interval seconds of CPU time (SIGPROF timer) and counts the samples per stack, which
+  is dumped in the folded format understood by flamegraph.pl, speedscope and similar tools,
+- times every callback run by the event loop and reports callbacks slower than slow_callback seconds,
+- keeps the timings of stages of the last trace_size requests processed by servers, which have it set as profiler.
+
+Sampling uses signals, so the profiler works only in the main thread on Unix. Timing of callbacks wraps
+asyncio.Handle._run, i.e. it needs the event loop of the standard library.
+"""
+import asyncio
+import collections
+import csv
+import os
+import signal
+import sys
+import time
+
+
+class Profiler:
+    def __init__(self, interval: float = 0.001, slow_callback: float = 0.01, trace_size: int = 100000):
+        """
+        :param interval: seconds of CPU time between stack samples
+        :param slow_callback: callbacks running at least this many seconds are reported
+        :param trace_size: number of requests, whose stage timings are kept
+        """
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.running = False
+        self.stacks = collections.Counter()  # folded stack -> number of samples
+        self.slow_callbacks = collections.deque(maxlen=1000)  # (time, duration in seconds, description)
+        # (time, clientid, orderid, requests in batch, parse, match and send durations in seconds)
+        self.trace = collections.deque(maxlen=trace_size)
+        self._handle_run = None  # original asyncio.Handle._run
+
+    def start(self) -> None:
+        """
+        Starts sampling and timing. Collected data are kept from previous runs.
+        """
+        if self.running:
+            return
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._handle_run = handle_run = asyncio.Handle._run
+        profiler = self
+
+        def _run(handle):
+            start = time.perf_counter()
+            handle_run(handle)
+            duration = time.perf_counter() - start
+            if duration >= profiler.slow_callback:
+                profiler._slow(handle, duration)
+
+        asyncio.Handle._run = _run
+        self.running = True
+
+    def stop(self) -> None:
+        """
+        Stops sampling and timing.
+        """
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        asyncio.Handle._run = self._handle_run
+        self.running = False
+
+    def toggle(self) -> None:
+        """
+        Starts a stopped profiler or stops a running one.
+        """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        print("Profiling %s." % ("started" if self.running else "stopped"), file=sys.stderr)
+
+    def reset(self) -> None:
+        """
+        Forgets all collected data.
+        """
+        self.stacks.clear()
+        self.slow_callbacks.clear()
+        self.trace.clear()
+
+    def trace_batch(self, clientid: int, requests: list, parse: float, matches: list, send: float) -> None:
+        """
+        Records stage timings of a batch of requests processed by a server.
+        :param requests: JSON requests (dicts), binary requests (tuples) or exceptions raised by their parsing
+        :param parse: seconds spent parsing the received data containing the batch
+        :param matches: seconds spent executing every request
+        :param send: seconds spent publishing the events of the batch and writing the reports
+        """
+        now = time.time()
+        for (request, match) in zip(requests, matches):
+            if isinstance(request, dict):
+                orderid = request.get("orderId")
+            elif isinstance(request, tuple):
+                orderid = request[1]
+            else:
+                orderid = None
+            self.trace.append((now, clientid, orderid, len(requests), parse, match, send))
+
+    def dump(self, prefix: str) -> None:
+        """
+        Writes the stack samples to prefix + ".folded" and the stage timings to prefix + ".stages.csv".
+        """
+        with open(prefix + ".folded", "w") as file:
+            for (stack, count) in sorted(self.stacks.items()):
+                file.write("%s %d\n" % (stack, count))
+        with open(prefix + ".stages.csv", "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["time", "clientid", "orderid", "batch", "parse_us", "match_us", "send_us"])
+            for (time_, clientid, orderid, batch, parse, match, send) in list(self.trace):
+                writer.writerow([repr(time_), clientid, orderid, batch, "%.3f" % (parse * 1e6), "%.3f" % (match * 1e6),
+                                 "%.3f" % (send * 1e6)])
+        print("Profile with %d samples and %d requests written to %s.folded and %s.stages.csv." % (
+            sum(self.stacks.values()), len(self.trace), prefix, prefix), file=sys.stderr)
+
+    def _sample(self, signum, frame) -> None:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def _slow(self, handle, duration: float) -> None:
+        description = repr(handle)
+        self.slow_callbacks.append((time.time(), duration, description))
+        print("Slow callback took %.3f ms: %s" % (duration * 1000, description), file=sys.stderr)
@@ -0,0 +1,256 @@
+"""
+Offline replay of recorded order flow into an Exchange or a single order book, without any networking.
+
+Records are (time, command) tuples, where time is a UNIX timestamp of the command and command is
+("open", orderid, clientid, side, price, qty, symbol) or ("cancel", clientid, orderid, symbol) with price in ticks,
+i.e. the same command tuples as stored by the journal.
+
+Two file formats are supported:
+- CSV with the header "time,action,orderid,clientid,side,price,quantity,symbol", where action is "open" or "cancel",
+  price is a decimal number converted to ticks of the symbol's instrument and side, price and quantity are empty for
+  cancels,
+- binary, where every record is RECORD (time and client id) followed by a frame of the binary order protocol, see the
+  binary module.
+Both are read lazily in chunks of records.
+"""
+import csv
+import struct
+import time
+from typing import BinaryIO, Dict, Iterable, Iterator, List, TextIO, Tuple
+
+from exchange import binary
+from exchange.histogram import Histogram
+from exchange.instrument import Instrument
+from exchange.order import Order
+
+# time, clientid
+RECORD = struct.Struct("<dQ")
+CSV_FIELDS = ["time", "action", "orderid", "clientid", "side", "price", "quantity", "symbol"]
+
+
+def read_csv(file: TextIO, instruments: Dict[str, Instrument], chunk_size: int = 10000) -> Iterator[List[Tuple]]:
+    """
+    :param file: text file with records in CSV format
+    :param instruments: symbol -> Instrument used to convert prices to ticks
+    :param chunk_size: number of records in a chunk
+    :return: generator of lists of records
+    """
+    reader = csv.reader(file)
+    columns = {name: n for (n, name) in enumerate(next(reader))}
+    missing = set(CSV_FIELDS) - set(columns)
+    if missing:
+        raise ValueError("Missing CSV columns: %s" % ", ".join(sorted(missing)))
+    (time_, action, orderid, clientid, side, price, qty, symbol) = [columns[name] for name in CSV_FIELDS]
+    chunk = []
+    for row in reader:
+        if row[action] == "open":
+            command = ("open", row[orderid], int(row[clientid]), row[side],
+                       instruments[row[symbol]].to_ticks(row[price]), int(row[qty]), row[symbol])
+        elif row[action] == "cancel":
+            command = ("cancel", int(row[clientid]), row[orderid], row[symbol])
+        else:
+            raise ValueError("Unknown action %s" % row[action])
+        chunk.append((float(row[time_]), command))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_csv(file: TextIO, records: Iterable[Tuple], instruments: Dict[str, Instrument]) -> None:
+    """
+    :param file: text file opened with newline=""
+    :param records: (time, command) tuples
+    :param instruments: symbol -> Instrument used to convert ticks to prices
+    """
+    writer = csv.writer(file)
+    writer.writerow(CSV_FIELDS)
+    for (time_, command) in records:
+        if command[0] == "open":
+            (_, orderid, clientid, side, price, qty, symbol) = command
+            writer.writerow([repr(time_), "open", orderid, clientid, side, instruments[symbol].to_price(price), qty,
+                             symbol])
+        else:
+            (_, clientid, orderid, symbol) = command
+            writer.writerow([repr(time_), "cancel", orderid, clientid, "", "", "", symbol])
+
+
+def read_binary(file: BinaryIO, chunk_size: int = 10000, read_size: int = 1 << 20) -> Iterator[List[Tuple]]:
+    """
+    :param file: binary file with records in binary format
+    :param chunk_size: maximal number of records in a chunk
+    :param read_size: number of bytes read from the file at once
+    :return: generator of lists of records
+    """
+    data = bytearray()
+    while True:
+        block = file.read(read_size)
+        if not block:
+            break
+        data += block
+        chunk = []
+        position = 0
+        header = RECORD.size + binary.HEADER.size
+        while len(data) - position >= header:
+            (time_, clientid) = RECORD.unpack_from(data, position)
+            (length,) = binary.HEADER.unpack_from(data, position + RECORD.size)
+            end = position + header + length
+            if end > len(data):
+                break
+            request = binary.unpack_request(bytes(data[position + header:end]))
+            if request[0] == "createOrder":
+                (_, orderid, side, price, qty, symbol) = request
+                chunk.append((time_, ("open", orderid, clientid, side, price, qty, symbol)))
+            elif request[0] == "cancelOrder":
+                (_, orderid, symbol) = request
+                chunk.append((time_, ("cancel", clientid, orderid, symbol)))
+            else:
+                raise ValueError("Message %s can not be replayed" % request[0])
+            position = end
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        del data[:position]
+        if chunk:
+            yield chunk
+    if data:
+        raise ValueError("Truncated record at the end of the file")
+
+
+def write_binary(file: BinaryIO, records: Iterable[Tuple]) -> None:
+    """
+    :param file: binary file
+    :param records: (time, command) tuples, order ids have to be integers
+    """
+    for (time_, command) in records:
+        if command[0] == "open":
+            (_, orderid, clientid, side, price, qty, symbol) = command
+            frame = binary.pack_create_order(orderid, side, price, qty, symbol)
+        else:
+            (_, clientid, orderid, symbol) = command
+            frame = binary.pack_cancel_order(orderid, symbol)
+        file.write(RECORD.pack(time_, clientid) + frame)
+
+
+def read_records(path: str, instruments: Dict[str, Instrument], chunk_size: int = 10000) -> Iterator[List[Tuple]]:
+    """
+    Reads a file in CSV format if its name ends with ".csv", in binary format otherwise.
+    :return: generator of lists of records
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="") as file:
+            yield from read_csv(file, instruments, chunk_size)
+    else:
+        with open(path, "rb") as file:
+            yield from read_binary(file, chunk_size)
+
+
+class ReplayStats:
+    """
+    Results of a replay. Latencies are in nanoseconds, throughput contains the number of commands processed during
+    every second of the replay.
+    """
+
+    def __init__(self):
+        self.opened = 0
+        self.cancelled = 0
+        self.rejected = 0  # commands, which raised an exception, e.g. cancels of already filled orders
+        self.fills = 0  # filled resting orders
+        self.elapsed = 0.0
+        self.latency = Histogram()
+        self.throughput = []
+
+    def commands(self) -> int:
+        return self.opened + self.cancelled + self.rejected
+
+    def report(self) -> str:
+        """
+        :return: human readable summary with histograms of latency and throughput
+        """
+        lines = ["Replayed %d commands (%d opens, %d cancels, %d rejected, %d fills) in %.3f s: %.0f commands/s" % (
+            self.commands(), self.opened, self.cancelled, self.rejected, self.fills, self.elapsed,
+            self.commands() / self.elapsed if self.elapsed else 0)]
+        lines.append("Latency: mean %.2f us, p50 %.2f us, p99 %.2f us, p99.9 %.2f us, max %.2f us" % (
+            self.latency.mean() / 1000, self.latency.percentile(50) / 1000, self.latency.percentile(99) / 1000,
+            self.latency.percentile(99.9) / 1000, self.latency.max / 1000))
+        lines += _bars([("<= %9.2f us" % (upper / 1000), count) for (lower, upper, count) in _powers_of_two(
+            self.latency)])
+        if self.throughput:
+            lines.append("Throughput: min %d, mean %.0f, max %d commands/s" % (
+                min(self.throughput), sum(self.throughput) / len(self.throughput), max(self.throughput)))
+            histogram = Histogram()
+            for value in self.throughput:
+                histogram.record(value)
+            lines += _bars([("<= %9d /s" % upper, count) for (lower, upper, count) in _powers_of_two(histogram)])
+        return "\n".join(lines)
+
+
+def _powers_of_two(histogram: Histogram) -> List[Tuple[int, int, int]]:
+    # Joins the fine buckets of a histogram into buckets ending at powers of two, which are easier to read.
+    rows = []
+    for (lower, upper, count) in histogram.buckets():
+        top = (1 << upper.bit_length()) - 1
+        if rows and rows[-1][1] == top:
+            rows[-1][2] += count
+        else:
+            rows.append([lower, top, count])
+    return rows
+
+
+def _bars(rows: List[Tuple[str, int]], width: int = 50) -> List[str]:
+    most = max([count for (label, count) in rows], default=0)
+    return ["  %s %10d %s" % (label, count, "#" * (count * width // most)) for (label, count) in rows]
+
+
+def replay(chunks: Iterable[List[Tuple]], target, speed: float = 0) -> ReplayStats:
+    """
+    Feeds records into an exchange.Exchange (through its synchronous API, without publishing any events) or into
+    an order book.
+    :param chunks: lists of records, e.g. from read_records
+    :param target: Exchange, Book or LevelBook
+    :param speed: multiplier of the recorded pace, 0 replays as fast as possible
+    :return: statistics of the replay
+    """
+    stats = ReplayStats()
+    use_exchange = hasattr(target, "open_order_events")
+    latency = stats.latency
+    clock = time.perf_counter
+    start = clock()
+    second = start + 1
+    processed = 0  # commands before the current second
+    first_time = None
+    for chunk in chunks:
+        if speed and chunk and first_time is None:
+            first_time = chunk[0][0]
+        for (time_, command) in chunk:
+            if speed:
+                delay = (time_ - first_time) / speed - (clock() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            begin = clock()
+            try:
+                if command[0] == "open":
+                    if use_exchange:
+                        events = target.open_order_events(*command[1:])
+                        # the first fill event belongs to the opened order, the others to the resting orders
+                        stats.fills += max(sum(1 for event in events if event[0] == "fill") - 1, 0)
+                    else:
+                        stats.fills += len(target.open_order(Order(*command[1:6]))[1])
+                    stats.opened += 1
+                else:
+                    if use_exchange:
+                        target.cancel_order_events(*command[1:])
+                    else:
+                        target.remove_order(command[1], command[2])
+                    stats.cancelled += 1
+            except Exception:
+                stats.rejected += 1
+            end = clock()
+            latency.record((end - begin) * 1e9)
+            if end >= second:
+                stats.throughput.append(stats.commands() - processed)
+                processed = stats.commands()
+                second = end + 1
+    stats.elapsed = clock() - start
+    return stats
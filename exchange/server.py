@@ -1,11 +1,8 @@
 import asyncio
-import asyncio.streams
-import datetime
-import abc
+import heapq
 import sys
-from decimal import Decimal
+import time
 import traceback
-from concurrent.futures._base import CancelledError
 
 # Use faster json module when available
 try:
@@ -13,13 +10,41 @@ try:
 except ImportError:
     import json
 
-from exchange import exchange
+# Use faster event loop when available
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from exchange import exchange, binary
 
+LOOPS = ["auto", "asyncio", "uvloop"]
 
-class GenericServer(metaclass=abc.ABCMeta):
+
+def new_event_loop(implementation: str = "auto") -> asyncio.AbstractEventLoop:
+    """
+    Creates an event loop. Set it as the current one by asyncio.set_event_loop before starting servers in it.
+    :param implementation: "asyncio" for the loop of the standard library, "uvloop" or "auto" for uvloop when installed
+    and asyncio otherwise
+    """
+    if implementation == "uvloop" or (implementation == "auto" and uvloop is not None):
+        if uvloop is None:
+            raise ImportError("uvloop is not installed")
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+class GenericServer:
     """
     TCP server base class.
+
+    Outgoing messages are encoded into a per-connection buffer, which is written to the transport once per event loop
+    iteration or as soon as it exceeds flush_threshold bytes. Transports of clients get high_water_mark as the limit of
+    their write buffer.
     """
+    flush_threshold = 64 * 1024
+    high_water_mark = 256 * 1024
+    metrics_prefix = "server"
 
     def __init__(self, host: str, port: int, exchange_obj: exchange.Exchange):
         self.server = None
@@ -27,7 +52,10 @@ class GenericServer(metaclass=abc.ABCMeta):
         self.port = port
         self.next_clientid = 0
         self.exchange = exchange_obj
-        self.clients = {}  # task -> (reader, writer)
+        self.clients = {}  # clientid -> (reader, writer)
+        self.metrics = None  # metrics.Metrics, see register_metrics
+        self._buffers = {}  # writer -> bytearray of messages waiting for flush
+        self._tasks = set()  # tasks handling clients
 
     def _client_done(self, task):
         try:
@@ -38,133 +66,764 @@ class GenericServer(metaclass=abc.ABCMeta):
 
     def _accept_client(self, client_reader, client_writer):
         clientid = self.exchange.get_clientid()
-        task = asyncio.Task(self._handle_client(clientid, client_reader, client_writer))
+        client_writer.transport.set_write_buffer_limits(high=self.high_water_mark)
+        task = asyncio.ensure_future(self._handle_client(clientid, client_reader, client_writer))
         self.clients[clientid] = (client_reader, client_writer)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
         task.add_done_callback(self._client_done)
+        self._client_connected(clientid, client_writer)
+
+    def _client_connected(self, clientid, client_writer) -> None:
+        """Called when a client connects, after it was added to clients."""
+        pass
 
-    @abc.abstractmethod
     async def _handle_client(self, clientid, client_reader, client_writer):
         raise NotImplementedError("This is a method of abstract class")
 
     async def _send_json(self, writer, json_str):
-        if writer.transport._conn_lost:  # Workaround of https://github.com/aaugustin/websockets/issues/84
+        if writer.transport.is_closing():
             raise ConnectionResetError()
+        self._buffer_json(writer, json_str)
+
+    def _buffer_json(self, writer, json_str) -> None:
+        self._buffer(writer, json.dumps(json_str).encode() + b"\n")
+
+    def _buffer(self, writer, data: bytes) -> None:
+        buffer = self._buffers.get(writer)
+        if buffer is None:
+            if not self._buffers:
+                asyncio.get_event_loop().call_soon(self._flush)
+            buffer = self._buffers[writer] = bytearray()
+        buffer += data
+        if len(buffer) >= self.flush_threshold:
+            self._write(writer, self._buffers.pop(writer))
+
+    def _write(self, writer, data: bytes) -> None:
+        if writer.transport.is_closing():
+            return
         try:
-            writer.write(json.dumps(json_str).encode())
-            writer.write("\n".encode())
+            writer.write(data)
         except Exception as ex:
-            print("Write failed:\n%s" % ex.with_traceback(), file=sys.stderr)
+            print("Write failed:\n%s" % ex, file=sys.stderr)
+
+    def _flush(self) -> None:
+        """Writes all buffered messages to their transports."""
+        buffers = self._buffers
+        self._buffers = {}
+        for (writer, data) in buffers.items():
+            self._write(writer, data)
+
+    def register_metrics(self, metrics) -> None:
+        """
+        Starts recording metrics of the server into a metrics.Metrics object and registers gauges of its clients.
+        """
+        self.metrics = metrics
+        prefix = self.metrics_prefix
+        metrics.gauge(prefix + "_clients", lambda: len(self.clients))
+        metrics.gauge(prefix + "_buffered_bytes", lambda: sum(
+            writer.transport.get_write_buffer_size() for (reader, writer) in self.clients.values()) + sum(
+            len(data) for data in self._buffers.values()))
 
+    def _listen(self, loop: asyncio.AbstractEventLoop):
+        """:return: coroutine creating the listening server"""
+        return asyncio.start_server(self._accept_client, self.host, self.port)
 
     def start(self, loop: asyncio.AbstractEventLoop):
-        """Start listening on specified address and port."""
-        self.server = loop.run_until_complete(
-            asyncio.streams.start_server(self._accept_client,
-                                         self.host, self.port,
-                                         loop=loop))
+        """Start listening on specified address and port. Port 0 picks a free port, which is then stored in port."""
+        self.server = loop.run_until_complete(self._listen(loop))
+        self.port = self.server.sockets[0].getsockname()[1]
 
     def stop(self, loop: asyncio.AbstractEventLoop):
         """Abort all client connections and stop listening."""
         if self.server is not None:
+            self._flush()
             self.server.close()
-            for task in asyncio.Task.all_tasks():
+            for (reader, writer) in list(self.clients.values()):
+                writer.transport.close()
+            for task in list(self._tasks):
                 task.cancel()
             loop.run_until_complete(self.server.wait_closed())
             self.server = None
 
 
+class _OrderConnection(asyncio.Protocol):
+    """
+    Connection of an order channel client. It splits received data into complete requests and queues them for
+    OrderServer. It also acts as the writer of the connection for GenericServer methods.
+    """
+    def __init__(self, server: "OrderServer"):
+        self.server = server
+        self.transport = None
+        self.clientid = None
+        self.binary = None  # protocol of the connection, unknown until the first bytes arrive
+        self.requests = []  # parsed requests waiting for processing
+        self.cancel_on_disconnect = server.cancel_on_disconnect  # cancel orders of the client when it disconnects
+        self.parse_time = 0.0  # seconds spent parsing the last received data, measured only with metrics or profiler
+        self._data = bytearray()  # incomplete request
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.server.high_water_mark)
+        self.clientid = self.server.exchange.get_clientid()
+        self.server.clients[self.clientid] = (None, self)
+        print("Client %d connected." % self.clientid)
+
+    def data_received(self, data: bytes):
+        timed = self.server._timed()
+        if timed:
+            start = time.perf_counter()
+        self._data += data
+        if self.binary is None:
+            if self._data[:1] != binary.MAGIC[:1]:
+                self.binary = False
+            elif len(self._data) < len(binary.MAGIC):
+                return
+            elif self._data[:len(binary.MAGIC)] == binary.MAGIC:
+                self.binary = True
+                del self._data[:len(binary.MAGIC)]
+            else:
+                self.transport.close()
+                return
+        if self.binary:
+            self._split_frames()
+        else:
+            self._split_lines()
+        if timed:
+            self.parse_time = time.perf_counter() - start
+        if self.requests:
+            self.server._process_requests(self)
+
+    def _split_lines(self):
+        end = self._data.rfind(b"\n")
+        if end < 0:
+            return
+        lines = self._data[:end].split(b"\n")
+        del self._data[:end + 1]
+        for line in lines:
+            try:
+                self.requests.append(json.loads(line.decode("utf-8").rstrip()))
+            except Exception as ex:  # reported when the request is processed, so that responses stay in order
+                self.requests.append(ex)
+
+    def _split_frames(self):
+        data = self._data
+        position = 0
+        while len(data) - position >= binary.HEADER.size:
+            (length,) = binary.HEADER.unpack_from(data, position)
+            end = position + binary.HEADER.size + length
+            if end > len(data):
+                break
+            try:
+                self.requests.append(binary.unpack_request(bytes(data[position + binary.HEADER.size:end])))
+            except Exception as ex:  # reported when the request is processed, so that responses stay in order
+                self.requests.append(ex)
+            position = end
+        del data[:position]
+
+    def connection_lost(self, exc):
+        self.server._client_disconnected(self)
+
+    def pause_writing(self):
+        # Client does not read its reports, stop reading its requests until it catches up.
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+
 class OrderServer(GenericServer):
     """
     Server handling order requests of clients.
+    Clients send newline-delimited JSON messages, unless they start the connection with binary.MAGIC, which switches
+    the connection to the binary protocol described in the binary module.
+
+    All complete requests received in one chunk of data are processed as a batch. Events of the whole batch are
+    published at once and the reports of the client are written right away. The server has to be added as an event
+    handler of the exchange to send the reports.
+    Reading from a client is paused while its transport buffer exceeds high_water_mark.
+
+    Clients can change the price and quantity of their resting orders by a modifyOrder request, which is acknowledged by
+    a MODIFIED report. Reducing the quantity keeps the priority of the order, other changes re-queue it.
+    Clients can cancel all their orders, optionally of one symbol, side or price range, by one cancelAll request, which
+    is finished by a CANCELLED_ALL report with the number of cancelled orders in its quantity, even if it was 0. A
+    session with the cancel_on_disconnect flag, which clients set by a session request and which is initialised from
+    the attribute of the server, has all its orders cancelled when the client disconnects.
+
+    With metrics registered, the server records latencies in nanoseconds of parsing received data with complete requests
+    ("order_parse_ns"), matching a request ("order_match_ns") and publishing the events of a batch including writing
+    the reports of its client ("order_send_ns"), and counts requests, fills, cancels and errors.
     """
-    async def _handle_client(self, clientid, client_reader, client_writer):
-        print("Client %d connected." % clientid)
-        while True:
+    metrics_prefix = "order"
+    cancel_on_disconnect = False
+
+    def __init__(self, host: str, port: int, exchange_obj: exchange.Exchange):
+        super().__init__(host, port, exchange_obj)
+        self.profiler = None  # profiling.Profiler, which traces stage timings of requests while it is running
+        self._parse_latency = None
+        self._match_latency = None
+        self._send_latency = None
+
+    def register_metrics(self, metrics) -> None:
+        super().register_metrics(metrics)
+        self._parse_latency = metrics.histogram("order_parse_ns")
+        self._match_latency = metrics.histogram("order_match_ns")
+        self._send_latency = metrics.histogram("order_send_ns")
+
+    def _listen(self, loop: asyncio.AbstractEventLoop):
+        return loop.create_server(lambda: _OrderConnection(self), self.host, self.port)
+
+    def _client_disconnected(self, connection: _OrderConnection):
+        print("Client %d disconnected" % connection.clientid)
+        del self.clients[connection.clientid]
+        if connection.cancel_on_disconnect:
+            self.exchange.publish(self.exchange.cancel_all_events(connection.clientid))
+
+    def _process_requests(self, connection: _OrderConnection):
+        requests = connection.requests
+        connection.requests = []
+        events = []
+        timed = self._timed()
+        matches = []
+        for request in requests:
+            if timed:
+                start = time.perf_counter()
             try:
-                string = (await client_reader.readline()).decode("utf-8")
-                if not string:  # an empty string means the client disconnected
-                    break
-                data = json.loads(string.rstrip())
-                if data["message"] == "createOrder":
-                    await self._send_json(client_writer, {
-                        "message": "executionReport",
-                        "orderId": data["orderId"],
-                        "report": "NEW"
-                    })
-                    await self.exchange.open_order(data["orderId"], clientid, data["side"], Decimal(data["price"]),
-                                                   data["quantity"])
-                elif data["message"] == "cancelOrder":
-                    await self.exchange.cancel_order(clientid, data["orderId"])
-                    await self._send_json(client_writer, {
-                        "message": "executionReport",
-                        "orderId": data["orderId"],
-                        "report": "CANCELLED"
-                    })
+                if isinstance(request, Exception):
+                    raise request
+                if connection.binary:
+                    events += self._execute_binary_request(connection, request)
                 else:
-                    raise Exception("Unknown order type")
-            except ConnectionResetError:  # Client has disconnected
-                break
-            except CancelledError:  # Clients task has been cancelled
-                break
-            except Exception as ex:  # Another error
-                print("Exception raised for client %d:" % clientid)
+                    events += self._execute_json_request(connection, request)
+            except Exception as ex:
+                print("Exception raised for client %d:" % connection.clientid)
                 traceback.print_exc(file=sys.stderr)
-                reason = traceback.format_exception_only(type(ex), ex)[0].rstrip("\n")
-                await self._send_json(client_writer, {
-                    "message": "error",
-                    "report": "Processing your request failed",
-                    "reason": reason
-                })
-        return clientid  # return clientid as task result, so we can recognize the disconnected client in _client_done()
+                # Sent as an event, so that it does not overtake reports of preceding requests.
+                events.append(("error", connection.clientid,
+                               traceback.format_exception_only(type(ex), ex)[0].rstrip("\n")))
+            if timed:
+                matches.append(time.perf_counter() - start)
+        if timed:
+            start = time.perf_counter()
+        self.exchange.publish(events)
+        data = self._buffers.pop(connection, None)
+        if data:
+            self._write(connection, data)
+        if timed:
+            self._record_timings(connection, requests, matches, time.perf_counter() - start)
+
+    def _timed(self) -> bool:
+        return self.metrics is not None or (self.profiler is not None and self.profiler.running)
+
+    def _record_timings(self, connection: _OrderConnection, requests: list, matches: list, send: float) -> None:
+        if self.metrics is not None:
+            self.metrics.count("order_requests", len(requests))
+            self._parse_latency.record(connection.parse_time * 1e9)
+            for match in matches:
+                self._match_latency.record(match * 1e9)
+            self._send_latency.record(send * 1e9)
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.trace_batch(connection.clientid, requests, connection.parse_time, matches, send)
+
+    def _execute_json_request(self, connection: _OrderConnection, data: dict) -> list:
+        symbol = data.get("symbol", "")
+        if data["message"] == "createOrder":
+            order_type = data.get("type", "LIMIT")
+            if order_type == "MARKET":
+                price = None
+            else:
+                price = self.exchange.get_instrument(symbol).to_ticks(data["price"])
+            return self.exchange.open_order_events(data["orderId"], connection.clientid, data["side"], price,
+                                                   data["quantity"], symbol, order_type)
+        elif data["message"] == "cancelOrder":
+            return self.exchange.cancel_order_events(connection.clientid, data["orderId"], symbol)
+        elif data["message"] == "modifyOrder":
+            price = data.get("price")
+            if price is not None:
+                price = self.exchange.get_instrument(symbol).to_ticks(price)
+            return self.exchange.modify_order_events(connection.clientid, data["orderId"], price, data.get("quantity"),
+                                                     symbol)
+        elif data["message"] == "cancelAll":
+            symbol = data.get("symbol")
+            (min_price, max_price) = (data.get("minPrice"), data.get("maxPrice"))
+            if min_price is not None or max_price is not None:
+                instrument = self.exchange.get_instrument(symbol or "")
+                min_price = None if min_price is None else instrument.to_ticks(min_price)
+                max_price = None if max_price is None else instrument.to_ticks(max_price)
+            return self.exchange.cancel_all_events(connection.clientid, symbol, data.get("side"), min_price, max_price)
+        elif data["message"] == "session":
+            connection.cancel_on_disconnect = bool(data.get("cancelOnDisconnect", connection.cancel_on_disconnect))
+            return []
+        else:
+            raise Exception("Unknown order type")
+
+    def _execute_binary_request(self, connection: _OrderConnection, request: tuple) -> list:
+        if request[0] == "createOrder":
+            (_, orderid, side, price, qty, symbol) = request
+            return self.exchange.open_order_events(orderid, connection.clientid, side, price, qty, symbol)
+        elif request[0] == "cancelOrder":
+            (_, orderid, symbol) = request
+            return self.exchange.cancel_order_events(connection.clientid, orderid, symbol)
+        elif request[0] == "modifyOrder":
+            (_, orderid, price, qty, symbol) = request
+            return self.exchange.modify_order_events(connection.clientid, orderid, price, qty, symbol)
+        elif request[0] == "cancelAll":
+            (_, side, min_price, max_price, symbol) = request
+            return self.exchange.cancel_all_events(connection.clientid, symbol, side, min_price, max_price)
+        else:
+            connection.cancel_on_disconnect = bool(request[1] & binary.CANCEL_ON_DISCONNECT)
+            return []
+
+    def _buffer_error(self, connection: _OrderConnection, reason: str) -> None:
+        if connection.binary:
+            self._buffer(connection, binary.pack_error(reason))
+        else:
+            self._buffer_json(connection, {
+                "message": "error",
+                "report": "Processing your request failed",
+                "reason": reason
+            })
 
-    async def fill_order_report(self, clientid: str, orderid: int, price: Decimal, qty: int) -> None:
+    def _report(self, orderid: str, report: str, symbol: str) -> dict:
+        message = {
+            "message": "executionReport",
+            "orderId": orderid,
+            "report": report
+        }
+        if symbol:  # only for instruments with a symbol, single instrument exchanges don't need it
+            message["symbol"] = symbol
+        return message
+
+    def handle_events(self, events: list) -> None:
+        """
+        Sends execution reports and errors contained in a list of events published by the exchange to their clients.
+        """
+        (fills, cancels, errors) = (0, 0, 0)
+        for event in events:
+            if event[0] == "fill":
+                self._execution_report(event[1], event[2], "FILL", event[3], event[4], event[5])
+                fills += 1
+            elif event[0] == "new":
+                self._execution_report(event[1], event[2], "NEW", 0, 0, event[3])
+            elif event[0] == "modified":
+                self._execution_report(event[1], event[2], "MODIFIED", 0, 0, event[3])
+            elif event[0] == "cancelled":
+                self._execution_report(event[1], event[2], "CANCELLED", 0, 0, event[3])
+                cancels += 1
+            elif event[0] == "cancelledAll":
+                self._cancelled_all_report(event[1], event[2], event[3])
+            elif event[0] == "error":
+                if event[1] in self.clients:
+                    self._buffer_error(self.clients[event[1]][1], event[2])
+                errors += 1
+        if self.metrics is not None:
+            self.metrics.count("order_fills", fills)
+            self.metrics.count("order_cancels", cancels)
+            self.metrics.count("order_errors", errors)
+
+    async def fill_order_report(self, clientid: str, orderid: int, price: int, qty: int, symbol: str = "") -> None:
         """
         Sends report about order execution to client.
-        Here qty means the number of traded stocks, not remaining.
+        Here qty means the number of traded stocks, not remaining, and price is in ticks.
         """
-        if clientid not in self.clients:  # Client already disconnected. Don't send the fill report.
+        self._execution_report(clientid, orderid, "FILL", price, qty, symbol)
+
+    def _execution_report(self, clientid: int, orderid, report: str, price: int, qty: int, symbol: str) -> None:
+        if clientid not in self.clients:  # Client already disconnected. Don't send the report.
+            return
+        (reader, writer) = self.clients[clientid]
+        if writer.binary:
+            self._buffer(writer, binary.pack_execution_report(orderid, report, price, qty, symbol))
+            return
+        message = self._report(orderid, report, symbol)
+        if report == "FILL":
+            message["price"] = self.exchange.get_instrument(symbol).to_price(price)
+            message["quantity"] = qty
+        self._buffer_json(writer, message)
+
+
+    def _cancelled_all_report(self, clientid: int, count: int, symbol: str) -> None:
+        if clientid not in self.clients:
             return
         (reader, writer) = self.clients[clientid]
-        await self._send_json(writer, {
+        if writer.binary:
+            self._buffer(writer, binary.pack_execution_report(0, "CANCELLED_ALL", 0, count,
+                                                              binary.ALL_SYMBOLS if symbol is None else symbol))
+            return
+        message = {
             "message": "executionReport",
-            "report": "FILL",
-            "orderId": orderid,
-            "price": str(price),
-            "quantity": qty
-        })
+            "report": "CANCELLED_ALL",
+            "quantity": count
+        }
+        if symbol is not None:
+            message["symbol"] = symbol
+        self._buffer_json(writer, message)
+
+
+class _SlowConsumer:
+    """
+    State of a datastream client, whose transport buffer exceeded the buffer limit.
+    """
+    __slots__ = ("dropped", "levels")
+
+    def __init__(self):
+        self.dropped = 0  # number of reports the client did not get
+        self.levels = set()  # (symbol, side, price) of book rows changed meanwhile, used by "conflate" policy
+
+
+class _Subscription:
+    """
+    Subscription of a datastream client to conflated depth snapshots of one book.
+    """
+    __slots__ = ("symbol", "depth", "interval", "version", "last", "handle")
+
+    def __init__(self, symbol: str, depth: int, interval: float):
+        self.symbol = symbol
+        self.depth = depth
+        self.interval = interval
+        self.version = None  # version of the book, from which the last snapshot was made
+        self.last = None  # last sent (bids, asks)
+        self.handle = None  # timer of the next snapshot
+
+
+class _JoiningClient:
+    """
+    State of a datastream client, which is getting the snapshot of the books sent when it connected.
+    """
+    __slots__ = ("seq", "sides", "prices", "skip", "backlog")
+
+    def __init__(self, seq: int, sides: list, skip: int):
+        self.seq = seq  # sequence number of the last report reflected in the snapshot
+        self.sides = sides  # (symbol, side, {price -> qty}) copied when the client connected, not sent yet
+        self.prices = None  # heap of keys of the levels of sides[0], which were not sent yet
+        self.skip = skip  # length of the broadcast buffer at the time of the copy, these reports are in the snapshot
+        self.backlog = bytearray()  # reports following the snapshot
 
 
 class DatastreamServer(GenericServer):
     """
     Server providing anonymous data, which we call "datastream".
+
+    The server has to be added as an event handler of the exchange. Every report is serialised only once. Reports
+    produced during one event loop iteration are joined and the same bytes are written to the transports of all
+    clients at the end of the iteration.
+
+    Clients, which do not keep up with reading, are handled according to slow_consumer_policy once their transport
+    buffer exceeds buffer_limit bytes:
+    - "disconnect" closes the connection,
+    - "drop" stops sending them reports and, when their buffer gets below the limit again, sends them a "gap" report
+      with the number of reports they missed,
+    - "conflate" works like "drop", but the "gap" report is followed by the current state of all book rows changed
+      meanwhile.
+
+    Every report carries "seq", a sequence number increasing by one with every report of the exchange. A client
+    gets a snapshot of all levels of all books, which is consistent with the reports up to its seq, when it connects.
+    It consists of "snapshot" reports with the levels of one side of one book, best first, followed by a "snapshotEnd"
+    report. All of them carry the same seq and the client then gets the reports following it. The snapshot is made
+    from a copy of the levels, which the server keeps updated from the reports themselves, so it works with the
+    journal and with sharded exchanges too. It is sent in chunks of snapshot_chunk levels per event loop iteration,
+    so that a large book does not stall the matching.
+
+    Instead of the raw stream of reports, clients can ask for conflated snapshots of the top of the book by sending
+    {"message": "subscribe", "symbol": ..., "depth": N, "interval": SECONDS}. They then get at most one "depth" report
+    per interval and book, containing the best N levels of both sides, and only if the levels changed.
+
+    With metrics registered, the server records latencies in nanoseconds of writing the joined reports to all clients
+    ("datastream_send_ns") and counts the reports.
     """
+    POLICIES = ["disconnect", "drop", "conflate"]
+    metrics_prefix = "datastream"
+    snapshot_chunk = 1000
+
+    def __init__(self, host: str, port: int, exchange_obj: exchange.Exchange, buffer_limit: int = 1024 * 1024,
+                 slow_consumer_policy: str = "drop"):
+        super().__init__(host, port, exchange_obj)
+        assert slow_consumer_policy in self.POLICIES, "Unknown slow consumer policy"
+        assert slow_consumer_policy != "conflate" or hasattr(exchange_obj, "get_book"), \
+            "Conflation needs access to the order books"
+        self.buffer_limit = buffer_limit
+        self.slow_consumer_policy = slow_consumer_policy
+        self.stats = {"disconnected": 0, "dropped": 0}
+        self._broadcast_buffer = bytearray()
+        self._broadcast_count = 0  # number of reports in the broadcast buffer
+        self._broadcast_levels = []  # book rows changed by reports in the broadcast buffer, for "conflate" policy
+        self._slow = {}  # clientid -> _SlowConsumer
+        self._subscriptions = {}  # clientid -> {symbol -> _Subscription}
+        self._versions = {}  # symbol -> number of changes of the book
+        self._send_latency = None
+        self._seq = 0  # sequence number of the last report
+        self._levels = {}  # symbol -> {side -> {price -> qty}} as reported by the reports so far
+        self._joining = {}  # clientid -> _JoiningClient
+        for (symbol, book) in getattr(exchange_obj, "books", {}).items():  # books recovered from the journal
+            self._levels[symbol] = {side: dict(book.get_depth(side, book.get_order_count(side)))
+                                    for side in ["BUY", "SELL"]}
+
     def _client_done(self, task):
         try:
             del self.clients[task.result()]
+            self._slow.pop(task.result(), None)
+            self._joining.pop(task.result(), None)
+            for subscription in self._subscriptions.pop(task.result(), {}).values():
+                subscription.handle.cancel()
         except:
             print("Datastream client forced to disconnect.", file=sys.stderr)
 
     async def _handle_client(self, clientid, client_reader, client_writer):
         while True:
-            string = await client_reader.readline()
-            if not string:  # an empty string means the client disconnected
+            try:
+                string = (await client_reader.readline()).decode("utf-8")
+                if not string:  # an empty string means the client disconnected
+                    break
+                data = json.loads(string.rstrip())
+                if data["message"] == "subscribe":
+                    self._subscribe(clientid, data.get("symbol", ""), int(data["depth"]), float(data["interval"]))
+                else:
+                    raise Exception("Unknown message type")
+            except ConnectionResetError:  # Client has disconnected
                 break
+            except asyncio.CancelledError:  # Clients task has been cancelled
+                break
+            except Exception as ex:  # Another error
+                reason = traceback.format_exception_only(type(ex), ex)[0].rstrip("\n")
+                await self._send_json(client_writer, {
+                    "type": "error",
+                    "reason": reason
+                })
         return clientid  # return clientid as task result, so we can recognize the disconnected client in _client_done()
 
-    async def send_datastream_report(self, type: str, side: str, time: datetime.time, price: Decimal, qty: int) -> None:
+    def _client_connected(self, clientid, client_writer) -> None:
+        sides = [(symbol, side, dict(levels[side])) for (symbol, levels) in sorted(self._levels.items())
+                 for side in ["BUY", "SELL"] if levels[side]]
+        self._joining[clientid] = _JoiningClient(self._seq, sides, len(self._broadcast_buffer))
+        asyncio.get_event_loop().call_soon(self._send_book_snapshot, clientid)
+
+    def _send_book_snapshot(self, clientid: int) -> None:
+        joining = self._joining.get(clientid)
+        if joining is None:  # disconnected meanwhile
+            return
+        translate = {"BUY": "bid", "SELL": "ask"}
+        messages = []
+        budget = self.snapshot_chunk
+        while joining.sides and budget > 0:
+            (symbol, side, levels) = joining.sides[0]
+            if joining.prices is None:
+                # A heap gives the best levels first without sorting all of them at once.
+                joining.prices = [-price for price in levels] if side == "BUY" else list(levels)
+                heapq.heapify(joining.prices)
+            prices = [heapq.heappop(joining.prices) for _ in range(min(budget, len(joining.prices)))]
+            budget -= len(prices)
+            to_price = self.exchange.get_instrument(symbol).to_price
+            message = {
+                "type": "snapshot",
+                "seq": joining.seq,
+                "side": translate[side],
+                "levels": [[to_price(price), levels[price]] for price in
+                           ([-price for price in prices] if side == "BUY" else prices)],
+            }
+            if symbol:
+                message["symbol"] = symbol
+            messages.append(message)
+            if not joining.prices:
+                joining.sides.pop(0)
+                joining.prices = None
+        if joining.sides:
+            asyncio.get_event_loop().call_soon(self._send_book_snapshot, clientid)
+        else:
+            messages.append({"type": "snapshotEnd", "seq": joining.seq})
+            del self._joining[clientid]
+        (reader, writer) = self.clients[clientid]
+        self._write(writer, b"".join(json.dumps(message).encode() + b"\n" for message in messages))
+        if not joining.sides and joining.backlog:
+            self._write(writer, bytes(joining.backlog))
+
+    def _subscribe(self, clientid: int, symbol: str, depth: int, interval: float) -> None:
+        assert depth > 0, "Depth has to be positive"
+        assert interval >= 0.001, "Interval has to be at least 1 ms"
+        assert hasattr(self.exchange, "get_book"), "Snapshots need access to the order books"
+        self.exchange.get_instrument(symbol)
+        subscriptions = self._subscriptions.setdefault(clientid, {})
+        if symbol in subscriptions:
+            subscriptions[symbol].handle.cancel()
+        subscription = subscriptions[symbol] = _Subscription(symbol, depth, interval)
+        subscription.handle = asyncio.get_event_loop().call_soon(self._send_snapshot, clientid, subscription)
+
+    def _send_snapshot(self, clientid: int, subscription: _Subscription) -> None:
+        subscription.handle = asyncio.get_event_loop().call_later(subscription.interval, self._send_snapshot, clientid,
+                                                                   subscription)
+        symbol = subscription.symbol
+        version = self._versions.get(symbol, 0)
+        if version == subscription.version:
+            return
+        subscription.version = version
+        book = self.exchange.get_book(symbol)
+        levels = (book.get_depth("BUY", subscription.depth), book.get_depth("SELL", subscription.depth))
+        if levels == subscription.last:
+            return
+        subscription.last = levels
+        to_price = self.exchange.get_instrument(symbol).to_price
+        message = {
+            "type": "depth",
+            "bids": [[to_price(price), qty] for (price, qty) in levels[0]],
+            "asks": [[to_price(price), qty] for (price, qty) in levels[1]],
+            "time": time.time(),
+            "seq": self._seq,
+        }
+        if symbol:
+            message["symbol"] = symbol
+        (reader, writer) = self.clients[clientid]
+        if not writer.transport.is_closing():
+            self._buffer_json(writer, message)
+
+    def handle_events(self, events: list) -> None:
+        """
+        Sends reports about trades and changed books contained in a list of events published by the exchange.
+        """
+        for event in events:
+            if event[0] in exchange.DATASTREAM_EVENTS:
+                self._send_report(*event)
+
+    async def send_datastream_report(self, type: str, side: str, time: float, price: int, qty: int,
+                                     symbol: str = "") -> None:
         """
         Sends report about changed book to public/datastream channel.
-        Side can be None for 'trade' reports.
+        Side can be None for 'trade' reports. Price is in ticks.
         """
+        self._send_report(type, side, time, price, qty, symbol)
+
+    def _send_report(self, type: str, side: str, time: float, price: int, qty: int, symbol: str) -> None:
         translate = {"BUY": "bid", "SELL": "ask"}
         assert type != "trade" or qty != 0
-        for (reader, writer) in self.clients.values():
+        self._seq += 1
+        if side:
+            levels = self._levels.get(symbol)
+            if levels is None:
+                levels = self._levels[symbol] = {"BUY": {}, "SELL": {}}
+            levels = levels[side]
+            # "orderbook" reports carry the new qty of the level, "cancel" reports the cancelled qty
+            remaining = levels.get(price, 0) - qty if type == "cancel" else qty
+            if remaining > 0:
+                levels[price] = remaining
+            else:
+                levels.pop(price, None)
+        if not self.clients:
+            return
+        message = {
+            "type": type,
+            "price": self.exchange.get_instrument(symbol).to_price(price),
+            "quantity": qty,
+            "time": time,
+            "seq": self._seq,
+        }
+        if side:  # only for some types of reports, not for "trade"
+            message["side"] = translate[side]
+            self._versions[symbol] = self._versions.get(symbol, 0) + 1
+            if self.slow_consumer_policy == "conflate":
+                self._broadcast_levels.append((symbol, side, price))
+        if symbol:
+            message["symbol"] = symbol
+        self._broadcast(json.dumps(message).encode() + b"\n")
+
+    def get_client_stats(self) -> dict:
+        """
+        :return: dict mapping clientid to dict with the number of bytes waiting in the client's transport buffer
+        ("buffered"), number of reports it missed since it became slow ("dropped") and number of book rows waiting
+        for conflation ("conflated")
+        """
+        stats = {}
+        for (clientid, (reader, writer)) in self.clients.items():
+            slow = self._slow.get(clientid)
+            stats[clientid] = {
+                "buffered": writer.transport.get_write_buffer_size(),
+                "dropped": slow.dropped if slow else 0,
+                "conflated": len(slow.levels) if slow else 0,
+            }
+        return stats
+
+    def register_metrics(self, metrics) -> None:
+        super().register_metrics(metrics)
+        self._send_latency = metrics.histogram("datastream_send_ns")
+        metrics.gauge("datastream_slow_clients", lambda: len(self._slow))
+        metrics.gauge("datastream_max_buffered_bytes", lambda: max(
+            [writer.transport.get_write_buffer_size() for (reader, writer) in self.clients.values()], default=0))
+        metrics.counter("datastream_dropped_reports", lambda: self.stats["dropped"])
+        metrics.counter("datastream_disconnected_clients", lambda: self.stats["disconnected"])
+
+    def _broadcast(self, data: bytes) -> None:
+        if not self._broadcast_buffer:
+            asyncio.get_event_loop().call_soon(self._flush_broadcast)
+        self._broadcast_buffer += data
+        self._broadcast_count += 1
+
+    def _flush_broadcast(self) -> None:
+        if not self._broadcast_buffer:
+            return
+        send = self._send_latency
+        if send is not None:
+            start = time.perf_counter()
+        data = bytes(self._broadcast_buffer)
+        count = self._broadcast_count
+        levels = self._broadcast_levels
+        self._broadcast_buffer = bytearray()
+        self._broadcast_count = 0
+        self._broadcast_levels = []
+        for (clientid, (reader, writer)) in self.clients.items():
+            if writer.transport.is_closing() or clientid in self._subscriptions:
+                continue
+            if self._joining and clientid in self._joining:
+                joining = self._joining[clientid]
+                joining.backlog += data[joining.skip:]
+                joining.skip = 0
+                continue
+            if writer.transport.get_write_buffer_size() > self.buffer_limit:
+                self._slow_consumer(clientid, writer, count, levels)
+                continue
+            slow = self._slow.pop(clientid, None)
+            if slow is not None:
+                self._write(writer, self._catch_up(slow, self._seq - count))
+            self._write(writer, data)
+        if send is not None:
+            send.record((time.perf_counter() - start) * 1e9)
+            self.metrics.count("datastream_reports", count)
+
+    def _slow_consumer(self, clientid, writer, count: int, levels: list) -> None:
+        if self.slow_consumer_policy == "disconnect":
+            print("Datastream client %d disconnected for not reading its data." % clientid, file=sys.stderr)
+            self.stats["disconnected"] += 1
+            writer.transport.abort()
+            return
+        slow = self._slow.get(clientid)
+        if slow is None:
+            slow = self._slow[clientid] = _SlowConsumer()
+        slow.dropped += count
+        self.stats["dropped"] += count
+        if self.slow_consumer_policy == "conflate":
+            slow.levels.update(levels)
+
+    def _catch_up(self, slow: _SlowConsumer, seq: int) -> bytes:
+        """
+        :param seq: sequence number of the last report the client missed
+        :return: reports for a client, which was slow and can receive data again
+        """
+        messages = [{"type": "gap", "dropped": slow.dropped, "seq": seq}]
+        translate = {"BUY": "bid", "SELL": "ask"}
+        now = time.time()
+        for (symbol, side, price) in sorted(slow.levels):
             message = {
-                "type": type,
-                "price": str(price),
-                "quantity": qty,
-                "time": time.timestamp(),
+                "type": "orderbook",
+                "price": self.exchange.get_instrument(symbol).to_price(price),
+                "quantity": self.exchange.get_book(symbol).get_price_qty(side, price),
+                "time": now,
+                "side": translate[side],
+                "seq": seq,
             }
-            if side:  # only for some types of reports, not for "trade"
-                message["side"] = translate[side]
-            await self._send_json(writer, message)
+            if symbol:
+                message["symbol"] = symbol
+            messages.append(message)
+        return b"".join(json.dumps(message).encode() + b"\n" for message in messages)
+
+    def _flush(self) -> None:
+        super()._flush()
+        self._flush_broadcast()
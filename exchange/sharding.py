@@ -0,0 +1,312 @@
+import asyncio
+import multiprocessing
+import traceback
+from typing import Callable, Iterable, List
+
+from exchange import book
+from exchange.exchange import Exchange, DATASTREAM_EVENTS
+from exchange.instrument import Instrument
+from exchange.order import ORDER_TYPES
+
+
+def _worker_main(commands: multiprocessing.Queue, results, book_class: type, instruments: List[Instrument]) -> None:
+    """
+    Main function of a matching worker process. It receives batches of commands, runs them through its own Exchange
+    and sends back a batch of events for each batch of commands.
+    """
+    exchange = Exchange(book_class, instruments)
+    while True:
+        batch = commands.get()
+        if batch is None:
+            break
+        traded = exchange.stats["traded"]
+        events = []
+        for command in batch:
+            if command[0] == "open":
+                events += exchange.open_order_events(*command[1:])
+            elif command[0] in ["cancel", "modify"]:
+                (request, clientid) = command[1:3]
+                error = None
+                try:
+                    if command[0] == "cancel":
+                        events += exchange.cancel_order_events(*command[2:])
+                    else:
+                        events += exchange.modify_order_events(*command[2:])
+                except Exception as ex:
+                    error = traceback.format_exception_only(type(ex), ex)[0].rstrip("\n")
+                    if request is None:  # nobody waits for the result, report the error to the client
+                        events.append(("error", clientid, error))
+                if request is not None:
+                    events.append(("done", request, error))
+            elif command[0] == "cancelAll":
+                cancel_events = exchange.cancel_all_events(*command[2:])
+                if command[1] is not None:  # a part of a cancel of all symbols, its count is summed by the server
+                    (_, clientid, count, symbol) = cancel_events.pop()
+                    cancel_events.append(("cancelledPart", command[1], count))
+                events += cancel_events
+            elif command[0] == "sync":
+                events.append(("done", command[1], None))
+        if exchange.stats["traded"] != traded:
+            events.append(("traded", exchange.stats["traded"] - traded))
+        results.send(events)
+    results.close()
+
+
+class ShardedExchange:
+    """
+    Exchange, whose instruments are split among several matching worker processes. It has the same interface as
+    exchange.Exchange, so it can be used by the servers instead of it.
+
+    Every symbol is owned by exactly one worker and commands for a worker are sent in order through a single queue, so
+    orders of one symbol are processed in the order in which they arrived. Commands are sent to workers in batches once
+    per event loop iteration and the events produced by workers are published when they come back.
+    """
+
+    def __init__(self, workers: int, book_class: type = book.Book, instruments: Iterable[Instrument] = None):
+        """
+        :param workers: number of worker processes
+        :param book_class: order book implementation used by workers
+        :param instruments: traded instruments, they are assigned to workers in round-robin fashion
+        """
+        assert workers > 0, "At least one worker is needed"
+        self.next_clientid = 0
+        self.book_class = book_class
+        self.instruments = {i.symbol: i for i in (instruments or [Instrument()])}
+        self.worker_of = {symbol: n % workers for (n, symbol) in enumerate(sorted(self.instruments))}
+        self.fill_callback = None
+        self.datastream_callback = None
+        self.event_handlers = []
+        self.stats = {"opened": 0, "traded": 0}
+        self._workers = []  # (process, command queue, result connection)
+        self._num_workers = workers
+        self._pending = [[] for _ in range(workers)]  # commands waiting to be sent to each worker
+        self._flush_scheduled = False
+        self._requests = {}  # request id -> future waiting for the worker's reply
+        self._cancels = {}  # request id -> [clientid, workers to reply, cancelled orders] for cancelAll of all symbols
+        self._next_request = 0
+        self._loop = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Start worker processes."""
+        self._loop = loop
+        for n in range(self._num_workers):
+            instruments = [i for (symbol, i) in self.instruments.items() if self.worker_of[symbol] == n]
+            commands = multiprocessing.Queue()
+            (results, worker_results) = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_worker_main, daemon=True,
+                                              args=(commands, worker_results, self.book_class, instruments))
+            process.start()
+            worker_results.close()
+            loop.add_reader(results.fileno(), self._receive, results)
+            self._workers.append((process, commands, results))
+
+    def stop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Stop worker processes."""
+        for (process, commands, results) in self._workers:
+            loop.remove_reader(results.fileno())
+            commands.put(None)
+            process.join()
+            results.close()
+        self._workers = []
+
+    def get_clientid(self) -> int:
+        """
+        Returns next available client id
+        """
+        id = self.next_clientid
+        self.next_clientid += 1
+        return id
+
+    def get_instrument(self, symbol: str = "") -> Instrument:
+        """
+        :param symbol: symbol of the instrument
+        :return: the instrument, raises KeyError for unknown symbols
+        """
+        try:
+            return self.instruments[symbol]
+        except KeyError:
+            raise KeyError("Unknown symbol %s" % symbol)
+
+    def open_order_events(self, orderid: str, clientid: int, side: str, price: int, qty: int,
+                          symbol: str = "", order_type: str = "LIMIT") -> list:
+        """
+        Sends new trading order to the worker owning the symbol. Its events are published as soon as the worker
+        processes the order. See Exchange.open_order_events for description of parameters.
+        :return: empty list
+        """
+        self.get_instrument(symbol)
+        assert side in ["BUY", "SELL"], "Side has to be BUY or SELL"
+        assert qty > 0, "Quantity has to be positive"
+        assert order_type in ORDER_TYPES, "Unknown order type"
+        self.stats["opened"] += 1
+        self._send(symbol, ("open", orderid, clientid, side, price, qty, symbol, order_type))
+        return []
+
+    def cancel_order_events(self, clientid: int, orderid: str, symbol: str = "") -> list:
+        """
+        Sends cancel of an order to the worker owning the symbol. Its events, or an "error" event if the order does
+        not exist, are published as soon as the worker processes the cancel.
+        See Exchange.cancel_order_events for description of parameters.
+        :return: empty list
+        """
+        self.get_instrument(symbol)
+        self._send(symbol, ("cancel", None, clientid, orderid, symbol))
+        return []
+
+    def modify_order_events(self, clientid: int, orderid: str, price: int = None, qty: int = None,
+                            symbol: str = "") -> list:
+        """
+        Sends change of an order to the worker owning the symbol. Its events, or an "error" event if the order does
+        not exist, are published as soon as the worker processes the change.
+        See Exchange.modify_order_events for description of parameters.
+        :return: empty list
+        """
+        self.get_instrument(symbol)
+        assert qty is None or qty > 0, "Quantity has to be positive"
+        self._send(symbol, ("modify", None, clientid, orderid, price, qty, symbol))
+        return []
+
+    def cancel_all_events(self, clientid: int, symbol: str = None, side: str = None, min_price: int = None,
+                          max_price: int = None) -> list:
+        """
+        Sends cancel of all orders of a client to the worker owning the symbol or, without a symbol, to all workers.
+        Its events are published as soon as the workers process it, the "cancelledAll" event with the total count
+        after all workers did. See Exchange.cancel_all_events for description of parameters.
+        :return: empty list
+        """
+        assert side in [None, "BUY", "SELL"], "Side has to be BUY or SELL"
+        if symbol is not None:
+            self.get_instrument(symbol)
+            self._send(symbol, ("cancelAll", None, clientid, symbol, side, min_price, max_price))
+        elif self._workers:
+            request = self._next_request
+            self._next_request += 1
+            self._cancels[request] = [clientid, len(self._pending), 0]
+            for pending in self._pending:
+                pending.append(("cancelAll", request, clientid, symbol, side, min_price, max_price))
+            self._schedule_flush()
+        else:
+            return [("cancelledAll", clientid, 0, None)]
+        return []
+
+    async def open_order(self, orderid: str, clientid: int, side: str, price: int, qty: int, symbol: str = "",
+                         order_type: str = "LIMIT") -> None:
+        """
+        Sends new trading order to the worker owning the symbol. Fills are reported through callbacks as soon as
+        the worker processes the order. See Exchange.open_order for description of parameters.
+        """
+        self.open_order_events(orderid, clientid, side, price, qty, symbol, order_type)
+
+    async def cancel_order(self, clientid: int, orderid: str, symbol: str = "") -> None:
+        """
+        Removes order. Waits for the worker owning the symbol to process the request.
+        See Exchange.cancel_order for description of parameters.
+        """
+        self.get_instrument(symbol)
+        error = await self._request(self.worker_of[symbol], ("cancel", None, clientid, orderid, symbol))
+        if error:
+            raise KeyError(error)
+
+    async def sync(self) -> None:
+        """
+        Waits until all workers have processed all commands sent before the call and their events were dispatched.
+        """
+        await asyncio.gather(*[self._request(n, ("sync", None)) for n in range(self._num_workers)])
+
+    def set_callbacks(self, fill: Callable[[str, int, int, int, str], None],
+                      datastream: Callable[[str, str, float, int, int, str], None]) -> None:
+        """
+        Sets callbacks, see Exchange.set_callbacks.
+        """
+        self.fill_callback = fill
+        self.datastream_callback = datastream
+
+    def add_event_handler(self, handler: Callable[[list], None]) -> None:
+        """
+        Adds a handler of events, see Exchange.add_event_handler.
+        """
+        self.event_handlers.append(handler)
+
+    def publish(self, events: list) -> None:
+        """
+        Passes a list of events to all event handlers at once, see Exchange.publish.
+        """
+        for handler in self.event_handlers:
+            handler(events)
+
+    def register_metrics(self, metrics) -> None:
+        """
+        Registers counters of orders and the number of workers in a metrics.Metrics object.
+        """
+        metrics.counter("exchange_orders_opened", lambda: self.stats["opened"])
+        metrics.counter("exchange_orders_traded", lambda: self.stats["traded"])
+        metrics.gauge("exchange_workers", lambda: len(self._workers))
+
+    def _send(self, symbol: str, command: tuple) -> None:
+        self._pending[self.worker_of[symbol]].append(command)
+        self._schedule_flush()
+
+    def _request(self, worker: int, command: tuple) -> asyncio.Future:
+        request = self._next_request
+        self._next_request += 1
+        future = self._loop.create_future()
+        self._requests[request] = future
+        self._pending[worker].append((command[0], request) + command[2:])
+        self._schedule_flush()
+        return future
+
+    def _schedule_flush(self) -> None:
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        for (n, commands) in enumerate(self._pending):
+            if commands:
+                self._workers[n][1].put(commands)
+                self._pending[n] = []
+
+    def _receive(self, results) -> None:
+        while results.poll():
+            try:
+                events = results.recv()
+            except EOFError:  # worker exited
+                self._loop.remove_reader(results.fileno())
+                return
+            self._dispatch(events)
+
+    def _dispatch(self, events: list) -> None:
+        published = []
+        done = []
+        for event in events:
+            if event[0] == "done":
+                done.append(event)
+            elif event[0] == "traded":
+                self.stats["traded"] += event[1]
+            elif event[0] == "cancelledPart":
+                cancel = self._cancels[event[1]]
+                cancel[1] -= 1
+                cancel[2] += event[2]
+                if not cancel[1]:
+                    del self._cancels[event[1]]
+                    published.append(("cancelledAll", cancel[0], cancel[2], None))
+            else:
+                published.append(event)
+        self.publish(published)
+        if self.fill_callback or self.datastream_callback:
+            asyncio.ensure_future(self._run_callbacks(published))
+        for (_, request, error) in done:
+            self._requests.pop(request).set_result(error)
+
+    async def _run_callbacks(self, events: list) -> None:
+        for event in events:
+            if event[0] == "fill":
+                if self.fill_callback:
+                    try:
+                        await self.fill_callback(*event[1:])
+                    except ConnectionResetError:  # Client has disconnected meanwhile
+                        pass
+            elif event[0] in DATASTREAM_EVENTS:
+                if self.datastream_callback:
+                    await self.datastream_callback(*event)
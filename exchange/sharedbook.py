@@ -0,0 +1,238 @@
+"""
+Top of the order books published in shared memory for readers running on the same machine.
+
+SharedBookPublisher keeps the best depth levels of both sides of every book in a memory-mapped file, e.g. in /dev/shm.
+SharedBookReader maps the same file and reads a book without any system call, socket or parsing, so a local strategy
+gets the best bid and ask much faster than from the datastream.
+
+The file starts with HEADER followed by one slot per instrument. Every slot starts with SLOT_HEADER, which is written
+once, followed by the changing part: a sequence number, the time of the update, the numbers of bid and ask levels and
+depth rows of (bid price, bid qty, ask price, qty), best first. Prices are integer numbers of ticks of the instrument.
+Slots are aligned to cache lines.
+
+Slots are guarded by a seqlock: the publisher makes the sequence number odd, writes the levels and makes it even again.
+A reader copies the slot and accepts the copy only if the sequence number was even and did not change meanwhile. The
+sequence number is written by a single 8 byte copy and the order of the writes is kept by the processor on x86-64, the
+only platform this is meant for, as Python cannot issue memory barriers.
+"""
+import asyncio
+import bisect
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+from exchange.instrument import Instrument
+
+MAGIC = b"EXBOOK01"
+# magic, depth, number of slots, size of a slot
+HEADER = struct.Struct("<8sIII")
+# symbol, tick size as ASCII decimal number
+SLOT_HEADER = struct.Struct("<8s24s")
+# sequence number
+SEQ = struct.Struct("<Q")
+CACHE_LINE = 64
+
+# Consistent copy of a slot. Bids and asks are lists of (price in ticks, qty), best first.
+BookLevels = namedtuple("BookLevels", ["seq", "time", "bids", "asks"])
+
+
+def _levels_format(depth: int) -> struct.Struct:
+    # sequence number, time, number of bids, number of asks, padding, depth rows of bid price, qty, ask price, qty
+    return struct.Struct("<QdHH4x" + "qqqq" * depth)
+
+
+def _slot_size(depth: int) -> int:
+    size = SLOT_HEADER.size + _levels_format(depth).size
+    return (size + CACHE_LINE - 1) // CACHE_LINE * CACHE_LINE
+
+
+class SharedBookPublisher:
+    """
+    Publisher of the best levels of the books of an exchange into a shared memory file. It has to be added as an event
+    handler of the exchange. It keeps the levels of the books as reported by the events, like the datastream does, so
+    it works with sharding.ShardedExchange as well and never scans the books. Books changed by the published events
+    are written once per event loop iteration and only if their best levels changed.
+    """
+
+    def __init__(self, path: str, exchange_obj, depth: int = 10):
+        """
+        :param path: file to create, it should be on a memory file system like /dev/shm
+        :param exchange_obj: exchange.Exchange or sharding.ShardedExchange
+        :param depth: number of levels of each side
+        """
+        assert depth > 0, "Depth has to be positive"
+        self.path = path
+        self.depth = depth
+        self.stats = {"writes": 0}
+        self._format = _levels_format(depth)
+        self._slots = {}  # symbol -> offset of the slot
+        self._seqs = {}  # symbol -> sequence number of the slot
+        self._levels = {}  # (symbol, side) -> {price -> qty}
+        self._prices = {}  # (symbol, side) -> sorted list of prices of the levels
+        self._last = {}  # symbol -> last written (bids, asks)
+        self._changed = set()  # symbols with levels changed since the last write
+        slot_size = _slot_size(depth)
+        symbols = sorted(exchange_obj.instruments)
+        size = HEADER.size + CACHE_LINE - HEADER.size % CACHE_LINE + slot_size * len(symbols)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        offset = size - slot_size * len(symbols)
+        books = getattr(exchange_obj, "books", {})  # books recovered from the journal
+        for symbol in symbols:
+            tick_size = str(exchange_obj.get_instrument(symbol).tick_size).encode()
+            assert len(symbol.encode()) <= 8 and len(tick_size) <= SLOT_HEADER.size - 8, \
+                "Symbol or tick size is too long"
+            SLOT_HEADER.pack_into(self._mmap, offset, symbol.encode(), tick_size)
+            self._slots[symbol] = offset
+            self._seqs[symbol] = 0
+            for side in ["BUY", "SELL"]:
+                book = books.get(symbol)
+                levels = self._levels[(symbol, side)] = dict(
+                    book.get_depth(side, book.get_order_count(side)) if book is not None else [])
+                self._prices[(symbol, side)] = sorted(levels)
+            self._changed.add(symbol)
+            offset += slot_size
+        self.write()
+        # The header is written last, so readers never see a file with unwritten slots.
+        HEADER.pack_into(self._mmap, 0, MAGIC, depth, len(symbols), slot_size)
+
+    def handle_events(self, events: list) -> None:
+        """
+        Updates the levels changed by a list of events published by the exchange and schedules writing of their books.
+        """
+        changed = self._changed
+        was_empty = not changed
+        for event in events:
+            if event[0] == "orderbook" or event[0] == "cancel":
+                (type, side, time_, price, qty, symbol) = event
+                levels = self._levels[(symbol, side)]
+                # "orderbook" events carry the new qty of the level, "cancel" events the cancelled qty
+                remaining = levels.get(price, 0) - qty if type == "cancel" else qty
+                prices = self._prices[(symbol, side)]
+                if remaining > 0:
+                    if price not in levels:
+                        bisect.insort(prices, price)
+                    levels[price] = remaining
+                elif price in levels:
+                    del levels[price]
+                    del prices[bisect.bisect_left(prices, price)]
+                changed.add(symbol)
+        if was_empty and changed:
+            asyncio.get_event_loop().call_soon(self.write)
+
+    def write(self) -> None:
+        """
+        Writes the best levels of the changed books to their slots.
+        """
+        changed = self._changed
+        self._changed = set()
+        mm = self._mmap
+        depth = self.depth
+        for symbol in changed:
+            (bid_levels, ask_levels) = (self._levels[(symbol, "BUY")], self._levels[(symbol, "SELL")])
+            bids = [(price, bid_levels[price]) for price in reversed(self._prices[(symbol, "BUY")][-depth:])]
+            asks = [(price, ask_levels[price]) for price in self._prices[(symbol, "SELL")][:depth]]
+            if (bids, asks) == self._last.get(symbol):
+                continue
+            self._last[symbol] = (bids, asks)
+            rows = []
+            for n in range(depth):
+                rows += bids[n] if n < len(bids) else (0, 0)
+                rows += asks[n] if n < len(asks) else (0, 0)
+            offset = self._slots[symbol] + SLOT_HEADER.size
+            seq = self._seqs[symbol]
+            mm[offset:offset + SEQ.size] = SEQ.pack(seq + 1)
+            self._format.pack_into(mm, offset, seq + 1, time.time(), len(bids), len(asks), *rows)
+            mm[offset:offset + SEQ.size] = SEQ.pack(seq + 2)
+            self._seqs[symbol] = seq + 2
+            self.stats["writes"] += 1
+
+    def register_metrics(self, metrics) -> None:
+        """
+        Registers the counter of written books in a metrics.Metrics object.
+        """
+        metrics.counter("sharedbook_writes", lambda: self.stats["writes"])
+
+    def close(self) -> None:
+        """
+        Unmaps the file. The file itself is kept, readers see the last written state.
+        """
+        self._mmap.close()
+
+
+class SharedBookReader:
+    """
+    Reader of books published by SharedBookPublisher, typically in another process. Reads never block, they only
+    retry while the publisher is writing the slot.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: file created by SharedBookPublisher
+        """
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.depth, count, slot_size) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError("%s is not a shared book" % path)
+        self._format = _levels_format(self.depth)
+        # sequence number, time, number of bids, number of asks, best bid price, qty, best ask price, qty
+        self._top = struct.Struct("<QdHH4xqqqq")
+        self.instruments = {}  # symbol -> Instrument with the tick size of the published prices
+        self._slots = {}  # symbol -> offset of the levels of the slot
+        offset = len(self._mmap) - slot_size * count
+        for _ in range(count):
+            (symbol, tick_size) = SLOT_HEADER.unpack_from(self._mmap, offset)
+            symbol = symbol.rstrip(b"\0").decode()
+            self.instruments[symbol] = Instrument(symbol, tick_size.rstrip(b"\0").decode())
+            self._slots[symbol] = offset + SLOT_HEADER.size
+            offset += slot_size
+
+    def symbols(self) -> List[str]:
+        """
+        :return: symbols of the published books
+        """
+        return sorted(self._slots)
+
+    def _read(self, unpack, symbol: str) -> tuple:
+        mm = self._mmap
+        offset = self._slots[symbol]
+        while True:
+            values = unpack(mm, offset)
+            if not values[0] & 1 and SEQ.unpack_from(mm, offset)[0] == values[0]:
+                return values
+
+    def best(self, symbol: str = "") -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        """
+        :return: (price, qty) of the best bid and of the best ask, None for an empty side
+        """
+        (seq, time_, bid_count, ask_count, bid_price, bid_qty, ask_price, ask_qty) = self._read(
+            self._top.unpack_from, symbol)
+        return (bid_price, bid_qty) if bid_count else None, (ask_price, ask_qty) if ask_count else None
+
+    def levels(self, symbol: str = "") -> BookLevels:
+        """
+        :return: all published levels of a book
+        """
+        values = self._read(self._format.unpack_from, symbol)
+        (seq, time_, bid_count, ask_count) = values[:4]
+        rows = values[4:]
+        bids = [(rows[4 * n], rows[4 * n + 1]) for n in range(bid_count)]
+        asks = [(rows[4 * n + 2], rows[4 * n + 3]) for n in range(ask_count)]
+        return BookLevels(seq, time_, bids, asks)
+
+    def seq(self, symbol: str = "") -> int:
+        """
+        :return: current sequence number of a book, which changes with every update, e.g. for polling
+        """
+        return SEQ.unpack_from(self._mmap, self._slots[symbol])[0]
+
+    def close(self) -> None:
+        self._mmap.close()
@@ -0,0 +1,99 @@
+"""
+Compact columnar snapshots of order books.
+
+A snapshot of a book starts with MAGIC and contains both sides, BUY first. A side consists of the numbers of its price
+levels and resting orders followed by columns: prices, quantities and order counts of the levels, best level first,
+and prices, quantities, sequence numbers and client ids of the orders in priority order. Numeric columns are arrays of
+little-endian 64-bit integers, order ids are a length-prefixed pickled list. Both book implementations share the
+format, so a snapshot of one can be loaded into the other.
+"""
+from array import array
+import gc
+import itertools
+import pickle
+import struct
+import sys
+from typing import BinaryIO, Dict, List, Tuple
+
+from exchange import order
+from exchange.order import Order
+
+MAGIC = b"EXBOOK\x01\0"
+SIDES = ["BUY", "SELL"]
+
+# number of levels, number of orders
+COUNTS = struct.Struct("<QQ")
+LENGTH = struct.Struct("<Q")
+PICKLE_PROTOCOL = 4
+
+
+def _write_column(file: BinaryIO, values) -> None:
+    column = array("q", values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    file.write(column.tobytes())
+
+
+def _read_column(file: BinaryIO, length: int) -> array:
+    column = array("q")
+    column.frombytes(file.read(length * column.itemsize))
+    if len(column) != length:
+        raise ValueError("Truncated book snapshot")
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def write_book(file: BinaryIO, sides: Dict[str, List[Order]]) -> None:
+    """
+    :param file: binary file to write to
+    :param sides: side -> live resting orders of the side in priority order
+    """
+    file.write(MAGIC)
+    for side in SIDES:
+        orders = sides[side]
+        levels = []  # [price, qty, count]
+        for o in orders:
+            if levels and levels[-1][0] == o.price:
+                levels[-1][1] += o.qty
+                levels[-1][2] += 1
+            else:
+                levels.append([o.price, o.qty, 1])
+        file.write(COUNTS.pack(len(levels), len(orders)))
+        for n in range(3):
+            _write_column(file, [level[n] for level in levels])
+        _write_column(file, [o.price for o in orders])
+        _write_column(file, [o.qty for o in orders])
+        _write_column(file, [o.seq for o in orders])
+        _write_column(file, [o.clientid for o in orders])
+        ids = pickle.dumps([o.id for o in orders], PICKLE_PROTOCOL)
+        file.write(LENGTH.pack(len(ids)) + ids)
+
+
+def read_book(file: BinaryIO) -> Dict[str, Tuple[List[Tuple[int, int, int]], List[Order]]]:
+    """
+    Reads a book snapshot and makes orders created afterwards get lower priority than the restored ones.
+    :param file: binary file positioned at the start of the snapshot
+    :return: side -> (list of (price, qty, number of orders) of levels best first, list of orders in priority order)
+    """
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a book snapshot")
+    sides = {}
+    # Creating millions of objects would trigger many useless collections, which would slow the load down twice.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for side in SIDES:
+            (num_levels, num_orders) = COUNTS.unpack(file.read(COUNTS.size))
+            levels = list(zip(*[_read_column(file, num_levels) for _ in range(3)]))
+            (prices, qtys, seqs, clientids) = [_read_column(file, num_orders) for _ in range(4)]
+            (length,) = LENGTH.unpack(file.read(LENGTH.size))
+            ids = pickle.loads(file.read(length))
+            sides[side] = (levels, list(map(Order, ids, clientids, itertools.repeat(side, num_orders), prices, qtys,
+                                            seqs)))
+            if seqs:
+                order.reserve_sequence(max(seqs))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return sides
@@ -4,8 +4,26 @@
 
 import asyncio
 import json
+import os
 import sys
 import random
+import time
+import tempfile
+import tracemalloc
+import gc
+
+from exchange.book import Book
+from exchange.levelbook import LevelBook
+from exchange.order import Order
+from exchange.exchange import Exchange
+from exchange.histogram import Histogram
+from exchange.instrument import Instrument
+from exchange.journal import Journal
+from exchange.sharding import ShardedExchange
+from exchange.metrics import Metrics
+from exchange.server import DatastreamServer, OrderServer, new_event_loop, uvloop
+from exchange.sharedbook import SharedBookPublisher, SharedBookReader
+from exchange import binary, replay
 
 
 async def _read_incoming_data(reader):
@@ -22,7 +40,7 @@ async def _send_message(writer, msg):
     await writer.drain()
 
 
-async def benchmark(host, port, max_orders=0, sleep_time=0):
+async def benchmark(host, port, max_orders=0, sleep_time=0, symbols=None):
     reader, writer = await asyncio.open_connection(host, port)
     incoming = asyncio.ensure_future(_read_incoming_data(reader))
 
@@ -30,17 +48,20 @@ async def benchmark(host, port, max_orders=0, sleep_time=0):
     try:
         while num_orders < max_orders or max_orders == 0:
             num_orders += 1
-            order_id = random.randint(0, 10**6)
+            order_id = num_orders
             side = random.choice(['BUY', 'SELL'])
             price = int(random.gauss(100, 10))
             quantity = int(random.gauss(100, 10))
-            await _send_message(writer, {
+            message = {
                 'message': 'createOrder',
                 'orderId': order_id,
                 'side': side,
                 'price': str(price),
                 'quantity': quantity,
-            })
+            }
+            if symbols:  # drive many instruments at once
+                message['symbol'] = random.choice(symbols)
+            await _send_message(writer, message)
             if reader.at_eof():
                 break
         await asyncio.sleep(sleep_time)
@@ -63,7 +84,7 @@ async def network_benchmark(host, port, max_orders=0, sleep_time=0):
     try:
         while num_orders < max_orders or max_orders == 0:
             num_orders += 1
-            order_id = random.randint(0, 10**6)
+            order_id = num_orders
             side = "SELL" if side == "BUY" else "BUY"
             price = 101 if side == "BUY" else 100
             quantity = 10
@@ -85,16 +106,791 @@ async def network_benchmark(host, port, max_orders=0, sleep_time=0):
         print("Orders opened: ", num_orders)
 
 
+def cancel_benchmark(depths=(1000, 10000, 100000), cancels=1000):
+    """
+    Measures average latency of Book.remove_order for books of various depths.
+    Cancel latency should not grow with the number of resting orders.
+    :return: dict mapping book depth to average cancel latency in microseconds
+    """
+    results = {}
+    for depth in depths:
+        book = Book()
+        for i in range(depth):
+            side = "BUY" if i % 2 else "SELL"
+            price = random.randint(1, 100) if side == "BUY" else random.randint(101, 200)
+            book.open_order(Order(str(i), i % 10, side, price, 10))
+        victims = random.sample(range(depth), min(cancels, depth))
+        start = time.perf_counter()
+        for i in victims:
+            book.remove_order(i % 10, str(i))
+        results[depth] = (time.perf_counter() - start) / len(victims) * 10**6
+        print("Book depth %7d: %.2f us per cancel" % (depth, results[depth]))
+    return results
+
+
+def mass_cancel_benchmark(book_classes=(Book, LevelBook), depths=(1000, 10000, 100000), quotes=100, repeat=20):
+    """
+    Measures Book.remove_client_orders of one client with quotes resting orders among depth orders of other clients,
+    compared with cancelling the same orders one by one.
+    Mass cancel latency should grow only with the number of orders of the client, not with the depth of the book.
+    :return: dict mapping (book class name, depth) to average latency of a mass cancel and of the equivalent single
+    cancels in microseconds
+    """
+    results = {}
+    for book_class in book_classes:
+        for depth in depths:
+            book = book_class()
+            for i in range(depth):
+                side = "BUY" if i % 2 else "SELL"
+                price = random.randint(1, 100) if side == "BUY" else random.randint(101, 200)
+                book.open_order(Order(str(i), 1 + i % 10, side, price, 10))
+            timings = {"mass": 0.0, "single": 0.0}
+            for n in range(2 * repeat):
+                for i in range(quotes):
+                    book.open_order(Order(str(i), 0, "BUY" if i % 2 else "SELL", 100 if i % 2 else 101, 10))
+                start = time.perf_counter()
+                if n % 2:
+                    book.remove_client_orders(0)
+                    timings["mass"] += time.perf_counter() - start
+                else:
+                    for i in range(quotes):
+                        book.remove_order(0, str(i))
+                    timings["single"] += time.perf_counter() - start
+            result = results[(book_class.__name__, depth)] = (timings["mass"] / repeat * 10**6,
+                                                               timings["single"] / repeat * 10**6)
+            print("%-9s depth %7d: %.1f us per mass cancel of %d orders, %.1f us by single cancels" % (
+                book_class.__name__, depth, result[0], quotes, result[1]))
+    return results
+
+
+def amend_benchmark(book_classes=(Book, LevelBook), depths=(1000, 100000), amends=2000):
+    """
+    Measures average latency of Book.modify_order reducing qty in place and changing price, compared with the cancel
+    and new order, which clients had to send before.
+    :return: dict mapping (book class name, depth) to dict of latencies in microseconds
+    """
+    results = {}
+    for book_class in book_classes:
+        for depth in depths:
+            result = results[(book_class.__name__, depth)] = {}
+            for mode in ["qty", "price", "cancel+open"]:
+                book = book_class()
+                rnd = random.Random(0)
+                for i in range(depth):
+                    side = "BUY" if i % 2 else "SELL"
+                    price = rnd.randint(1, 100) if side == "BUY" else rnd.randint(101, 200)
+                    book.open_order(Order(str(i), i % 10, side, price, 1000))
+                victims = [(i % 10, str(i), "BUY" if i % 2 else "SELL")
+                           for i in rnd.sample(range(depth), min(amends, depth))]
+                start = time.perf_counter()
+                if mode == "qty":
+                    for (clientid, orderid, side) in victims:
+                        book.modify_order(clientid, orderid, qty=500)
+                elif mode == "price":
+                    for (clientid, orderid, side) in victims:
+                        book.modify_order(clientid, orderid, 50 if side == "BUY" else 150)
+                else:
+                    for (clientid, orderid, side) in victims:
+                        order = book.remove_order(clientid, orderid)
+                        book.open_order(Order(orderid, clientid, side, 50 if side == "BUY" else 150, order.qty))
+                result[mode] = (time.perf_counter() - start) / len(victims) * 10**6
+            print("%-9s depth %7d: %s" % (book_class.__name__, depth, ", ".join(
+                "%s %.2f us" % (mode, latency) for (mode, latency) in result.items())))
+    return results
+
+
+def generate_order_flow(num_orders, seed=0, cancel_ratio=0.2):
+    """
+    Generates a reproducible flow of gaussian orders mixed with cancels of previously sent orders.
+    :return: list of ("open", Order arguments) and ("cancel", clientid, orderid) tuples
+    """
+    rnd = random.Random(seed)
+    flow = []
+    sent = []
+    for i in range(num_orders):
+        if sent and rnd.random() < cancel_ratio:
+            flow.append(("cancel",) + sent.pop(rnd.randrange(len(sent))))
+            continue
+        clientid = rnd.randint(0, 9)
+        side = rnd.choice(['BUY', 'SELL'])
+        price = int(rnd.gauss(100, 10))
+        quantity = int(rnd.gauss(100, 10))
+        flow.append(("open", str(i), clientid, side, price, quantity))
+        sent.append((clientid, str(i)))
+    return flow
+
+
+def run_order_flow(book, flow):
+    """
+    Feeds an order flow into a book.
+    :return: number of fills
+    """
+    fills = 0
+    for item in flow:
+        if item[0] == "open":
+            fills += len(book.open_order(Order(*item[1:]))[1])
+        else:
+            try:
+                book.remove_order(item[1], item[2])
+            except KeyError:  # already filled
+                pass
+    return fills
+
+
+def book_benchmark(book_classes=(Book, LevelBook), num_orders=100000, seed=0):
+    """
+    Runs an identical order flow through each book implementation.
+    :return: dict mapping book class name to processed messages per second
+    """
+    flow = generate_order_flow(num_orders, seed)
+    results = {}
+    for book_class in book_classes:
+        book = book_class()
+        start = time.perf_counter()
+        fills = run_order_flow(book, flow)
+        results[book_class.__name__] = len(flow) / (time.perf_counter() - start)
+        print("%-10s %9.0f msgs/s, %d fills" % (book_class.__name__, results[book_class.__name__], fills))
+    return results
+
+
+async def exchange_benchmark(num_orders=100000, seed=0):
+    """
+    Runs an identical order flow through Exchange.open_order_events and cancel_order_events in a plain loop and
+    through the open_order and cancel_order coroutines with callbacks awaited for every event.
+    :return: dict mapping the API ("events" or "callbacks") to processed messages per second
+    """
+    flow = generate_order_flow(num_orders, seed)
+    results = {}
+
+    async def callback(*args):
+        pass
+
+    def run_events(exchange):
+        for item in flow:
+            try:
+                if item[0] == "open":
+                    exchange.publish(exchange.open_order_events(*item[1:]))
+                else:
+                    exchange.publish(exchange.cancel_order_events(item[1], item[2]))
+            except KeyError:  # already filled
+                pass
+
+    async def run_callbacks(exchange):
+        for item in flow:
+            try:
+                if item[0] == "open":
+                    await exchange.open_order(*item[1:])
+                else:
+                    await exchange.cancel_order(item[1], item[2])
+            except KeyError:  # already filled
+                pass
+
+    for api in ["events", "callbacks"]:
+        exchange = Exchange(LevelBook, [Instrument(tick_size="1")])
+        start = time.perf_counter()
+        if api == "events":
+            exchange.add_event_handler(len)
+            run_events(exchange)
+        else:
+            exchange.set_callbacks(callback, callback)
+            await run_callbacks(exchange)
+        results[api] = len(flow) / (time.perf_counter() - start)
+        print("%-10s %9.0f msgs/s" % (api, results[api]))
+    return results
+
+
+def journal_benchmark(num_orders=100000, commit_every=100, directory=None, seed=0):
+    """
+    Runs an identical order flow through an exchange without a journal, with a journal committed without fsync and
+    with fsync, committing once per commit_every messages. Then recovers the exchange from the last journal.
+    :return: dict mapping the journal mode ("none", "no fsync", "fsync" or "recovery") to messages per second
+    """
+    flow = generate_order_flow(num_orders, seed)
+    results = {}
+    with tempfile.TemporaryDirectory(dir=directory) as temp:
+        for mode in ["none", "no fsync", "fsync"]:
+            exchange = Exchange(LevelBook, [Instrument(tick_size="1")])
+            path = os.path.join(temp, mode.replace(" ", "_"))
+            if mode != "none":
+                exchange.journal = Journal(path, mode == "fsync", snapshot_interval=0)
+                exchange.journal.recover(exchange)
+            start = time.perf_counter()
+            for (n, item) in enumerate(flow):
+                try:
+                    if item[0] == "open":
+                        exchange.open_order_events(*item[1:])
+                    else:
+                        exchange.cancel_order_events(item[1], item[2])
+                except KeyError:  # already filled
+                    pass
+                if exchange.journal and n % commit_every == 0:
+                    exchange.commit()
+            if exchange.journal:
+                exchange.commit()
+                exchange.journal.close()
+            results[mode] = len(flow) / (time.perf_counter() - start)
+        exchange = Exchange(LevelBook, [Instrument(tick_size="1")])
+        start = time.perf_counter()
+        replayed = Journal(path).recover(exchange)
+        results["recovery"] = replayed / (time.perf_counter() - start)
+    for (mode, rate) in results.items():
+        print("%-10s %9.0f msgs/s" % (mode, rate))
+    return results
+
+
+def _timed(histogram, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    histogram.record((time.perf_counter() - start) * 1e9)
+    return result
+
+
+def book_latency_benchmark(book_classes=(Book, LevelBook), depths=(1000, 100000), operations=2000, seed=0):
+    """
+    Measures latency of single book operations at various depths of the book: inserting a non-crossing order,
+    cancelling it and matching an aggressive order against one resting order.
+    :return: dict mapping (book class name, depth, operation) to Histogram of latencies in nanoseconds
+    """
+    rnd = random.Random(seed)
+    results = {}
+    for book_class in book_classes:
+        for depth in depths:
+            book = book_class()
+            for i in range(depth):
+                side = "BUY" if i % 2 else "SELL"
+                price = rnd.randint(1, 1000) if side == "BUY" else rnd.randint(1001, 2000)
+                book.open_order(Order(str(i), i % 10, side, price, 10))
+            (insert, cancel, match) = (Histogram(), Histogram(), Histogram())
+            gc.disable()  # collections of the deep book would dominate the tail latencies
+            try:
+                for i in range(operations):
+                    side = "BUY" if i % 2 else "SELL"
+                    price = rnd.randint(1, 1000) if side == "BUY" else rnd.randint(1001, 2000)
+                    _timed(insert, book.open_order, Order("x%d" % i, 99, side, price, 10))
+                for i in range(operations):
+                    _timed(cancel, book.remove_order, 99, "x%d" % i)
+                for i in range(operations):
+                    # Every resting order has quantity 10, so exactly one of them gets filled.
+                    aggressive = Order("m%d" % i, 98, "SELL", 0, 10) if i % 2 else Order("m%d" % i, 98, "BUY", 3000, 10)
+                    (order, filled) = _timed(match, book.open_order, aggressive)
+                    side = filled[0].side
+                    price = rnd.randint(1, 1000) if side == "BUY" else rnd.randint(1001, 2000)
+                    book.open_order(Order("r%d" % i, 97, side, price, 10))
+            finally:
+                gc.enable()
+            for (name, histogram) in [("insert", insert), ("cancel", cancel), ("match", match)]:
+                results[(book_class.__name__, depth, name)] = histogram
+                print("%-10s depth %7d %-6s p50 %6.2f us, p99 %6.2f us, p99.9 %6.2f us" % (
+                    book_class.__name__, depth, name, histogram.percentile(50) / 1000,
+                    histogram.percentile(99) / 1000, histogram.percentile(99.9) / 1000))
+    return results
+
+
+def snapshot_benchmark(book_classes=(Book, LevelBook), num_orders=1000000):
+    """
+    Compares building a deep book by opening its orders one by one with loading it from a snapshot.
+    :return: dict mapping book class name to dict with orders per second when opened, dumped and loaded
+    """
+    results = {}
+    for book_class in book_classes:
+        book = book_class()
+        orders = []
+        for i in range(num_orders):
+            side = "BUY" if i % 2 else "SELL"
+            price = random.randint(1, 1000) if side == "BUY" else random.randint(1001, 2000)
+            orders.append(Order(str(i), i % 10, side, price, 10))
+        start = time.perf_counter()
+        for order in orders:
+            book.open_order(order)
+        opened = time.perf_counter() - start
+        del orders
+        with tempfile.TemporaryFile() as file:
+            start = time.perf_counter()
+            book.dump(file)
+            dumped = time.perf_counter() - start
+            size = file.tell()
+            file.seek(0)
+            start = time.perf_counter()
+            book_class.load(file)
+            loaded = time.perf_counter() - start
+        results[book_class.__name__] = {"open": num_orders / opened, "dump": num_orders / dumped,
+                                        "load": num_orders / loaded}
+        print("%-10s open %9.0f orders/s, dump %9.0f orders/s, load %9.0f orders/s, %.1f bytes per order" % (
+            book_class.__name__, num_orders / opened, num_orders / dumped, num_orders / loaded, size / num_orders))
+    return results
+
+
+def replay_benchmark(num_orders=200000, path=None):
+    """
+    Records the benchmark order flow to a binary and a CSV file and replays them into an exchange as fast as possible.
+    :param path: path of the recorded files without extension, temporary files are used if not given
+    :return: dict mapping the file format to replayed commands per second
+    """
+    instruments = {"": Instrument(tick_size="1")}
+    records = []
+    for (n, item) in enumerate(generate_order_flow(num_orders)):
+        if item[0] == "open":
+            records.append((n / 1000, ("open", int(item[1]), item[2], item[3], item[4], item[5], "")))
+        else:
+            records.append((n / 1000, ("cancel", item[1], int(item[2]), "")))
+    results = {}
+    with tempfile.TemporaryDirectory() as temp:
+        path = path or os.path.join(temp, "orders")
+        with open(path + ".bin", "wb") as file:
+            replay.write_binary(file, records)
+        with open(path + ".csv", "w", newline="") as file:
+            replay.write_csv(file, records, instruments)
+        for (name, extension) in [("binary", ".bin"), ("csv", ".csv")]:
+            exchange = Exchange(LevelBook, instruments.values())
+            stats = replay.replay(replay.read_records(path + extension, instruments), exchange)
+            results[name] = stats.commands() / stats.elapsed
+            print("%s file:" % name)
+            print(stats.report())
+    return results
+
+
+def memory_benchmark(book_classes=(Book, LevelBook), num_orders=100000):
+    """
+    Measures memory allocated per resting order, including the order object and the book structures holding it.
+    :return: dict mapping book class name to bytes per resting order
+    """
+    results = {}
+    for book_class in book_classes:
+        gc.collect()
+        tracemalloc.start()
+        book = book_class()
+        for i in range(num_orders):
+            side = "BUY" if i % 2 else "SELL"
+            price = random.randint(1, 1000) if side == "BUY" else random.randint(1001, 2000)
+            book.open_order(Order(str(i), i % 10, side, price, 10))
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[book_class.__name__] = current / num_orders
+        print("%-10s %6.0f bytes per resting order" % (book_class.__name__, results[book_class.__name__]))
+        del book
+    return results
+
+
+async def sharding_benchmark(workers=(0, 1, 2, 4), num_symbols=64, num_orders=200000):
+    """
+    Runs the same multi-symbol order flow through an exchange with various numbers of matching worker processes,
+    0 meaning matching in this process.
+    :return: dict mapping number of workers to processed orders per second
+    """
+    loop = asyncio.get_event_loop()
+    instruments = [Instrument("S%d" % n) for n in range(num_symbols)]
+    rnd = random.Random(0)
+    orders = [(str(i), rnd.randint(0, 9), rnd.choice(['BUY', 'SELL']), int(rnd.gauss(100, 10)),
+               int(rnd.gauss(100, 10)), instruments[rnd.randrange(num_symbols)].symbol) for i in range(num_orders)]
+
+    async def callback(*args):
+        pass
+
+    results = {}
+    for n in workers:
+        exchange = ShardedExchange(n, LevelBook, instruments) if n else Exchange(LevelBook, instruments)
+        exchange.set_callbacks(callback, callback)
+        if n:
+            exchange.start(loop)
+        start = time.perf_counter()
+        for (i, order) in enumerate(orders):
+            await exchange.open_order(*order)
+            if n and i % 1000 == 0:
+                await asyncio.sleep(0)  # let the batch go to the workers
+        if n:
+            await exchange.sync()
+        results[n] = num_orders / (time.perf_counter() - start)
+        if n:
+            exchange.stop(loop)
+        print("%d workers: %9.0f orders/s, %d traded" % (n, results[n], exchange.stats["traded"]))
+    return results
+
+
+async def datastream_benchmark(host="localhost", port=0, subscribers=(1, 10, 100, 1000), events=10000):
+    """
+    Measures how fast datastream reports get delivered to all subscribers.
+    :param port: port of the datastream server started by the benchmark, any free port if 0
+    :return: dict mapping number of subscribers to events per second delivered to every subscriber
+    """
+    exchange = Exchange()
+    server = DatastreamServer(host, port, exchange)
+    listener = await asyncio.start_server(server._accept_client, host, port)
+    port = listener.sockets[0].getsockname()[1]
+
+    async def subscriber(reader):
+        while json.loads((await reader.readline()).decode())["type"] != "snapshotEnd":
+            pass
+        for _ in range(events):
+            await reader.readline()
+
+    results = {}
+    try:
+        for n in subscribers:
+            connections = [await asyncio.open_connection(host, port) for _ in range(n)]
+            while len(server.clients) < n:
+                await asyncio.sleep(0.01)
+            readers = [asyncio.ensure_future(subscriber(reader)) for (reader, writer) in connections]
+            start = time.perf_counter()
+            for i in range(events):
+                await server.send_datastream_report("orderbook", "BUY", 0.0, 100 + i % 10, i + 1)
+                if i % 100 == 0:
+                    await asyncio.sleep(0)  # let the reports be flushed and read
+            await asyncio.wait(readers)
+            results[n] = events / (time.perf_counter() - start)
+            print("%4d subscribers: %9.0f events/s" % (n, results[n]))
+            for (reader, writer) in connections:
+                writer.close()
+            while server.clients:
+                await asyncio.sleep(0.01)
+    finally:
+        listener.close()
+    return results
+
+
+async def join_benchmark(host="localhost", levels=(1000, 10000, 100000)):
+    """
+    Measures how long it takes a datastream client to get the snapshot of a book with the given number of levels on
+    each side when it connects, and the longest time the event loop was blocked by making the snapshot.
+    :return: dict mapping number of levels to (seconds until the end of the snapshot, longest blocking in seconds)
+    """
+    results = {}
+    for count in levels:
+        exchange = Exchange()
+        server = DatastreamServer(host, 0, exchange)
+        exchange.add_event_handler(server.handle_events)
+        for i in range(count):
+            exchange.publish(exchange.open_order_events("b%d" % i, 0, "BUY", 10**6 - i, 10))
+            exchange.publish(exchange.open_order_events("s%d" % i, 0, "SELL", 10**6 + 1 + i, 10))
+        listener = await asyncio.start_server(server._accept_client, host, 0)
+        port = listener.sockets[0].getsockname()[1]
+        blocked = []
+
+        def timed(function):
+            def wrapper(*args):
+                start = time.perf_counter()
+                function(*args)
+                blocked.append(time.perf_counter() - start)
+            return wrapper
+
+        server._client_connected = timed(server._client_connected)
+        server._send_book_snapshot = timed(server._send_book_snapshot)
+        try:
+            start = time.perf_counter()
+            (reader, writer) = await asyncio.open_connection(host, port)
+            received = 0
+            while True:
+                message = json.loads((await reader.readline()).decode())
+                if message["type"] == "snapshotEnd":
+                    break
+                received += len(message["levels"])
+            results[count] = (time.perf_counter() - start, max(blocked))
+            assert received == 2 * count
+            writer.close()
+        finally:
+            listener.close()
+        print("%6d levels per side: snapshot received in %.1f ms, event loop blocked at most %.2f ms" % (
+            count, results[count][0] * 1000, results[count][1] * 1000))
+    return results
+
+
+async def sharedbook_benchmark(book_classes=(Book, LevelBook), levels=(1000, 100000), depth=10, updates=2000,
+                               reads=100000):
+    """
+    Measures how long it takes to match an order joining the top of a book and to write the book by SharedBookPublisher,
+    and how long SharedBookReader takes to read the best bid and ask and all published levels.
+    :return: dict mapping (book class name, number of levels per side) to dict of latencies in microseconds
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for book_class in book_classes:
+            for count in levels:
+                exchange = Exchange(book_class)
+                for i in range(count):
+                    exchange.open_order_events("b%d" % i, 0, "BUY", 10**6 - i, 10)
+                    exchange.open_order_events("s%d" % i, 0, "SELL", 10**6 + 1 + i, 10)
+                publisher = SharedBookPublisher(os.path.join(directory, "book"), exchange, depth)
+                exchange.add_event_handler(publisher.handle_events)
+                reader = SharedBookReader(publisher.path)
+                result = results[(book_class.__name__, count)] = {}
+                start = time.perf_counter()
+                for i in range(updates):
+                    exchange.publish(exchange.open_order_events("u%d" % i, 1, "BUY", 10**6 - i % depth, 1))
+                    publisher.write()
+                result["write"] = (time.perf_counter() - start) / updates * 10**6
+                await asyncio.sleep(0)
+                start = time.perf_counter()
+                for i in range(reads):
+                    reader.best()
+                result["best"] = (time.perf_counter() - start) / reads * 10**6
+                start = time.perf_counter()
+                for i in range(reads):
+                    reader.levels()
+                result["levels"] = (time.perf_counter() - start) / reads * 10**6
+                assert reader.best() == ((10**6, 10 + (updates + depth - 1) // depth), (10**6 + 1, 10))
+                reader.close()
+                publisher.close()
+                print("%-9s %6d levels per side, depth %d: %s" % (book_class.__name__, count, depth, ", ".join(
+                    "%s %.2f us" % (name, latency) for (name, latency) in result.items())))
+    return results
+
+
+async def _protocol_client(host, port, use_binary, num_orders, window):
+    """
+    Sends orders in windows of the given size and measures latency of their NEW reports.
+    :return: (orders per second, list of latencies in seconds)
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    if use_binary:
+        writer.write(binary.MAGIC)
+    rnd = random.Random(0)
+    latencies = []
+    start = time.perf_counter()
+    try:
+        for first in range(0, num_orders, window):
+            sent = time.perf_counter()
+            for orderid in range(first, min(first + window, num_orders)):
+                side = rnd.choice(['BUY', 'SELL'])
+                price = int(rnd.gauss(100, 10))
+                quantity = int(rnd.gauss(100, 10))
+                if use_binary:
+                    writer.write(binary.pack_create_order(orderid, side, price, quantity))
+                else:
+                    writer.write(json.dumps({'message': 'createOrder', 'orderId': orderid, 'side': side,
+                                             'price': str(price), 'quantity': quantity}).encode() + b'\n')
+            acked = first
+            while acked < min(first + window, num_orders):
+                if use_binary:
+                    (length,) = binary.HEADER.unpack(await reader.readexactly(binary.HEADER.size))
+                    report = binary.unpack_response(await reader.readexactly(length))[2]
+                else:
+                    report = json.loads((await reader.readline()).decode())['report']
+                if report == 'NEW':
+                    acked += 1
+                    latencies.append(time.perf_counter() - sent)
+        return num_orders / (time.perf_counter() - start), latencies
+    finally:
+        writer.close()
+
+
+async def protocol_benchmark(host, port, num_orders=20000, window=100):
+    """
+    Compares throughput and latency of JSON and binary protocols of the order channel.
+    :return: dict mapping protocol name to (orders per second, p99 latency in milliseconds)
+    """
+    results = {}
+    for (name, use_binary) in [("json", False), ("binary", True)]:
+        (rate, latencies) = await _protocol_client(host, port, use_binary, num_orders, window)
+        latencies.sort()
+        results[name] = (rate, latencies[int(len(latencies) * 0.99)] * 1000)
+        print("%-6s %9.0f orders/s, p99 latency %.3f ms" % ((name,) + results[name]))
+    return results
+
+
+async def _latency_client(host, port, num_orders, window, ack, fill):
+    # Alternately sends a BUY order, which rests in the book, and a SELL order crossing it.
+    (reader, writer) = await asyncio.open_connection(host, port)
+    sent = {}
+    (next_order, acked, filled) = (0, 0, 0)
+    try:
+        while acked < num_orders or filled < num_orders // 2:
+            while next_order < num_orders and next_order - acked < window:
+                side = "BUY" if next_order % 2 == 0 else "SELL"
+                sent[next_order] = time.perf_counter()
+                writer.write(json.dumps({'message': 'createOrder', 'orderId': next_order, 'side': side,
+                                         'price': "101" if side == "BUY" else "100", 'quantity': 10}).encode() + b'\n')
+                next_order += 1
+            report = json.loads((await reader.readline()).decode())
+            if report.get('report') == 'NEW':
+                ack.record((time.perf_counter() - sent[report['orderId']]) * 1e9)
+                acked += 1
+            elif report.get('report') == 'FILL' and report['orderId'] % 2:
+                fill.record((time.perf_counter() - sent[report['orderId']]) * 1e9)
+                filled += 1
+            elif report.get('message') == 'error':
+                raise Exception(report['reason'])
+    finally:
+        writer.close()
+
+
+async def latency_benchmark(host, port, num_orders=10000, clients=1, window=1):
+    """
+    Measures end-to-end latency of the order channel. Every client alternately sends a BUY order, which rests in the
+    book, and a SELL order crossing it, keeping at most window orders without the NEW report.
+    :return: dict with "orders/s", and Histograms of order->NEW report ("ack") and SELL order->FILL report ("fill")
+    latencies in nanoseconds
+    """
+    (ack, fill) = (Histogram(), Histogram())
+    start = time.perf_counter()
+    await asyncio.gather(*[_latency_client(host, port, num_orders // clients, window, ack, fill)
+                           for _ in range(clients)])
+    rate = ack.count / (time.perf_counter() - start)
+    print("%3d clients, window %3d: %9.0f orders/s, ack p50 %.1f us, p99 %.1f us, p99.9 %.1f us, "
+          "fill p99 %.1f us" % (clients, window, rate, ack.percentile(50) / 1000, ack.percentile(99) / 1000,
+                                ack.percentile(99.9) / 1000, fill.percentile(99) / 1000))
+    return {"orders/s": rate, "ack": ack, "fill": fill}
+
+
+async def pipeline_benchmark(host, port, num_orders=50000):
+    """
+    Sends all orders at once through a single connection and waits for their NEW reports.
+    :return: orders per second
+    """
+    rnd = random.Random(0)
+    data = b"".join(json.dumps({'message': 'createOrder', 'orderId': i, 'side': rnd.choice(['BUY', 'SELL']),
+                                'price': str(int(rnd.gauss(100, 10))), 'quantity': 10}).encode() + b'\n'
+                    for i in range(num_orders))
+    reader, writer = await asyncio.open_connection(host, port)
+    start = time.perf_counter()
+    writer.write(data)
+    acked = 0
+    tail = b""
+    try:
+        while acked < num_orders:
+            chunk = tail + await reader.read(1 << 20)
+            acked += chunk.count(b"NEW")
+            tail = chunk[-2:]  # a report may be split between chunks
+    finally:
+        writer.close()
+    rate = num_orders / (time.perf_counter() - start)
+    print("Pipelined: %9.0f orders/s" % rate)
+    return rate
+
+
+async def _order_server_benchmark(host, num_orders, metrics=None):
+    """
+    Starts an order server in the current event loop and measures its throughput and latency.
+    :return: dict with "pipelined" orders/s and "ack" Histogram of a single client
+    """
+    exchange = Exchange(LevelBook, [Instrument(tick_size="1")])
+    server = OrderServer(host, 0, exchange)
+    exchange.add_event_handler(server.handle_events)
+    if metrics is not None:
+        exchange.register_metrics(metrics)
+        server.register_metrics(metrics)
+    server.server = await server._listen(asyncio.get_event_loop())
+    port = server.server.sockets[0].getsockname()[1]
+    try:
+        # latency first, its orders cross each other only in an empty book
+        ack = (await latency_benchmark(host, port, num_orders // 10))["ack"]
+        return {"pipelined": await pipeline_benchmark(host, port, num_orders), "ack": ack}
+    finally:
+        server.server.close()
+        await server.server.wait_closed()
+
+
+def _merge(results, name, result):
+    merged = results.setdefault(name, {"pipelined": 0, "ack": Histogram()})
+    merged["pipelined"] = max(merged["pipelined"], result["pipelined"])
+    merged["ack"].merge(result["ack"])
+
+
+def _print_server_results(title, results):
+    for (name, result) in sorted(results.items()):
+        print("%s %-7s: %9.0f orders/s pipelined, ack p50 %.1f us, p99 %.1f us" % (
+            title, name, result["pipelined"], result["ack"].percentile(50) / 1000, result["ack"].percentile(99) / 1000))
+
+
+async def metrics_benchmark(host="localhost", num_orders=50000, repeat=3):
+    """
+    Compares throughput and latency of an order server with and without metrics.
+    :return: dict mapping "off" and "on" to dicts with "pipelined" orders/s and "ack" Histogram of a single client
+    """
+    results = {}
+    for enabled in [False, True] * repeat:
+        _merge(results, "on" if enabled else "off",
+               await _order_server_benchmark(host, num_orders, Metrics() if enabled else None))
+    _print_server_results("Metrics", results)
+    return results
+
+
+def loop_benchmark(host="localhost", num_orders=50000, repeat=3):
+    """
+    Compares throughput and latency of an order server running in the event loop of the standard library and in
+    uvloop, if it is installed. Has to be called outside of a running event loop.
+    :return: dict mapping "asyncio" and "uvloop" to dicts with "pipelined" orders/s and "ack" Histogram of a single
+    client
+    """
+    results = {}
+    for implementation in ["asyncio", "uvloop"] * repeat:
+        if implementation == "uvloop" and uvloop is None:
+            continue
+        loop = new_event_loop(implementation)
+        try:
+            _merge(results, implementation, loop.run_until_complete(_order_server_benchmark(host, num_orders)))
+        finally:
+            loop.close()
+    if uvloop is None:
+        print("uvloop is not installed, only the asyncio loop was measured.")
+    _print_server_results("Loop", results)
+    return results
+
+
 async def main():
-    if len(sys.argv) != 3 and len(sys.argv) != 4:
-        exit('Usage: benchmark.py hostname port [net]')
+    if len(sys.argv) == 2 and sys.argv[1] == 'cancel':
+        cancel_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'masscancel':
+        mass_cancel_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'amend':
+        amend_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'books':
+        book_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'exchange':
+        await exchange_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'journal':
+        journal_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'snapshot':
+        snapshot_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'replay':
+        replay_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'memory':
+        memory_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'sharding':
+        await sharding_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'datastream':
+        await datastream_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'join':
+        await join_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'sharedbook':
+        await sharedbook_benchmark()
+        return
+    if len(sys.argv) == 2 and sys.argv[1] == 'metrics':
+        await metrics_benchmark()
+        return
+    if len(sys.argv) not in [3, 4, 5]:
+        exit('Usage: benchmark.py hostname port [net | protocols | pipeline | symbols SYMBOL,...] | '
+             'benchmark.py cancel | benchmark.py masscancel | benchmark.py amend | benchmark.py books | '
+             'benchmark.py exchange | benchmark.py journal | benchmark.py snapshot | benchmark.py replay | '
+             'benchmark.py memory | benchmark.py sharding | benchmark.py datastream | benchmark.py join | '
+             'benchmark.py sharedbook | benchmark.py metrics | benchmark.py loops')
     host = sys.argv[1]
     port = int(sys.argv[2])
     if len(sys.argv) == 4 and sys.argv[3] == 'net':
         await network_benchmark(host, port)
+    elif len(sys.argv) == 4 and sys.argv[3] == 'protocols':
+        await protocol_benchmark(host, port)
+    elif len(sys.argv) == 4 and sys.argv[3] == 'pipeline':
+        await pipeline_benchmark(host, port)
+    elif len(sys.argv) == 5 and sys.argv[3] == 'symbols':
+        await benchmark(host, port, symbols=sys.argv[4].split(","))
     else:
         await benchmark(host, port)
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    if sys.argv[1:] == ['loops']:
+        loop_benchmark()  # runs its own event loops
+    else:
+        loop = new_event_loop("asyncio")
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(main())
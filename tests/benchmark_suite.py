@@ -0,0 +1,142 @@
+#!/usr/bin/env python3.5
+#
+# Benchmark suite producing machine-readable results, which can be compared against a stored baseline.
+
+import asyncio
+import json
+import platform
+import sys
+import time
+
+from exchange.exchange import Exchange
+from exchange.instrument import Instrument
+from exchange.levelbook import LevelBook
+from exchange.server import OrderServer, DatastreamServer, new_event_loop
+from tests import benchmark
+
+BASELINE = "tests/benchmark_baseline.json"
+PERCENTILES = [("p50", 50), ("p99", 99), ("p999", 99.9)]
+
+
+def _throughput(results, name, value, unit):
+    results[name] = {"value": round(value, 1), "unit": unit, "better": "higher"}
+
+
+def _latency(results, name, histogram):
+    for (suffix, percentile) in PERCENTILES:
+        results["%s.%s" % (name, suffix)] = {"value": round(histogram.percentile(percentile) / 1000, 2),
+                                             "unit": "us", "better": "lower"}
+
+
+def _end_to_end(results, quick):
+    loop = asyncio.get_event_loop()
+    e = Exchange(LevelBook, [Instrument(tick_size="1")])
+    order_server = OrderServer("localhost", 0, e)
+    datastream_server = DatastreamServer("localhost", 0, e)
+    e.add_event_handler(order_server.handle_events)
+    e.add_event_handler(datastream_server.handle_events)
+    order_server.start(loop)
+    datastream_server.start(loop)
+    try:
+        single = loop.run_until_complete(benchmark.latency_benchmark("localhost", order_server.port,
+                                                                     2000 if quick else 20000))
+        _latency(results, "e2e.ack", single["ack"])
+        _latency(results, "e2e.fill", single["fill"])
+        clients = 4 if quick else 16
+        load = loop.run_until_complete(benchmark.latency_benchmark("localhost", order_server.port,
+                                                                   2000 if quick else 50000, clients, 10))
+        _throughput(results, "e2e.clients_%d.throughput" % clients, load["orders/s"], "orders/s")
+        _latency(results, "e2e.clients_%d.ack" % clients, load["ack"])
+    finally:
+        order_server.stop(loop)
+        datastream_server.stop(loop)
+
+
+def run_suite(quick: bool = False) -> dict:
+    """
+    Runs all benchmarks of the suite. Quick mode uses small sizes, it only checks that the suite works.
+    :return: dict with "machine" description and "results" mapping benchmark name to dict with "value", "unit" and
+    whether "higher" or "lower" values are "better"
+    """
+    results = {}
+    loop = asyncio.get_event_loop()
+
+    latencies = benchmark.book_latency_benchmark(depths=(1000,) if quick else (1000, 100000),
+                                                 operations=200 if quick else 5000)
+    for ((book, depth, operation), histogram) in sorted(latencies.items()):
+        _latency(results, "book.%s.depth_%d.%s" % (book, depth, operation), histogram)
+    for (book, rate) in benchmark.book_benchmark(num_orders=2000 if quick else 100000).items():
+        _throughput(results, "book.%s.flow" % book, rate, "msgs/s")
+    for (api, rate) in loop.run_until_complete(benchmark.exchange_benchmark(2000 if quick else 100000)).items():
+        _throughput(results, "exchange.%s" % api, rate, "msgs/s")
+
+    _end_to_end(results, quick)
+    for (implementation, result) in benchmark.loop_benchmark(num_orders=2000 if quick else 50000,
+                                                             repeat=1 if quick else 3).items():
+        _throughput(results, "loop.%s.pipelined" % implementation, result["pipelined"], "orders/s")
+        _latency(results, "loop.%s.ack" % implementation, result["ack"])
+
+    fanout = loop.run_until_complete(benchmark.datastream_benchmark(
+        subscribers=(1, 10) if quick else (1, 100), events=500 if quick else 10000))
+    for (subscribers, rate) in fanout.items():
+        _throughput(results, "datastream.subscribers_%d" % subscribers, rate, "events/s")
+
+    return {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "processor": platform.processor()},
+        "time": time.time(),
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """
+    :param current: results of run_suite
+    :param baseline: stored results of run_suite
+    :param tolerance: allowed relative change to the worse
+    :return: list of (name, baseline value, current value, relative change) of regressed benchmarks
+    """
+    regressions = []
+    for (name, result) in sorted(current["results"].items()):
+        base = baseline["results"].get(name)
+        if not base or not base["value"]:
+            continue
+        change = (result["value"] - base["value"]) / base["value"]
+        worse = -change if result["better"] == "higher" else change
+        if worse > tolerance:
+            regressions.append((name, base["value"], result["value"], change))
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 4 or (len(sys.argv) > 1 and sys.argv[1] in ["-h", "--help"]):
+        exit("Usage: benchmark_suite.py [OUTPUT.json [BASELINE.json [TOLERANCE]]]\n"
+             "Runs all benchmarks, writes results to OUTPUT.json (stdout if '-') and compares them with "
+             "BASELINE.json (default %s). Exits with status 1 on regressions larger than TOLERANCE "
+             "(default 0.2)." % BASELINE)
+    asyncio.set_event_loop(new_event_loop("asyncio"))
+    current = run_suite()
+    output = json.dumps(current, indent=2, sort_keys=True)
+    if len(sys.argv) > 1 and sys.argv[1] != "-":
+        with open(sys.argv[1], "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    try:
+        with open(sys.argv[2] if len(sys.argv) > 2 else BASELINE) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        print("No baseline to compare with.", file=sys.stderr)
+        return
+    if baseline["machine"] != current["machine"]:
+        print("Warning: the baseline was measured on another machine: %s" % baseline["machine"], file=sys.stderr)
+    regressions = compare(current, baseline, float(sys.argv[3]) if len(sys.argv) > 3 else 0.2)
+    for (name, base, value, change) in regressions:
+        print("REGRESSION %s: %s -> %s (%+.0f %%)" % (name, base, value, change * 100), file=sys.stderr)
+    if regressions:
+        exit(1)
+    print("No regressions against the baseline.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
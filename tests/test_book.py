@@ -0,0 +1,272 @@
+from unittest import TestCase
+import io
+
+from exchange.book import Book
+from exchange.levelbook import LevelBook
+from exchange.order import Order, Fill
+from tests import benchmark
+
+
+class TestBook(TestCase):
+
+    def test_remove_order(self):
+        b = Book()
+        b.open_order(Order("1", 0, "BUY", 100, 10))
+        b.open_order(Order("2", 0, "BUY", 101, 20))
+        b.open_order(Order("1", 1, "BUY", 99, 30))
+        order = b.remove_order(0, "2")
+        self.assertEqual(order.qty, 20)
+        self.assertEqual(b.get_order_count("BUY"), 2)
+        self.assertEqual(b.get_price_qty("BUY", 101), 0)
+        self.assertEqual(b._bid[0].price, 100, "Cancelled order left on top of the heap")
+        with self.assertRaises(KeyError):
+            b.remove_order(0, "2")
+
+    def test_cancelled_order_not_matched(self):
+        b = Book()
+        b.open_order(Order("1", 0, "SELL", 100, 10))
+        b.open_order(Order("2", 0, "SELL", 101, 10))
+        b.open_order(Order("3", 0, "SELL", 102, 10))
+        b.remove_order(0, "2")
+        (order, filled) = b.open_order(Order("4", 1, "BUY", 103, 30))
+        self.assertEqual([o.id for o in filled], ["1", "3"])
+        self.assertEqual(order.qty, 10)
+        self.assertEqual(b.get_order_count("SELL"), 0)
+        self.assertEqual(b.get_order_count("BUY"), 1)
+
+    def test_filled_order_cannot_be_cancelled(self):
+        b = Book()
+        b.open_order(Order("1", 0, "SELL", 100, 10))
+        b.open_order(Order("2", 1, "BUY", 101, 10))
+        with self.assertRaises(KeyError):
+            b.remove_order(0, "1")
+
+    def test_tombstones_compacted(self):
+        b = Book()
+        for i in range(1000):
+            b.open_order(Order(str(i), 0, "BUY", i, 10))
+        for i in range(900):
+            b.remove_order(0, str(i))
+        self.assertEqual(b.get_order_count("BUY"), 100)
+        self.assertLess(len(b._bid), 300, "Cancelled orders were never dropped from the heap")
+
+    def test_fill_records(self):
+        b = Book()
+        resting = Order("1", 0, "SELL", 100, 10)
+        b.open_order(resting)
+        (order, filled) = b.open_order(Order("2", 1, "BUY", 101, 4))
+        self.assertEqual(filled, [Fill("1", 0, "SELL", 100, 4, 101)])
+        self.assertEqual(resting.qty, 6)
+        self.assertLess(resting.seq, order.seq)
+        self.assertFalse(hasattr(resting, "__dict__"), "Order should use __slots__")
+
+    def test_duplicate_order_id(self):
+        b = Book()
+        b.open_order(Order("1", 0, "BUY", 100, 10))
+        with self.assertRaises(ValueError):
+            b.open_order(Order("1", 0, "BUY", 101, 20))
+        self.assertEqual(b.get_price_qty("BUY", 101), 0)
+        b.open_order(Order("1", 1, "BUY", 101, 20))  # ids are unique per client
+        self.assertEqual(b.remove_order(0, "1").price, 100)
+        self.assertEqual(b.get_order_count("BUY"), 1)
+        b.open_order(Order("1", 0, "BUY", 99, 5))  # the id is free again after the cancel
+        self.assertEqual(b.remove_order(0, "1").price, 99)
+
+    def test_cancel_benchmark(self):
+        results = benchmark.cancel_benchmark((1000, 50000), 500)
+        self.assertLess(results[50000], 10 * results[1000], "Cancel latency grows with book depth")
+
+    def test_amend_benchmark(self):
+        results = benchmark.amend_benchmark(depths=(1000,), amends=500)
+        for name in ["Book", "LevelBook"]:
+            self.assertEqual(sorted(results[(name, 1000)]), ["cancel+open", "price", "qty"])
+
+    def test_mass_cancel_benchmark(self):
+        results = benchmark.mass_cancel_benchmark(depths=(1000, 50000), repeat=5)
+        for name in ["Book", "LevelBook"]:
+            self.assertLess(results[(name, 50000)][0], 10 * results[(name, 1000)][0],
+                            "Mass cancel latency grows with book depth")
+
+
+class TestLevelBook(TestCase):
+
+    def test_price_time_priority(self):
+        b = LevelBook()
+        b.open_order(Order("1", 0, "SELL", 101, 10))
+        b.open_order(Order("2", 0, "SELL", 100, 10))
+        b.open_order(Order("3", 1, "SELL", 100, 10))
+        self.assertEqual(b.get_best("SELL").price, 100)
+        self.assertEqual(b.get_price_qty("SELL", 100), 20)
+        (order, filled) = b.open_order(Order("4", 2, "BUY", 102, 25))
+        self.assertEqual([(o.id, o.qty) for o in filled], [("2", 10), ("3", 10), ("1", 5)])
+        self.assertEqual(order.qty, 0)
+        self.assertEqual(b.get_price_qty("SELL", 101), 5)
+        self.assertIsNone(b.get_best("BUY"))
+
+    def test_remove_order(self):
+        b = LevelBook()
+        b.open_order(Order("1", 0, "BUY", 100, 10))
+        b.open_order(Order("2", 0, "BUY", 101, 20))
+        b.remove_order(0, "2")
+        self.assertEqual(b.get_best("BUY").price, 100)
+        self.assertEqual(b.get_order_count("BUY"), 1)
+        b.remove_order(0, "1")
+        self.assertIsNone(b.get_best("BUY"))
+        with self.assertRaises(KeyError):
+            b.remove_order(0, "1")
+
+    def test_duplicate_order_id(self):
+        b = LevelBook()
+        b.open_order(Order("1", 0, "BUY", 100, 10))
+        with self.assertRaises(ValueError):
+            b.open_order(Order("1", 0, "SELL", 90, 20))
+        self.assertEqual(b.get_price_qty("BUY", 100), 10, "Rejected order traded")
+        b.open_order(Order("1", 1, "BUY", 101, 20))
+        self.assertEqual(b.remove_order(0, "1").price, 100)
+        self.assertEqual(b.get_order_count("BUY"), 1)
+        b.open_order(Order("1", 0, "BUY", 99, 5))
+        self.assertEqual(b.remove_order(0, "1").price, 99)
+
+    def test_aggressor_not_pushed(self):
+        b = Book()
+        b.open_order(Order("1", 0, "SELL", 100, 10))
+        (order, filled) = b.open_order(Order("2", 1, "BUY", 101, 10))
+        self.assertEqual(order.qty, 0)
+        self.assertEqual(len(b._bid), 0)
+        self.assertEqual(len(b._ask), 0)
+        self.assertEqual(b._order_by_price_idx, {})
+        self.assertEqual(b._orders_by_client, {})
+        (order, filled) = b.open_order(Order("3", 1, "BUY", 101, 10))
+        self.assertEqual(filled, [])
+        self.assertEqual(b.get_price_qty("BUY", 101), 10)
+
+    def test_order_types(self):
+        for book_class in [Book, LevelBook]:
+            b = book_class()
+            b.open_order(Order("1", 0, "SELL", 100, 10))
+            b.open_order(Order("2", 0, "SELL", 102, 10))
+            b.open_order(Order("3", 0, "SELL", 105, 10))
+
+            # IOC trades up to its limit price and its remainder does not rest
+            (order, filled) = b.open_order(Order("4", 1, "BUY", 101, 15), "IOC")
+            self.assertEqual([(f.id, f.qty, f.price_traded) for f in filled], [("1", 10, 101)])
+            self.assertEqual(order.qty, 5)
+            self.assertEqual(b.get_order_count("BUY"), 0)
+
+            # FOK is killed without trading if there is not enough qty at matching prices
+            (order, filled) = b.open_order(Order("5", 1, "BUY", 103, 11), "FOK")
+            self.assertEqual((order.qty, filled), (11, []))
+            self.assertEqual(b.get_price_qty("SELL", 102), 10)
+            (order, filled) = b.open_order(Order("6", 1, "BUY", 106, 15), "FOK")
+            self.assertEqual([(f.id, f.qty) for f in filled], [("2", 10), ("3", 5)])
+            self.assertEqual(order.qty, 0)
+
+            # MARKET trades at prices of the resting orders regardless of its own
+            (order, filled) = b.open_order(Order("7", 1, "BUY", None, 10), "MARKET")
+            self.assertEqual([(f.id, f.qty, f.price_traded) for f in filled], [("3", 5, 105)])
+            self.assertEqual(order.qty, 5)
+            for side in ["BUY", "SELL"]:
+                self.assertEqual(b.get_order_count(side), 0)
+                self.assertEqual(b.get_depth(side, 10), [])
+            with self.assertRaises(AssertionError):
+                b.open_order(Order("8", 1, "BUY", 100, 10), "GTC")
+
+    def test_remove_client_orders(self):
+        for book_class in [Book, LevelBook]:
+            b = book_class()
+            for (n, (side, price)) in enumerate([("BUY", 100), ("BUY", 99), ("BUY", 99), ("SELL", 102), ("SELL", 105)]):
+                b.open_order(Order(str(n), 0, side, price, 10))
+            b.open_order(Order("0", 1, "BUY", 99, 5))
+            removed = b.remove_client_orders(0, "BUY", max_price=99)
+            self.assertEqual([order.id for order in removed], ["1", "2"])
+            self.assertEqual(b.get_price_qty("BUY", 99), 5)
+            removed = b.remove_client_orders(0, min_price=101, max_price=104)
+            self.assertEqual([order.id for order in removed], ["3"])
+            self.assertEqual([order.id for order in b.remove_client_orders(0)], ["0", "4"])
+            self.assertEqual(b.remove_client_orders(0), [])
+            self.assertEqual(b.get_depth("BUY", 10), [(99, 5)])
+            self.assertEqual(b.get_depth("SELL", 10), [])
+            self.assertEqual(b.get_order_count("BUY"), 1)
+            with self.assertRaises(KeyError):
+                b.remove_order(0, "0")
+
+    def test_modify_order(self):
+        for book_class in [Book, LevelBook]:
+            b = book_class()
+            b.open_order(Order("1", 0, "SELL", 100, 10))
+            b.open_order(Order("2", 1, "SELL", 100, 10))
+            b.open_order(Order("3", 1, "SELL", 101, 10))
+
+            # reduced qty keeps the priority and the same Order object
+            original = b.get_order(0, "1")
+            (order, filled) = b.modify_order(0, "1", qty=4)
+            self.assertIs(order, original)
+            self.assertEqual((order.qty, filled), (4, []))
+            self.assertEqual(b.get_price_qty("SELL", 100), 14)
+            (order, filled) = b.open_order(Order("4", 2, "BUY", 101, 5))
+            self.assertEqual([(f.id, f.qty) for f in filled], [("1", 4), ("2", 1)])
+
+            # increased qty re-queues the order behind the others at its price
+            b.open_order(Order("5", 0, "SELL", 100, 1))
+            (order, filled) = b.modify_order(1, "2", qty=20)
+            self.assertIsNot(order, original)
+            self.assertEqual(b.get_price_qty("SELL", 100), 21)
+            (order, filled) = b.open_order(Order("6", 2, "BUY", 101, 2))
+            self.assertEqual([(f.id, f.qty) for f in filled], [("5", 1), ("2", 1)])
+
+            # new price crossing the book trades at once and only the remainder rests
+            b.open_order(Order("7", 2, "BUY", 99, 5))
+            (order, filled) = b.modify_order(1, "3", price=98, qty=8)
+            self.assertEqual([(f.id, f.qty, f.price_traded) for f in filled], [("7", 5, 99)])
+            self.assertEqual(order.qty, 3)
+            self.assertEqual(b.get_depth("SELL", 10), [(98, 3), (100, 19)])
+            self.assertEqual(b.get_order_count("SELL"), 2)
+            self.assertEqual(b.get_depth("BUY", 10), [])
+            with self.assertRaises(KeyError):
+                b.modify_order(2, "7", qty=1)
+            with self.assertRaises(AssertionError):
+                b.modify_order(1, "3", qty=0)
+
+    def test_same_fills_as_heap_book(self):
+        flow = benchmark.generate_order_flow(5000, seed=42)
+        books = (Book(), LevelBook())
+        for item in flow:
+            if item[0] == "open":
+                results = [b.open_order(Order(*item[1:])) for b in books]
+                self.assertEqual(*[[(o.id, o.qty, o.price_traded) for o in filled] for (order, filled) in results])
+                self.assertEqual(*[order.qty for (order, filled) in results])
+            else:
+                removed = []
+                for b in books:
+                    try:
+                        removed.append(b.remove_order(item[1], item[2]).qty)
+                    except KeyError:
+                        removed.append(None)
+                self.assertEqual(*removed)
+        for side in ["BUY", "SELL"]:
+            self.assertEqual(*[b.get_order_count(side) for b in books])
+
+    def test_snapshot(self):
+        flow = benchmark.generate_order_flow(4000, seed=7)
+        for (dumped_class, loaded_class) in [(Book, LevelBook), (LevelBook, Book), (LevelBook, LevelBook)]:
+            original = dumped_class()
+            benchmark.run_order_flow(original, flow[:2000])
+            file = io.BytesIO()
+            original.dump(file)
+            file.seek(0)
+            loaded = loaded_class.load(file)
+            for side in ["BUY", "SELL"]:
+                self.assertEqual(loaded.get_depth(side, 1000), original.get_depth(side, 1000))
+                self.assertEqual(loaded.get_order_count(side), original.get_order_count(side))
+            # Both books have to match the rest of the flow in the same way.
+            fills = [[], []]
+            for item in flow[2000:]:
+                for (n, b) in enumerate([original, loaded]):
+                    if item[0] == "open":
+                        fills[n].append([(f.id, f.qty) for f in b.open_order(Order(*item[1:]))[1]])
+                    else:
+                        try:
+                            fills[n].append(b.remove_order(item[1], item[2]).qty)
+                        except KeyError:
+                            fills[n].append(None)
+            self.assertEqual(*fills)
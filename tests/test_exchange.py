@@ -1,8 +1,12 @@
 from unittest import TestCase
 import asyncio
 from decimal import Decimal
+from unittest.mock import ANY
 
 from exchange import exchange
+from exchange.sharding import ShardedExchange
+from exchange.instrument import Instrument
+from tests import benchmark
 
 
 class TestExchange(TestCase):
@@ -20,12 +24,12 @@ class TestExchange(TestCase):
             e.open_order("123", 0, "BUY", Decimal(150), 200),
             e.open_order("234", 1, "SELL", Decimal(149), 100),
         ]
-        loop.run_until_complete(asyncio.wait(tasks))
+        loop.run_until_complete(asyncio.gather(*tasks))
 
-        self.assertTrue(len(e.book._bid) == 1, "Bid order missing")
-        self.assertTrue(len(e.book._ask) == 0, "Ask table not cleaned")
-        self.assertEqual(e.book._bid[0].price, Decimal(150), "Bid order has wrong price")
-        self.assertEqual(e.book._bid[0].qty, 100, "Bid order has wrong qty")
+        self.assertTrue(len(e.get_book()._bid) == 1, "Bid order missing")
+        self.assertTrue(len(e.get_book()._ask) == 0, "Ask table not cleaned")
+        self.assertEqual(e.get_book()._bid[0].price, Decimal(150), "Bid order has wrong price")
+        self.assertEqual(e.get_book()._bid[0].qty, 100, "Bid order has wrong qty")
 
     def test_sell_order_price_not_changed(self):
         loop = asyncio.get_event_loop()
@@ -34,10 +38,10 @@ class TestExchange(TestCase):
             e.open_order("123", 0, "BUY", Decimal(150), 100),
             e.open_order("124", 1, "SELL", Decimal(149), 200),
         ]
-        loop.run_until_complete(asyncio.wait(tasks))
+        loop.run_until_complete(asyncio.gather(*tasks))
 
-        self.assertEqual(e.book._ask[0].price, Decimal(149), "Ask order price changed after filling")
-        self.assertEqual(e.book._ask[0].qty, 100, "Sell order has wrong price")
+        self.assertEqual(e.get_book()._ask[0].price, Decimal(149), "Ask order price changed after filling")
+        self.assertEqual(e.get_book()._ask[0].qty, 100, "Sell order has wrong price")
 
     def test_decimal(self):
         loop = asyncio.get_event_loop()
@@ -47,16 +51,16 @@ class TestExchange(TestCase):
             e.open_order("124", 0, "BUY", Decimal(1.000003), 200),
             e.open_order("234", 1, "SELL", Decimal(1.000002), 400),
         ]
-        loop.run_until_complete(asyncio.wait(tasks))
-        self.assertEqual(len(e.book._ask), 1)
-        self.assertEqual(len(e.book._bid), 1)
+        loop.run_until_complete(asyncio.gather(*tasks))
+        self.assertEqual(len(e.get_book()._ask), 1)
+        self.assertEqual(len(e.get_book()._bid), 1)
 
     def test_cancel_order(self):
         loop = asyncio.get_event_loop()
         e = exchange.Exchange()
         loop.run_until_complete(e.open_order("123", 0, "BUY", Decimal(150), 200))
         loop.run_until_complete(e.cancel_order(0, "123"))
-        self.assertEqual(len(e.book._bid), 0, "Order was not canceled")
+        self.assertEqual(len(e.get_book()._bid), 0, "Order was not canceled")
 
     def _execute_and_get_reports(self, exchange_obj, tasks):
         loop = asyncio.get_event_loop()
@@ -74,7 +78,7 @@ class TestExchange(TestCase):
         exchange_obj.set_callbacks(fill_callback, datastream_callback)
 
         for t in tasks:  # Run tasks one by one to ensure reports order
-            loop.run_until_complete(asyncio.wait([t]))
+            loop.run_until_complete(t)
 
         return fill_report, datastream_report
 
@@ -87,8 +91,8 @@ class TestExchange(TestCase):
 
         fill_report, datastream_report = self._execute_and_get_reports(e, tasks)
 
-        self.assertIn((1, '334', Decimal('150'), 100), fill_report)
-        self.assertIn((0, '223', Decimal('150'), 100), fill_report)
+        self.assertIn((1, '334', Decimal('150'), 100, ''), fill_report)
+        self.assertIn((0, '223', Decimal('150'), 100, ''), fill_report)
         self.assertEqual(len(fill_report), 2, "Fill callback returned redundant items.")
 
     def test_datastream_callback(self):
@@ -100,10 +104,236 @@ class TestExchange(TestCase):
 
         (fill_report, datastream_report) = self._execute_and_get_reports(e, tasks)
 
-        price_and_qty = [x[3:] for x in datastream_report]  # Ignore type, side and datetime
+        price_and_qty = [x[3:5] for x in datastream_report]  # Ignore type, side, time and symbol
         self.assertListEqual(price_and_qty,
                          [(Decimal('150'), 200),
                          (Decimal('150'), 100),
                          (Decimal('150'), 100)])
 
-    # Future work: implement more tests. Not all funcionality and error cases are covered.
\ No newline at end of file
+    def test_order_type_events(self):
+        e = exchange.Exchange()
+        e.open_order_events("1", 0, "SELL", 100, 10)
+        events = e.open_order_events("2", 1, "BUY", 101, 15, "", "IOC")
+        self.assertEqual(events, [
+            ("new", 1, "2", ""),
+            ("fill", 1, "2", 101, 10, ""),
+            ("fill", 0, "1", 101, 10, ""),
+            ("trade", None, ANY, 101, 10, ""),
+            ("orderbook", "SELL", ANY, 100, 0, ""),
+            ("cancelled", 1, "2", ""),
+        ])
+        self.assertEqual(e.open_order_events("3", 1, "SELL", None, 5, "", "MARKET"),
+                         [("new", 1, "3", ""), ("cancelled", 1, "3", "")])
+        self.assertEqual(e.get_book().get_order_count("BUY"), 0)
+
+    def test_modify_order_events(self):
+        e = exchange.Exchange()
+        e.open_order_events("1", 0, "BUY", 100, 10)
+        e.open_order_events("2", 1, "BUY", 100, 10)
+        e.open_order_events("3", 1, "SELL", 105, 10)
+        self.assertEqual(e.modify_order_events(0, "1", qty=6), [
+            ("modified", 0, "1", ""),
+            ("orderbook", "BUY", ANY, 100, 16, ""),
+        ])
+        self.assertEqual(e.modify_order_events(0, "1", 101), [
+            ("modified", 0, "1", ""),
+            ("orderbook", "BUY", ANY, 101, 6, ""),
+            ("orderbook", "BUY", ANY, 100, 10, ""),
+        ])
+        self.assertEqual(e.modify_order_events(1, "3", 100, 12), [
+            ("modified", 1, "3", ""),
+            ("fill", 1, "3", 101, 6, ""),
+            ("fill", 0, "1", 101, 6, ""),
+            ("trade", None, ANY, 101, 6, ""),
+            ("orderbook", "BUY", ANY, 101, 0, ""),
+            ("orderbook", "SELL", ANY, 100, 6, ""),
+            ("orderbook", "SELL", ANY, 105, 0, ""),
+        ])
+        self.assertEqual(e.stats["traded"], 2)
+        with self.assertRaises(KeyError):
+            e.modify_order_events(0, "1", qty=1)
+
+    def test_cancel_all_events(self):
+        e = exchange.Exchange(instruments=[Instrument("A"), Instrument("B")])
+        e.open_order_events("1", 0, "BUY", 100, 10, "A")
+        e.open_order_events("2", 0, "BUY", 100, 20, "A")
+        e.open_order_events("3", 0, "SELL", 110, 5, "A")
+        e.open_order_events("4", 1, "BUY", 100, 7, "A")
+        e.open_order_events("5", 0, "SELL", 50, 1, "B")
+        self.assertEqual(e.cancel_all_events(0, "A", "BUY"), [
+            ("cancelled", 0, "1", "A"),
+            ("cancelled", 0, "2", "A"),
+            ("cancel", "BUY", ANY, 100, 30, "A"),
+            ("cancelledAll", 0, 2, "A"),
+        ])
+        with self.assertRaises(ValueError):  # a second live order with the same id would escape the cancel below
+            e.open_order_events("3", 0, "SELL", 120, 5, "A")
+        self.assertEqual(e.cancel_all_events(0), [
+            ("cancelled", 0, "3", "A"),
+            ("cancel", "SELL", ANY, 110, 5, "A"),
+            ("cancelled", 0, "5", "B"),
+            ("cancel", "SELL", ANY, 50, 1, "B"),
+            ("cancelledAll", 0, 2, None),
+        ])
+        self.assertEqual(e.get_book("A").get_order_count("SELL"), 0)
+        self.assertEqual(e.cancel_all_events(0), [("cancelledAll", 0, 0, None)])
+        self.assertEqual(e.get_book("A").get_depth("BUY", 10), [(100, 7)])
+        with self.assertRaises(KeyError):
+            e.cancel_all_events(0, "C")
+
+        loop = asyncio.get_event_loop()
+        sharded = ShardedExchange(2, instruments=[Instrument("A"), Instrument("B")])
+        published = []
+        sharded.add_event_handler(published.extend)
+        sharded.start(loop)
+        try:
+            sharded.open_order_events("1", 0, "BUY", 100, 10, "A")
+            sharded.open_order_events("2", 0, "BUY", 101, 10, "B")
+            sharded.open_order_events("3", 1, "BUY", 101, 10, "B")
+            sharded.cancel_all_events(0, min_price=101)
+            sharded.cancel_all_events(0, "A", max_price=99)
+            sharded.cancel_all_events(1)
+            loop.run_until_complete(sharded.sync())
+        finally:
+            sharded.stop(loop)
+        published = [event[:2] + event[3:] if event[0] == "cancel" else event for event in published
+                     if event[0] in ["cancelled", "cancel", "cancelledAll"]]  # without time
+        # workers run in parallel, but the count of all symbols is published after the cancels of all workers
+        self.assertGreater(published.index(("cancelledAll", 0, 1, None)), published.index(("cancelled", 0, "2", "B")))
+        self.assertCountEqual(published, [
+            ("cancelled", 0, "2", "B"),
+            ("cancel", "BUY", 101, 10, "B"),
+            ("cancelledAll", 0, 0, "A"),
+            ("cancelled", 1, "3", "B"),
+            ("cancel", "BUY", 101, 10, "B"),
+            ("cancelledAll", 0, 1, None),
+            ("cancelledAll", 1, 1, None),
+        ])
+
+    def test_instrument_ticks(self):
+        i = Instrument(tick_size="0.01")
+        self.assertEqual(i.to_ticks("150"), 15000)
+        self.assertEqual(i.to_ticks("1.05"), 105)
+        self.assertEqual(i.to_price(15000), "150")
+        self.assertEqual(i.to_price(105), "1.05")
+        with self.assertRaises(ValueError):
+            i.to_ticks("1.005")
+
+    def test_symbols(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument("A"), Instrument("B")])
+        tasks = [
+            e.open_order("1", 0, "BUY", 150, 100, "A"),
+            e.open_order("2", 1, "SELL", 149, 100, "B"),
+            e.open_order("3", 1, "SELL", 149, 40, "A"),
+        ]
+        fill_report, datastream_report = self._execute_and_get_reports(e, tasks)
+        self.assertEqual(sorted(e.books), ["A", "B"])
+        self.assertEqual(e.get_book("A").get_price_qty("BUY", 150), 60)
+        self.assertEqual(e.get_book("B").get_price_qty("SELL", 149), 100)
+        self.assertEqual({x[4] for x in fill_report}, {"A"})
+        self.assertEqual([x[5] for x in datastream_report], ["A", "B", "A", "A"])
+        with self.assertRaises(KeyError):
+            loop.run_until_complete(e.open_order("4", 0, "BUY", 150, 100, "C"))
+        self.assertNotIn("C", e.books)
+        loop.run_until_complete(e.cancel_order(1, "2", "B"))
+        self.assertEqual(e.get_book("B").get_order_count("SELL"), 0)
+
+    def test_order_events(self):
+        e = exchange.Exchange()
+        published = []
+        e.add_event_handler(published.append)
+        self.assertEqual(e.open_order_events("1", 0, "BUY", 150, 200), [("new", 0, "1", ""),
+                                                                        ("orderbook", "BUY", ANY, 150, 200, "")])
+        events = e.open_order_events("2", 1, "SELL", 149, 100)
+        self.assertEqual(events, [
+            ("new", 1, "2", ""),
+            ("fill", 1, "2", 150, 100, ""),
+            ("fill", 0, "1", 150, 100, ""),
+            ("trade", None, ANY, 150, 100, ""),
+            ("orderbook", "BUY", ANY, 150, 100, ""),
+        ])
+        self.assertEqual(e.cancel_order_events(0, "1"), [("cancelled", 0, "1", ""),
+                                                         ("cancel", "BUY", ANY, 150, 100, "")])
+        with self.assertRaises(KeyError):
+            e.cancel_order_events(0, "1")
+        self.assertEqual(published, [], "Events were published without Exchange.publish")
+        e.publish(events)
+        self.assertEqual(published, [events])
+
+    def test_exchange_benchmark(self):
+        results = asyncio.get_event_loop().run_until_complete(benchmark.exchange_benchmark(2000))
+        self.assertEqual(sorted(results), ["callbacks", "events"])
+
+    # Future work: implement more tests. Not all funcionality and error cases are covered.
+
+
+class TestShardedExchange(TestCase):
+
+    def _run(self, exchange_obj, orders):
+        loop = asyncio.get_event_loop()
+        fill_report = []
+        datastream_report = []
+
+        async def fill_callback(*args):
+            fill_report.append(args)
+
+        async def datastream_callback(*args):
+            datastream_report.append(args[:2] + args[3:])  # Ignore time
+
+        async def run():
+            for order in orders:
+                await exchange_obj.open_order(*order)
+            await exchange_obj.cancel_order(0, "0", "B")
+            with self.assertRaises(KeyError):
+                await exchange_obj.cancel_order(0, "0", "B")
+            if isinstance(exchange_obj, ShardedExchange):
+                await exchange_obj.sync()
+
+        exchange_obj.set_callbacks(fill_callback, datastream_callback)
+        loop.run_until_complete(run())
+        return fill_report, datastream_report
+
+    def test_error_events(self):
+        loop = asyncio.get_event_loop()
+        sharded = ShardedExchange(1, instruments=[Instrument("A")])
+        published = []
+        sharded.add_event_handler(published.extend)
+        sharded.start(loop)
+        try:
+            self.assertEqual(sharded.open_order_events("1", 0, "BUY", 150, 200, "A"), [])
+            sharded.modify_order_events(0, "1", 140, 100, "A")
+            sharded.cancel_order_events(0, "1", "A")
+            sharded.cancel_order_events(0, "1", "A")
+            sharded.modify_order_events(0, "1", qty=1, symbol="A")
+            loop.run_until_complete(sharded.sync())
+        finally:
+            sharded.stop(loop)
+        self.assertEqual([event for event in published if event[0] not in exchange.DATASTREAM_EVENTS], [
+            ("new", 0, "1", "A"),
+            ("modified", 0, "1", "A"),
+            ("cancelled", 0, "1", "A"),
+            ("error", 0, "KeyError: 'Order with specified id does not exit'"),
+            ("error", 0, "KeyError: 'Order with specified id does not exit'"),
+        ])
+
+    def test_same_reports_as_exchange(self):
+        loop = asyncio.get_event_loop()
+        instruments = [Instrument("A"), Instrument("B"), Instrument("C")]
+        orders = [("0", 0, "BUY", 10, 100, "B")]
+        orders += [(str(i), i % 3, "BUY" if i % 2 else "SELL", 100 + i % 7, 10 + i % 5, "ABC"[i % 3])
+                   for i in range(1, 300)]
+        sharded = ShardedExchange(2, instruments=instruments)
+        sharded.start(loop)
+        try:
+            (sharded_fills, sharded_datastream) = self._run(sharded, orders)
+        finally:
+            sharded.stop(loop)
+        plain = exchange.Exchange(instruments=instruments)
+        (fills, datastream) = self._run(plain, orders)
+        for symbol in "ABC":
+            self.assertEqual([x for x in sharded_fills if x[4] == symbol], [x for x in fills if x[4] == symbol])
+            self.assertEqual([x for x in sharded_datastream if x[4] == symbol],
+                             [x for x in datastream if x[4] == symbol])
+        self.assertGreater(len(fills), 0)
+        self.assertEqual(sharded.stats, plain.stats)
@@ -0,0 +1,124 @@
+from unittest import TestCase
+import asyncio
+import os
+import tempfile
+
+from exchange import exchange
+from exchange.instrument import Instrument
+from exchange.journal import Journal
+from exchange.order import ORDER_TYPES
+from tests import benchmark
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _exchange(self, snapshot_interval=0):
+        e = exchange.Exchange(instruments=[Instrument("A"), Instrument("B")])
+        journal = Journal(self.path, False, snapshot_interval)
+        replayed = journal.recover(e)
+        e.journal = journal
+        return e, replayed
+
+    def _run(self, e, flow):
+        for (n, item) in enumerate(flow):
+            symbol = "AB"[n % 2]
+            try:
+                if item[0] == "open":
+                    # some of the orders are of other types, which have to be journaled as well
+                    order_type = ORDER_TYPES[n % 4] if n % 5 == 0 else "LIMIT"
+                    e.open_order_events(*item[1:], symbol=symbol, order_type=order_type)
+                else:
+                    e.cancel_order_events(item[1], item[2], symbol)
+                if n % 7 == 0 and item[0] == "open":
+                    e.modify_order_events(item[2], item[1], item[4] + n % 3 - 1, max(1, item[5] - n % 5), symbol)
+                if n % 250 == 0:
+                    e.cancel_all_events(n % 10, symbol if n % 500 else None, "BUY")
+            except KeyError:  # already filled
+                pass
+            if e.journal and n % 100 == 0:
+                e.commit()
+        if e.journal:
+            e.commit()
+
+    def _state(self, e):
+        return (e.stats, {s: (b.get_depth("BUY", 1000), b.get_depth("SELL", 1000)) for (s, b) in e.books.items()})
+
+    def test_recover(self):
+        flow = benchmark.generate_order_flow(2000)
+        (e, replayed) = self._exchange()
+        self.assertEqual(replayed, 0)
+        e.get_clientid()
+        self._run(e, flow[:1000])
+        e.journal.close()
+        (recovered, replayed) = self._exchange()
+        self.assertGreater(replayed, 500)
+        self.assertEqual(self._state(recovered), self._state(e))
+        self.assertEqual(recovered.next_clientid, 10, "Recovered orders could be attributed to new clients")
+        e.journal = None
+        self._run(recovered, flow[1000:])
+        recovered.journal.close()
+        recovered.journal = None
+        self._run(e, flow[1000:])
+        self.assertEqual(self._state(recovered), self._state(e))
+
+    def test_torn_record(self):
+        (e, _) = self._exchange()
+        e.open_order_events("1", 0, "BUY", 100, 10, "A")
+        e.commit()
+        e.journal.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "ab") as f:
+            f.write(b"\x10\0\0\0garbage")
+        (recovered, replayed) = self._exchange()
+        self.assertEqual(replayed, 1)
+        self.assertEqual(os.path.getsize(self.path), size)
+        recovered.open_order_events("2", 0, "SELL", 99, 4, "A")
+        recovered.commit()
+        recovered.journal.close()
+        (recovered, replayed) = self._exchange()
+        self.assertEqual(replayed, 2)
+        self.assertEqual(recovered.get_book("A").get_price_qty("BUY", 100), 6)
+
+    def test_snapshot(self):
+        flow = benchmark.generate_order_flow(1000)
+        (e, _) = self._exchange(300)
+        self._run(e, flow)
+        self.assertGreater(e.journal.stats["snapshots"], 0)
+        e.journal.close()
+        (recovered, replayed) = self._exchange(300)
+        self.assertLess(replayed, 300)
+        self.assertEqual(self._state(recovered), self._state(e))
+        # Orders recovered from the snapshot keep their priority.
+        recovered.open_order_events("x", 99, "BUY", 1, 10, "A")
+        recovered.open_order_events("y", 99, "BUY", 1, 10, "A")
+        recovered.open_order_events("z", 98, "SELL", 1, 10, "A")
+        self.assertEqual(recovered.cancel_order_events(99, "x", "A")[1][4], 10)
+
+    def test_publish_after_commit(self):
+        loop = asyncio.get_event_loop()
+        (e, _) = self._exchange()
+        published = []
+        e.add_event_handler(published.extend)
+
+        async def run():
+            e.publish(e.open_order_events("1", 0, "BUY", 100, 10, "A"))
+            e.publish(e.open_order_events("2", 1, "SELL", 99, 10, "A"))
+            self.assertEqual(published, [])
+            self.assertEqual(os.path.getsize(self.path), 0)
+            await asyncio.sleep(0)
+
+        loop.run_until_complete(run())
+        self.assertEqual(e.journal.stats["commits"], 1)
+        self.assertEqual([event[0] for event in published], ["new", "orderbook", "new", "fill", "fill", "trade",
+                                                             "orderbook"])
+        e.journal.close()
+
+    def test_journal_benchmark(self):
+        results = benchmark.journal_benchmark(2000, directory=self.directory.name)
+        self.assertEqual(sorted(results), ["fsync", "no fsync", "none", "recovery"])
@@ -0,0 +1,57 @@
+from unittest import TestCase
+import asyncio
+
+from exchange.exchange import Exchange
+from exchange.metrics import Metrics, MetricsServer
+
+
+class TestMetrics(TestCase):
+    def test_render(self):
+        metrics = Metrics()
+        e = Exchange()
+        e.register_metrics(metrics)
+        e.open_order_events("1", 0, "BUY", 100, 10)
+        e.open_order_events("2", 0, "BUY", 99, 10)
+        e.open_order_events("3", 1, "SELL", 98, 10)
+        metrics.count("requests", 3)
+        latency = metrics.histogram("match_ns")
+        self.assertIs(metrics.histogram("match_ns"), latency)
+        for value in range(1, 101):
+            latency.record(value * 1000)
+        values = metrics.values()
+        self.assertEqual(values["requests"], 3)
+        self.assertEqual(values["exchange_orders_opened"], 3)
+        self.assertEqual(values["exchange_orders_traded"], 2)
+        self.assertEqual(values["exchange_book_bid_orders"], 1)
+        self.assertEqual(values["exchange_book_ask_orders"], 0)
+        self.assertEqual(values["journal_commits"], 0)
+        lines = metrics.render().splitlines()
+        self.assertIn("# TYPE requests counter", lines)
+        self.assertIn("# TYPE exchange_book_bid_orders gauge", lines)
+        self.assertIn("exchange_orders_opened 3", lines)
+        self.assertIn("# TYPE match_ns summary", lines)
+        self.assertIn('match_ns{quantile="0.5"} %d' % latency.percentile(50), lines)
+        self.assertIn("match_ns_count 100", lines)
+        self.assertIn("match_ns_sum 5050000", lines)
+        self.assertIn("match_ns_max 100000", lines)
+
+    def test_server(self):
+        loop = asyncio.get_event_loop()
+        metrics = Metrics()
+        metrics.count("requests", 5)
+        server = MetricsServer("localhost", 0, metrics)
+        server.start(loop)
+
+        async def get(path):
+            reader, writer = await asyncio.open_connection("localhost", server.port)
+            writer.write(("GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path).encode())
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+
+        response = loop.run_until_complete(get("/metrics"))
+        server.stop(loop)
+        (head, body) = response.split("\r\n\r\n", 1)
+        self.assertTrue(head.startswith("HTTP/1.0 200 OK"))
+        self.assertIn("Content-Length: %d" % len(body), head)
+        self.assertEqual(body, metrics.render())
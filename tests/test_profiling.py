@@ -0,0 +1,77 @@
+from unittest import TestCase
+import asyncio
+import csv
+import os
+import tempfile
+import time
+
+from exchange import exchange
+from exchange.instrument import Instrument
+from exchange.profiling import Profiler
+from exchange.server import OrderServer
+from tests import benchmark
+
+
+def _busy(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+class TestProfiling(TestCase):
+    def test_samples_and_slow_callbacks(self):
+        loop = asyncio.get_event_loop()
+        profiler = Profiler(interval=0.001, slow_callback=0.02)
+        handle_run = asyncio.Handle._run
+        profiler.start()
+        try:
+            loop.call_soon(_busy, 0.05)
+            loop.call_soon(_busy, 0.001)
+            loop.run_until_complete(asyncio.sleep(0.01))
+        finally:
+            profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertIs(asyncio.Handle._run, handle_run)
+        self.assertGreater(sum(count for (stack, count) in profiler.stacks.items() if "_busy" in stack), 10)
+        self.assertTrue(any(stack.split(";")[-1].startswith("_busy (test_profiling.py:")
+                            for stack in profiler.stacks))
+        self.assertEqual(len(profiler.slow_callbacks), 1)
+        self.assertGreaterEqual(profiler.slow_callbacks[0][1], 0.02)
+        self.assertIn("_busy", profiler.slow_callbacks[0][2])
+
+        # nothing is collected while stopped
+        samples = sum(profiler.stacks.values())
+        loop.call_soon(_busy, 0.05)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(sum(profiler.stacks.values()), samples)
+        self.assertEqual(len(profiler.slow_callbacks), 1)
+
+    def test_order_server_trace(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        order_server = OrderServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        profiler = Profiler()
+        order_server.profiler = profiler
+        order_server.start(loop)
+        loop.run_until_complete(benchmark.latency_benchmark("localhost", order_server.port, 100))
+        profiler.toggle()
+        loop.run_until_complete(benchmark.latency_benchmark("localhost", order_server.port, 100))
+        profiler.toggle()
+        loop.run_until_complete(benchmark.latency_benchmark("localhost", order_server.port, 100))
+        order_server.stop(loop)
+        self.assertEqual(len(profiler.trace), 100)
+        self.assertEqual(sorted(row[2] for row in profiler.trace), list(range(100)))
+        with tempfile.TemporaryDirectory() as directory:
+            prefix = os.path.join(directory, "profile")
+            profiler.dump(prefix)
+            with open(prefix + ".folded") as file:
+                lines = file.read().splitlines()
+            self.assertEqual(len(lines), len(profiler.stacks))
+            for line in lines:
+                self.assertRegex(line, r"^\S.* \d+$")
+            with open(prefix + ".stages.csv", newline="") as file:
+                rows = list(csv.DictReader(file))
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[0]["batch"], "1")
+        self.assertGreater(float(rows[0]["match_us"]), 0)
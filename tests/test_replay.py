@@ -0,0 +1,76 @@
+from unittest import TestCase
+import io
+import os
+import tempfile
+import time
+
+from exchange import replay
+from exchange.book import Book
+from exchange.exchange import Exchange
+from exchange.instrument import Instrument
+from exchange.levelbook import LevelBook
+from tests import benchmark
+
+
+def _records(num_orders):
+    # Records of the benchmark order flow with integer order ids, 1 ms apart.
+    records = []
+    for (n, item) in enumerate(benchmark.generate_order_flow(num_orders)):
+        if item[0] == "open":
+            command = ("open", int(item[1]), item[2], item[3], item[4], item[5], "A")
+        else:
+            command = ("cancel", item[1], int(item[2]), "A")
+        records.append((1500000000.0 + n / 1000, command))
+    return records
+
+
+class TestReplay(TestCase):
+    instruments = {"A": Instrument("A", "0.01")}
+
+    def test_binary_round_trip(self):
+        records = _records(1000)
+        file = io.BytesIO()
+        replay.write_binary(file, records)
+        file.seek(0)
+        chunks = list(replay.read_binary(file, chunk_size=300, read_size=1000))
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 300)
+        self.assertEqual([r for chunk in chunks for r in chunk], records)
+        file = io.BytesIO(file.getvalue()[:-1])
+        with self.assertRaises(ValueError):
+            list(replay.read_binary(file))
+
+    def test_csv_round_trip(self):
+        records = _records(1000)
+        file = io.StringIO(newline="")
+        replay.write_csv(file, records, self.instruments)
+        file.seek(0)
+        chunks = list(replay.read_csv(file, self.instruments, chunk_size=300))
+        self.assertEqual([len(chunk) for chunk in chunks], [300, 300, 300, 100])
+        # CSV has no types, order ids are read as strings
+        self.assertEqual([r for chunk in chunks for r in chunk],
+                         [(t, c[:1] + (str(c[1]),) + c[2:] if c[0] == "open" else c[:2] + (str(c[2]),) + c[3:])
+                          for (t, c) in records])
+
+    def test_replay(self):
+        records = _records(5000)
+        results = []
+        for target in [Exchange(instruments=self.instruments.values()), Book(), LevelBook()]:
+            stats = replay.replay([records[:2000], records[2000:]], target)
+            self.assertEqual(stats.commands(), 5000)
+            self.assertEqual(stats.latency.count, 5000)
+            results.append((stats.opened, stats.cancelled, stats.rejected, stats.fills))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        self.assertGreater(results[0][3], 0)
+        self.assertIn("Latency", stats.report())
+
+    def test_speed(self):
+        records = _records(100)  # 0.1 s of orders
+        start = time.perf_counter()
+        replay.replay([records], Book(), speed=2)
+        self.assertGreater(time.perf_counter() - start, 0.045)
+
+    def test_replay_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            results = benchmark.replay_benchmark(2000, os.path.join(directory, "orders"))
+        self.assertEqual(sorted(results), ["binary", "csv"])
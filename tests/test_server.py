@@ -1,44 +1,468 @@
 from unittest import TestCase
 import asyncio
+import json
 
-from exchange import exchange
+from exchange import exchange, binary
+from exchange.instrument import Instrument
+from exchange.metrics import Metrics
+from exchange.sharding import ShardedExchange
 from exchange.server import OrderServer, DatastreamServer
-from tests import benchmark
+from tests import benchmark, benchmark_suite
+
+
+class _Transport:
+    def __init__(self):
+        self.buffered = 0
+        self.aborted = False
+
+    def is_closing(self):
+        return self.aborted
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def abort(self):
+        self.aborted = True
+
+
+class _Writer:
+    def __init__(self):
+        self.transport = _Transport()
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+def _messages(writer):
+    return [json.loads(line) for data in writer.written for line in bytes(data).decode().splitlines()]
 
 
 class TestServer(TestCase):
+    def test_send_json_batched(self):
+        loop = asyncio.get_event_loop()
+        server = OrderServer("localhost", 0, exchange.Exchange())
+        writer = _Writer()
+
+        async def send():
+            for i in range(10):
+                await server._send_json(writer, {"n": i})
+            self.assertEqual(writer.written, [], "Messages were written before the end of loop iteration")
+            await asyncio.sleep(0)
+
+        loop.run_until_complete(send())
+        self.assertEqual(len(writer.written), 1)
+        self.assertEqual(_messages(writer), [{"n": i} for i in range(10)])
+
     def test_order_benchmark(self):
         loop = asyncio.get_event_loop()
         e = exchange.Exchange()
-        order_server = OrderServer("localhost", 7001, e)
-        datastream_server = DatastreamServer("localhost", 7002, e)
-        e.set_callbacks(order_server.fill_order_report, datastream_server.send_datastream_report)
+        order_server = OrderServer("localhost", 0, e)
+        datastream_server = DatastreamServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        e.add_event_handler(datastream_server.handle_events)
+        metrics = Metrics()
+        e.register_metrics(metrics)
+        order_server.register_metrics(metrics)
+        datastream_server.register_metrics(metrics)
         order_server.start(loop)
         datastream_server.start(loop)
-        loop.run_until_complete(asyncio.wait([
-            benchmark.benchmark("localhost", 7001, 1000, 0.01)
-        ]))
+        loop.run_until_complete(benchmark.benchmark("localhost", order_server.port, 1000, 0.01))
         order_server.stop(loop)
         datastream_server.stop(loop)
-        e.print_stats()
         self.assertEqual(e.stats["opened"], 1000)
         self.assertGreater(e.stats["traded"], 500)
+        values = metrics.values()
+        self.assertEqual(values["exchange_orders_opened"], 1000)
+        self.assertEqual(values["order_requests"], 1000)
+        self.assertGreaterEqual(values["order_fills"], e.stats["traded"])
+        self.assertEqual(values["order_errors"], 0)
+        self.assertEqual(values["exchange_book_bid_orders"] + values["exchange_book_ask_orders"],
+                         sum(e.get_book().get_order_count(side) for side in ["BUY", "SELL"]))
+        self.assertEqual(metrics.histograms["order_match_ns"].count, 1000)
+        self.assertGreater(metrics.histograms["order_parse_ns"].count, 0)
 
     def test_order_network_benchmark(self):
         loop = asyncio.get_event_loop()
         e = exchange.Exchange()
-        order_server = OrderServer("localhost", 7001, e)
-        datastream_server = DatastreamServer("localhost", 7002, e)
-        e.set_callbacks(order_server.fill_order_report, datastream_server.send_datastream_report)
+        order_server = OrderServer("localhost", 0, e)
+        datastream_server = DatastreamServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        e.add_event_handler(datastream_server.handle_events)
+        order_server.start(loop)
+        datastream_server.start(loop)
+        loop.run_until_complete(benchmark.network_benchmark("localhost", order_server.port, 1000, 0.01))
+        order_server.stop(loop)
+        datastream_server.stop(loop)
+        self.assertEqual(e.stats["opened"], 1000)
+        self.assertGreater(e.stats["traded"], 500)
+
+    def test_sharded_benchmark(self):
+        loop = asyncio.get_event_loop()
+        symbols = ["S%d" % n for n in range(8)]
+        e = ShardedExchange(2, instruments=[Instrument(s) for s in symbols])
+        order_server = OrderServer("localhost", 0, e)
+        datastream_server = DatastreamServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        e.add_event_handler(datastream_server.handle_events)
+        e.start(loop)
         order_server.start(loop)
         datastream_server.start(loop)
-        loop.run_until_complete(asyncio.wait([
-            benchmark.network_benchmark("localhost", 7001, 1000, 0.01)
-        ]))
+        loop.run_until_complete(benchmark.benchmark("localhost", order_server.port, 1000, 0.01, symbols))
+        loop.run_until_complete(e.sync())
         order_server.stop(loop)
         datastream_server.stop(loop)
-        e.print_stats()
+        e.stop(loop)
         self.assertEqual(e.stats["opened"], 1000)
         self.assertGreater(e.stats["traded"], 500)
 
+    def test_datastream_benchmark(self):
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(benchmark.datastream_benchmark("localhost", 0, (1, 20), 500))
+        self.assertEqual(sorted(results), [1, 20])
+
+    def test_join_benchmark(self):
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(benchmark.join_benchmark("localhost", (5000,)))
+        (elapsed, blocked) = results[5000]
+        self.assertLess(blocked, elapsed / 2, "Snapshot was not sent in chunks")
+
+    def _slow_consumer(self, policy, exchange_obj=None):
+        loop = asyncio.get_event_loop()
+        exchange_obj = exchange_obj or exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        server = DatastreamServer("localhost", 0, exchange_obj, 1000, policy)
+        (fast, slow) = (_Writer(), _Writer())
+        server.clients = {0: (None, fast), 1: (None, slow)}
+
+        async def send(prices):
+            for price in prices:
+                await server.send_datastream_report("orderbook", "BUY", 0.0, price, 10)
+            await asyncio.sleep(0)
+
+        slow.transport.buffered = 1001
+        loop.run_until_complete(send([100, 101, 100]))
+        self.assertEqual(len(_messages(fast)), 3)
+        self.assertEqual(_messages(slow), [])
+        self.assertEqual(server.get_client_stats()[1]["buffered"], 1001)
+        slow.transport.buffered = 0
+        loop.run_until_complete(send([102]))
+        return server, slow
+
+    def test_slow_consumer_disconnect(self):
+        (server, slow) = self._slow_consumer("disconnect")
+        self.assertTrue(slow.transport.aborted)
+        self.assertEqual(_messages(slow), [])
+        self.assertEqual(server.stats["disconnected"], 1)
+
+    def test_slow_consumer_drop(self):
+        (server, slow) = self._slow_consumer("drop")
+        messages = _messages(slow)
+        self.assertEqual(messages[0], {"type": "gap", "dropped": 3, "seq": 3})
+        self.assertEqual([(m["price"], m["seq"]) for m in messages[1:]], [("102", 4)])
+
+    def test_slow_consumer_conflate(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        loop.run_until_complete(e.open_order("1", 0, "BUY", 100, 30))
+        (server, slow) = self._slow_consumer("conflate", e)
+        messages = _messages(slow)
+        self.assertEqual(messages[0], {"type": "gap", "dropped": 3, "seq": 3})
+        self.assertEqual([(m["price"], m["quantity"], m["seq"]) for m in messages[1:]],
+                         [("100", 30, 3), ("101", 0, 3), ("102", 10, 4)])
+
+    def test_snapshot_on_connect(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument("A", "1"), Instrument("B", "1")])
+        datastream_server = DatastreamServer("localhost", 0, e)
+        datastream_server.snapshot_chunk = 3
+        e.add_event_handler(datastream_server.handle_events)
+        datastream_server.start(loop)
+        flow = benchmark.generate_order_flow(400, seed=1)
+
+        def run_flow(items):
+            for (n, item) in enumerate(items):
+                symbol = "AB"[n % 2]
+                try:
+                    if item[0] == "open":
+                        e.publish(e.open_order_events(*item[1:], symbol=symbol))
+                    else:
+                        e.publish(e.cancel_order_events(item[1], item[2], symbol))
+                except KeyError:  # already filled or cancelled in the other book
+                    pass
+
+        async def run():
+            run_flow(flow[:300])
+            (reader, writer) = await asyncio.open_connection("localhost", datastream_server.port)
+            while not datastream_server.clients:
+                await asyncio.sleep(0.001)
+            for n in range(300, 400, 10):  # the book changes while the snapshot is being sent
+                run_flow(flow[n:n + 10])
+                await asyncio.sleep(0)
+            books = {"A": {"bid": {}, "ask": {}}, "B": {"bid": {}, "ask": {}}}
+            snapshot = []
+            while True:
+                message = json.loads((await reader.readline()).decode())
+                if message["type"] == "snapshotEnd":
+                    break
+                snapshot.append(message)
+                for (price, qty) in message["levels"]:
+                    books[message["symbol"]][message["side"]][int(price)] = qty
+            seq = message["seq"]
+            while seq < datastream_server._seq:
+                message = json.loads((await reader.readline()).decode())
+                self.assertEqual(message["seq"], seq + 1, "Reports after the snapshot are not contiguous")
+                seq = message["seq"]
+                if message["type"] == "trade":
+                    continue
+                levels = books[message["symbol"]][message["side"]]
+                price = int(message["price"])
+                qty = levels.get(price, 0) - message["quantity"] if message["type"] == "cancel" else message["quantity"]
+                if qty:
+                    levels[price] = qty
+                else:
+                    del levels[price]
+            writer.close()
+            return snapshot, books
+
+        (snapshot, books) = loop.run_until_complete(run())
+        datastream_server.stop(loop)
+        self.assertGreater(len(snapshot), 4, "Snapshot was not sent in chunks")
+        self.assertTrue(all(len(message["levels"]) <= 3 for message in snapshot))
+        bids = [int(price) for message in snapshot if message["side"] == "bid" and message["symbol"] == "A"
+                for (price, qty) in message["levels"]]
+        self.assertEqual(bids, sorted(bids, reverse=True), "Levels are not sent best first")
+        for symbol in "AB":
+            self.assertEqual(sorted(books[symbol]["bid"].items(), reverse=True),
+                             e.get_book(symbol).get_depth("BUY", 1000))
+            self.assertEqual(sorted(books[symbol]["ask"].items()), e.get_book(symbol).get_depth("SELL", 1000))
+
+    def test_depth_subscription(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        order_server = OrderServer("localhost", 0, e)
+        datastream_server = DatastreamServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        e.add_event_handler(datastream_server.handle_events)
+        order_server.start(loop)
+        datastream_server.start(loop)
+
+        async def run():
+            (reader, writer) = await asyncio.open_connection("localhost", datastream_server.port)
+            writer.write(b'{"message": "subscribe", "depth": 2, "interval": 0.05}\n')
+            await asyncio.sleep(0.01)
+            for i in range(200):
+                price = 90 + i % 10 if i % 2 else 110 - i % 10
+                await e.open_order(str(i), 0, "BUY" if i % 2 else "SELL", price, 10)
+            await asyncio.sleep(0.2)
+            writer.close()
+            return [json.loads(line) for line in (await reader.read()).decode().splitlines()]
+
+        messages = loop.run_until_complete(run())
+        order_server.stop(loop)
+        datastream_server.stop(loop)
+        # the snapshot of the empty book is sent on connect, before the subscription arrives
+        self.assertEqual(messages[0], {"type": "snapshotEnd", "seq": 0})
+        messages = messages[1:]
+        self.assertEqual({m["type"] for m in messages}, {"depth"})
+        self.assertLessEqual(len(messages), 3, "Snapshots were not conflated")
+        self.assertEqual(messages[-1]["bids"], [["99", 200], ["97", 200]])
+        self.assertEqual(messages[-1]["asks"], [["102", 200], ["104", 200]])
+
+    def test_binary_protocol(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        order_server = OrderServer("localhost", 0, e)
+        datastream_server = DatastreamServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        e.add_event_handler(datastream_server.handle_events)
+        order_server.start(loop)
+        datastream_server.start(loop)
+
+        async def run():
+            (reader, writer) = await asyncio.open_connection("localhost", order_server.port)
+            writer.write(binary.MAGIC)
+            writer.write(binary.pack_create_order(1, "BUY", 101, 10))
+            writer.write(binary.pack_create_order(2, "SELL", 100, 4))
+            writer.write(binary.pack_cancel_order(1))
+            writer.write(binary.pack_cancel_order(1))
+            responses = []
+            for _ in range(6):
+                (length,) = binary.HEADER.unpack(await reader.readexactly(binary.HEADER.size))
+                responses.append(binary.unpack_response(await reader.readexactly(length)))
+            writer.close()
+            return responses
+
+        responses = loop.run_until_complete(run())
+        results = loop.run_until_complete(benchmark.protocol_benchmark("localhost", order_server.port, 2000))
+        order_server.stop(loop)
+        datastream_server.stop(loop)
+        self.assertEqual(responses[:5], [
+            ("executionReport", 1, "NEW", 0, 0, ""),
+            ("executionReport", 2, "NEW", 0, 0, ""),
+            ("executionReport", 2, "FILL", 101, 4, ""),
+            ("executionReport", 1, "FILL", 101, 4, ""),
+            ("executionReport", 1, "CANCELLED", 0, 0, ""),
+        ])
+        self.assertEqual(responses[5][0], "error")
+        self.assertEqual(sorted(results), ["binary", "json"])
+
+    def test_modify_order(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="0.5")])
+        order_server = OrderServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        order_server.start(loop)
+
+        async def run():
+            (reader, writer) = await asyncio.open_connection("localhost", order_server.port)
+            (binary_reader, binary_writer) = await asyncio.open_connection("localhost", order_server.port)
+            writer.write(b'{"message": "createOrder", "orderId": 1, "side": "BUY", "price": "100", "quantity": 10}\n'
+                         b'{"message": "modifyOrder", "orderId": 1, "quantity": 4}\n'
+                         b'{"message": "modifyOrder", "orderId": 1, "price": "100.5"}\n'
+                         b'{"message": "modifyOrder", "orderId": 2, "price": "100.5"}\n')
+            messages = [json.loads((await reader.readline()).decode()) for _ in range(4)]
+            binary_writer.write(binary.MAGIC + binary.pack_create_order(1, "SELL", 202, 10))
+            binary_writer.write(binary.pack_modify_order(1, price=200, qty=6))
+            responses = []
+            for _ in range(3):
+                (length,) = binary.HEADER.unpack(await binary_reader.readexactly(binary.HEADER.size))
+                responses.append(binary.unpack_response(await binary_reader.readexactly(length)))
+            writer.close()
+            binary_writer.close()
+            return messages, responses
+
+        (messages, responses) = loop.run_until_complete(run())
+        order_server.stop(loop)
+        self.assertEqual([(m["message"], m.get("orderId"), m.get("report")) for m in messages], [
+            ("executionReport", 1, "NEW"),
+            ("executionReport", 1, "MODIFIED"),
+            ("executionReport", 1, "MODIFIED"),
+            ("error", None, "Processing your request failed"),
+        ])
+        self.assertEqual(responses, [
+            ("executionReport", 1, "NEW", 0, 0, ""),
+            ("executionReport", 1, "MODIFIED", 0, 0, ""),
+            ("executionReport", 1, "FILL", 201, 4, ""),
+        ])
+        self.assertEqual(e.get_book().get_depth("SELL", 10), [(200, 2)])
+
+    def test_cancel_all(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        order_server = OrderServer("localhost", 0, e)
+        datastream_server = DatastreamServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        e.add_event_handler(datastream_server.handle_events)
+        order_server.start(loop)
+        datastream_server.start(loop)
+
+        async def run():
+            (datastream, datastream_writer) = await asyncio.open_connection("localhost", datastream_server.port)
+            (reader, writer) = await asyncio.open_connection("localhost", order_server.port)
+            (binary_reader, binary_writer) = await asyncio.open_connection("localhost", order_server.port)
+            writer.write(b'{"message": "session", "cancelOnDisconnect": true}\n')
+            for (n, price) in enumerate([100, 100, 98, 97]):
+                writer.write(('{"message": "createOrder", "orderId": %d, "side": "BUY", "price": "%d", '
+                              '"quantity": 10}\n' % (n, price)).encode())
+            writer.write(b'{"message": "cancelAll", "side": "BUY", "minPrice": "98"}\n')
+            writer.write(b'{"message": "cancelAll", "side": "SELL"}\n')
+            messages = [json.loads((await reader.readline()).decode()) for _ in range(9)]
+            binary_writer.write(binary.MAGIC + binary.pack_session(binary.CANCEL_ON_DISCONNECT))
+            binary_writer.write(binary.pack_create_order(1, "SELL", 120, 10))
+            binary_writer.write(binary.pack_session(0))
+            binary_writer.write(binary.pack_create_order(2, "SELL", 130, 10))
+            binary_writer.write(binary.pack_cancel_all(max_price=125, symbol=""))
+            responses = []
+            for _ in range(4):
+                (length,) = binary.HEADER.unpack(await binary_reader.readexactly(binary.HEADER.size))
+                responses.append(binary.unpack_response(await binary_reader.readexactly(length)))
+            writer.close()
+            binary_writer.close()
+            await asyncio.sleep(0.01)
+            cancels = []
+            while len(cancels) < 3:
+                message = json.loads((await datastream.readline()).decode())
+                if message["type"] == "cancel":
+                    cancels.append((message["side"], message["price"], message["quantity"]))
+            datastream_writer.close()
+            return messages, responses, cancels
+
+        (messages, responses, cancels) = loop.run_until_complete(run())
+        order_server.stop(loop)
+        datastream_server.stop(loop)
+        self.assertEqual([(m.get("orderId"), m["report"]) for m in messages],
+                         [(0, "NEW"), (1, "NEW"), (2, "NEW"), (3, "NEW"), (0, "CANCELLED"), (1, "CANCELLED"),
+                          (2, "CANCELLED"), (None, "CANCELLED_ALL"), (None, "CANCELLED_ALL")])
+        self.assertEqual([m["quantity"] for m in messages[7:]], [3, 0], "Cancels without orders are reported too")
+        self.assertEqual(responses, [
+            ("executionReport", 1, "NEW", 0, 0, ""),
+            ("executionReport", 2, "NEW", 0, 0, ""),
+            ("executionReport", 1, "CANCELLED", 0, 0, ""),
+            ("executionReport", 0, "CANCELLED_ALL", 0, 1, ""),
+        ])
+        # one message per level, the remaining order 3 was cancelled on disconnect, order 2 of the binary client not
+        self.assertEqual(cancels, [("bid", "100", 20), ("bid", "98", 10), ("ask", "120", 10)])
+        self.assertEqual(e.get_book().get_depth("BUY", 10), [])
+        self.assertEqual(e.get_book().get_depth("SELL", 10), [(130, 10)])
+
+    def test_pipelined_requests(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        order_server = OrderServer("localhost", 0, e)
+        datastream_server = DatastreamServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        e.add_event_handler(datastream_server.handle_events)
+        order_server.start(loop)
+        datastream_server.start(loop)
+
+        async def run():
+            (reader, writer) = await asyncio.open_connection("localhost", order_server.port)
+            writer.write(b'{"message": "createOrder", "orderId": 1, "side": "BUY", "price": "101", "quantity": 10}\n'
+                         b'{"message": "cancelOrder", "orderId": 2}\n'
+                         b'not json\n'
+                         b'{"message": "createOrder", "orderId": 2, "side": "SELL", "price": "100", ')
+            await asyncio.sleep(0.01)
+            writer.write(b'"quantity": 4}\n{"message": "cancelOrder", "orderId": 1}\n')
+            messages = [json.loads((await reader.readline()).decode()) for _ in range(7)]
+            writer.close()
+            return messages
+
+        messages = loop.run_until_complete(run())
+        rate = loop.run_until_complete(benchmark.pipeline_benchmark("localhost", order_server.port, 2000))
+        order_server.stop(loop)
+        datastream_server.stop(loop)
+        self.assertEqual([(m["message"], m.get("orderId"), m.get("report")) for m in messages], [
+            ("executionReport", 1, "NEW"),
+            ("error", None, "Processing your request failed"),
+            ("error", None, "Processing your request failed"),
+            ("executionReport", 2, "NEW"),
+            ("executionReport", 2, "FILL"),
+            ("executionReport", 1, "FILL"),
+            ("executionReport", 1, "CANCELLED"),
+        ])
+        self.assertGreater(rate, 0)
+
+    def test_latency_benchmark(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument(tick_size="1")])
+        order_server = OrderServer("localhost", 0, e)
+        e.add_event_handler(order_server.handle_events)
+        order_server.start(loop)
+        results = loop.run_until_complete(benchmark.latency_benchmark("localhost", order_server.port, 400, 4, 5))
+        order_server.stop(loop)
+        self.assertEqual(results["ack"].count, 400)
+        self.assertEqual(results["fill"].count, 200)
+        self.assertLessEqual(results["ack"].percentile(50), results["ack"].percentile(99))
+        self.assertEqual(e.stats["traded"], 400)
+
+    def test_benchmark_suite(self):
+        current = benchmark_suite.run_suite(quick=True)
+        self.assertIn("e2e.ack.p99", current["results"])
+        self.assertIn("datastream.subscribers_10", current["results"])
+        self.assertEqual(benchmark_suite.compare(current, current), [])
+        baseline = json.loads(json.dumps(current))
+        baseline["results"]["e2e.ack.p99"]["value"] = current["results"]["e2e.ack.p99"]["value"] / 2
+        baseline["results"]["exchange.events"]["value"] = current["results"]["exchange.events"]["value"] * 2
+        self.assertEqual([r[0] for r in benchmark_suite.compare(current, baseline)], ["e2e.ack.p99", "exchange.events"])
+
     # Future work: implement more tests. Not all funcionality and error cases are covered.
\ No newline at end of file
@@ -0,0 +1,115 @@
+from unittest import TestCase
+import asyncio
+import multiprocessing
+import os
+import tempfile
+from decimal import Decimal
+
+from exchange import exchange
+from exchange.instrument import Instrument
+from exchange.sharding import ShardedExchange
+from exchange.sharedbook import SharedBookPublisher, SharedBookReader
+from tests import benchmark
+
+
+def _read_levels(path, reads, queue):
+    reader = SharedBookReader(path)
+    torn = 0
+    for _ in range(reads):
+        levels = reader.levels("A")
+        if levels.seq % 2 or len({qty for (price, qty) in levels.bids + levels.asks}) > 1:
+            torn += 1
+    reader.close()
+    queue.put(torn)
+
+
+class TestSharedBook(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "book")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_publish(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument("B", "0.01"), Instrument("A", "1")])
+        e.publish(e.open_order_events("0", 0, "SELL", 120, 1, "A"))  # recovered before the publisher starts
+        publisher = SharedBookPublisher(self.path, e, depth=2)
+        e.add_event_handler(publisher.handle_events)
+        reader = SharedBookReader(self.path)
+        self.assertEqual(reader.symbols(), ["A", "B"])
+        self.assertEqual(reader.instruments["B"].tick_size, Decimal("0.01"))
+        self.assertEqual(reader.best("A"), (None, (120, 1)))
+        self.assertEqual(reader.best("B"), (None, None))
+
+        e.publish(e.open_order_events("1", 0, "BUY", 100, 10, "A"))
+        e.publish(e.open_order_events("2", 0, "BUY", 101, 20, "A"))
+        e.publish(e.open_order_events("3", 0, "BUY", 101, 5, "A"))
+        e.publish(e.open_order_events("4", 0, "SELL", 110, 7, "A"))
+        self.assertEqual(reader.best("A"), (None, (120, 1)), "Books are written once per event loop iteration")
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(reader.best("A"), ((101, 25), (110, 7)))
+        levels = reader.levels("A")
+        self.assertEqual((levels.bids, levels.asks), ([(101, 25), (100, 10)], [(110, 7), (120, 1)]))
+        self.assertEqual(levels.seq, 4)
+        self.assertEqual(publisher.stats["writes"], 3)
+
+        # levels behind the published depth don't change the book
+        e.publish(e.open_order_events("5", 0, "BUY", 99, 10, "A"))
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(reader.seq("A"), 4)
+        e.publish(e.cancel_order_events(0, "2", "A"))
+        e.publish(e.open_order_events("6", 1, "SELL", 99, 15, "A"))
+        loop.run_until_complete(asyncio.sleep(0))
+        levels = reader.levels("A")
+        self.assertEqual((levels.bids, levels.asks), ([(99, 10)], [(110, 7), (120, 1)]))
+        self.assertEqual(levels.seq, 6)
+        self.assertEqual(reader.seq("B"), 2)
+        reader.close()
+        publisher.close()
+
+    def test_sharded(self):
+        loop = asyncio.get_event_loop()
+        sharded = ShardedExchange(2, instruments=[Instrument("A"), Instrument("B")])
+        publisher = SharedBookPublisher(self.path, sharded)
+        sharded.add_event_handler(publisher.handle_events)
+        sharded.start(loop)
+        try:
+            sharded.open_order_events("1", 0, "BUY", 100, 10, "A")
+            sharded.open_order_events("2", 0, "SELL", 101, 10, "B")
+            loop.run_until_complete(sharded.sync())
+            loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            sharded.stop(loop)
+        reader = SharedBookReader(self.path)
+        self.assertEqual(reader.best("A"), ((100, 10), None))
+        self.assertEqual(reader.best("B"), (None, (101, 10)))
+        reader.close()
+        publisher.close()
+
+    def test_consistent_reads(self):
+        loop = asyncio.get_event_loop()
+        e = exchange.Exchange(instruments=[Instrument("A")])
+        publisher = SharedBookPublisher(self.path, e, depth=5)
+        queue = multiprocessing.Queue()
+        reader = multiprocessing.Process(target=_read_levels, args=(self.path, 20000, queue))
+        reader.start()
+        qty = 0
+        while reader.is_alive():
+            qty += 1
+            publisher.handle_events([("orderbook", side, 0, price, qty, "A") for side in ["BUY", "SELL"]
+                                     for price in range(5)])
+            publisher.write()
+        torn = queue.get()
+        reader.join()
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(torn, 0)
+        self.assertGreater(qty, 1)
+        publisher.close()
+
+    def test_sharedbook_benchmark(self):
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(benchmark.sharedbook_benchmark(levels=(1000,), updates=100, reads=1000))
+        for name in ["Book", "LevelBook"]:
+            self.assertEqual(sorted(results[(name, 1000)]), ["best", "levels", "write"])